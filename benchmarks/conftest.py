@@ -0,0 +1,158 @@
+# Synthetic "large study" metadata shared by the benchmarks.
+#
+# Each study has SAMPLES_PER_HOST samples per host (on average), spread over
+# two years. Most timestamps are nicely formatted, but -- like in real
+# studies -- some are formatted differently, and the timestamps of "messy"
+# hosts (every other host) also include partial, malformed, and nonexistent
+# dates. Each of the other hosts follows a couple of dietary phases, each of
+# which was started and stopped multiple times.
+from collections import OrderedDict, namedtuple
+import numpy as np
+import pandas as pd
+import pytest
+from qeeseburger.utils import PARSE_CACHE, save_metadata
+
+SAMPLE_COUNTS = [10000, 100000, 1000000]
+SAMPLES_PER_HOST = 100
+# Number of times each phase was started (and stopped) by each host
+PHASE_RANGE_COUNTS = OrderedDict([("keto", 3), ("antibiotics", 2)])
+# Extra columns, so that loading/saving the metadata isn't unrealistically
+# fast
+NUM_FILLER_COLS = 20
+STUDY_START = np.datetime64("2018-01-01")
+STUDY_LENGTH_IN_DAYS = 730
+
+Study = namedtuple(
+    "Study",
+    [
+        "num_samples",
+        "metadata_df",
+        "metadata_file",
+        "birthdays_file",
+        "phase_intervals",
+        "diet_host",
+        "diet_key_dates",
+    ],
+)
+
+
+def _make_timestamps(rng, days, messy):
+    n = len(days)
+    timestamps = pd.Series(np.datetime_as_string(days), dtype=object)
+    kinds = rng.random(n)
+
+    us_style = kinds < 0.1
+    timestamps[us_style] = (
+        pd.Series(days[us_style]).dt.strftime("%-m/%-d/%Y").to_numpy()
+    )
+    with_time = (kinds >= 0.1) & (kinds < 0.15)
+    timestamps[with_time] = timestamps[with_time] + " 10:30"
+
+    partial = messy & (kinds >= 0.15) & (kinds < 0.18)
+    timestamps[partial] = timestamps[partial].str.slice(0, 7)
+    malformed = messy & (kinds >= 0.18) & (kinds < 0.2)
+    timestamps[malformed] = "not provided"
+    nonexistent = messy & (kinds >= 0.2) & (kinds < 0.21)
+    timestamps[nonexistent] = "2019-02-30"
+    return timestamps.to_numpy()
+
+
+def _make_phase_intervals(rng, host_ids):
+    phase_intervals = OrderedDict()
+    for host_id in host_ids:
+        phase_intervals[host_id] = OrderedDict()
+        for phase_name, num_ranges in PHASE_RANGE_COUNTS.items():
+            # Alternate between gaps and ranges, so the ranges don't overlap
+            lengths = rng.integers(10, 120, 2 * num_ranges)
+            bounds = STUDY_START + np.cumsum(lengths).astype("m8[D]")
+            phase_intervals[host_id][phase_name] = (bounds[0::2], bounds[1::2])
+    return phase_intervals
+
+
+def _make_key_dates(phase_intervals):
+    dates = []
+    events = []
+    for phase_name, (starts, stops) in phase_intervals.items():
+        for start, stop in zip(starts, stops):
+            dates += [start, stop]
+            events += ["Started " + phase_name, "Stopped " + phase_name]
+    return pd.DataFrame(
+        {"Event": events}, index=pd.DatetimeIndex(np.array(dates, "M8[D]"))
+    ).sort_index()
+
+
+def make_study(num_samples, output_dir, seed=0):
+    rng = np.random.default_rng(seed)
+    num_hosts = max(num_samples // SAMPLES_PER_HOST, 2)
+    host_nums = rng.integers(0, num_hosts, num_samples)
+    host_ids = np.array(["H{}".format(h) for h in range(num_hosts)])
+    days = STUDY_START + rng.integers(0, STUDY_LENGTH_IN_DAYS, num_samples)
+
+    md = pd.DataFrame(
+        OrderedDict(
+            [
+                ("host_subject_id", host_ids[host_nums]),
+                (
+                    "collection_timestamp",
+                    _make_timestamps(rng, days, host_nums % 2 == 1),
+                ),
+            ]
+            + [
+                ("filler_{}".format(i), "value_{}".format(i))
+                for i in range(NUM_FILLER_COLS)
+            ]
+        ),
+        index=pd.Index(
+            ["S{}".format(i) for i in range(num_samples)], name="sample_name"
+        ),
+    ).astype(object)
+    metadata_file = str(output_dir.join("metadata.tsv"))
+    save_metadata(md, metadata_file)
+
+    birthdays = np.datetime64("1950-01-01") + rng.integers(
+        0, 365 * 50, num_hosts
+    )
+    birthdays_file = str(output_dir.join("birthdays.tsv"))
+    pd.DataFrame(
+        {
+            "host_subject_id": host_ids,
+            "birthday": np.datetime_as_string(birthdays),
+        }
+    ).to_csv(birthdays_file, sep="\t", index=False)
+
+    # Only the hosts without messy timestamps have key dates: add-diet fails
+    # on timestamps it can't parse
+    phase_intervals = _make_phase_intervals(rng, host_ids[0::2])
+    return Study(
+        num_samples,
+        md,
+        metadata_file,
+        birthdays_file,
+        phase_intervals,
+        host_ids[0],
+        _make_key_dates(phase_intervals[host_ids[0]]),
+    )
+
+
+@pytest.fixture(
+    scope="session",
+    params=SAMPLE_COUNTS,
+    ids=["{}_samples".format(n) for n in SAMPLE_COUNTS],
+)
+def study(request, tmpdir_factory):
+    """A synthetic study, generated once per size for all of the benchmarks."""
+    return make_study(request.param, tmpdir_factory.mktemp("study"))
+
+
+def run_uncached(benchmark, func, *args, rounds=3):
+    """Benchmarks func(*args), clearing the timestamp parse cache each round.
+
+       Otherwise, every round after the first would just look up the same
+       timestamps in the cache.
+    """
+
+    def setup():
+        PARSE_CACHE.clear()
+        return args, {}
+
+    return benchmark.pedantic(func, setup=setup, rounds=rounds)
@@ -0,0 +1,67 @@
+# Benchmarks add-diet's assignment of phase values on synthetic metadata of
+# increasing size, comparing the current bulk column assignment against the
+# old approach of writing each sample's value with .loc.
+import numpy as np
+import pandas as pd
+import pytest
+from qeeseburger.key_dates import find_phase_intervals
+from qeeseburger.utils import lenient_parse
+from qeeseburger.add_dietary_phase import (
+    _add_dietary_phase,
+    _classify_sample_dates,
+)
+
+SAMPLE_COUNTS = [1000, 10000, 100000, 1000000]
+# Writing values one at a time with .loc takes minutes for a million samples,
+# so we only run the old approach on smaller inputs
+MAX_LOC_WRITES_SAMPLE_COUNT = 100000
+NUM_HOSTS = 4
+
+
+def get_data(num_samples):
+    rng = np.random.default_rng(0)
+    days = np.datetime64("2019-01-01") + rng.integers(0, 365, num_samples)
+    md = pd.DataFrame(
+        {
+            "host_subject_id": rng.integers(0, NUM_HOSTS, num_samples).astype(
+                str
+            ),
+            "collection_timestamp": days.astype(str),
+        },
+        index=["S{}".format(i) for i in range(num_samples)],
+    )
+    kd = pd.DataFrame(
+        {"Event": ["Started keto", "Stopped keto"] * 6},
+        index=pd.date_range("2019-01-15", periods=12, freq="25D"),
+    )
+    return md, kd
+
+
+def add_dietary_phase_with_loc_writes(md, host_subject_id, phase_name, kd):
+    """What _add_dietary_phase() did before switching to bulk assignment."""
+    m_df = md.copy()
+    starts, stops = find_phase_intervals(kd, phase_name)
+    m_df[phase_name] = "not applicable"
+    host_samples = m_df.loc[m_df["host_subject_id"] == host_subject_id]
+    codes, uniques = pd.factorize(host_samples["collection_timestamp"])
+    unique_dates = np.array(
+        [lenient_parse(timestamp) for timestamp in uniques], dtype="M8[D]",
+    )
+    phase_values = _classify_sample_dates(unique_dates[codes], starts, stops)
+    for sample_id, phase_value in zip(host_samples.index, phase_values):
+        m_df.loc[sample_id, phase_name] = phase_value
+    return m_df
+
+
+@pytest.mark.parametrize("num_samples", SAMPLE_COUNTS)
+@pytest.mark.parametrize("approach", ["bulk", "loc_writes"])
+def test_add_dietary_phase(benchmark, approach, num_samples):
+    if approach == "loc_writes" and num_samples > MAX_LOC_WRITES_SAMPLE_COUNT:
+        pytest.skip("Too slow")
+    md, kd = get_data(num_samples)
+    func = {
+        "bulk": _add_dietary_phase,
+        "loc_writes": add_dietary_phase_with_loc_writes,
+    }[approach]
+    benchmark.group = "add-diet: {} samples".format(num_samples)
+    benchmark.pedantic(func, args=(md, "0", "keto", kd), rounds=3)
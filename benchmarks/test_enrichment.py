@@ -0,0 +1,87 @@
+# Benchmarks each of the enrichment commands' hot paths (and metadata I/O)
+# separately, on synthetic studies of increasing size (see conftest.py).
+# To catch regressions, save a baseline with "make benchmark-save" and then
+# compare against it with "make benchmark-compare".
+import io
+from contextlib import redirect_stdout
+from conftest import run_uncached
+from qeeseburger.add_timeseries_cols import _add_extra_cols
+from qeeseburger.add_host_ages import _add_host_ages
+from qeeseburger.add_dietary_phase import (
+    _add_dietary_phase,
+    _add_dietary_phases,
+)
+from qeeseburger.utils import load_metadata, save_metadata, manipulate_md
+
+
+def quietly(func):
+    def run(*args):
+        with redirect_stdout(io.StringIO()):
+            return func(*args)
+
+    return run
+
+
+def test_add_extra_cols(benchmark, study):
+    benchmark.group = "add-ts-cols: {} samples".format(study.num_samples)
+    run_uncached(benchmark, quietly(_add_extra_cols), study.metadata_df)
+
+
+def test_add_host_ages(benchmark, study):
+    benchmark.group = "add-host-ages: {} samples".format(study.num_samples)
+    run_uncached(
+        benchmark,
+        quietly(_add_host_ages),
+        study.metadata_df,
+        None,
+        None,
+        False,
+        study.birthdays_file,
+    )
+
+
+def test_add_dietary_phase(benchmark, study):
+    benchmark.group = "add-diet: {} samples".format(study.num_samples)
+    run_uncached(
+        benchmark,
+        _add_dietary_phase,
+        study.metadata_df,
+        study.diet_host,
+        "keto",
+        study.diet_key_dates,
+    )
+
+
+def test_add_dietary_phases(benchmark, study):
+    benchmark.group = "add-diet-batch: {} samples".format(study.num_samples)
+    run_uncached(
+        benchmark,
+        _add_dietary_phases,
+        study.metadata_df,
+        study.phase_intervals,
+    )
+
+
+def test_load_metadata(benchmark, study):
+    benchmark.group = "metadata I/O: {} samples".format(study.num_samples)
+    benchmark.pedantic(load_metadata, args=(study.metadata_file,), rounds=3)
+
+
+def test_save_metadata(benchmark, study, tmpdir):
+    benchmark.group = "metadata I/O: {} samples".format(study.num_samples)
+    output_file = str(tmpdir.join("output.tsv"))
+    benchmark.pedantic(
+        save_metadata, args=(study.metadata_df, output_file), rounds=3
+    )
+
+
+def test_manipulate_md(benchmark, study, tmpdir):
+    # A transform that doesn't add anything, so this just measures the I/O
+    # that manipulate_md() does around each command's actual work
+    benchmark.group = "metadata I/O: {} samples".format(study.num_samples)
+    output_file = str(tmpdir.join("output.tsv"))
+    benchmark.pedantic(
+        manipulate_md,
+        args=(study.metadata_file, [], output_file, lambda m_df: {}),
+        rounds=3,
+    )
@@ -0,0 +1,29 @@
+# Benchmarks the cold-start time of each of Qeeseburger's commands (i.e. the
+# time it takes for a new Python process to run "COMMAND --help").
+import subprocess
+import sys
+import pytest
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        "add_columns",
+        "add_columns_batch",
+        "add_host_ages",
+        "add_dietary_phase",
+        "add_dietary_phases",
+        "run",
+    ],
+)
+def test_help_startup(benchmark, command):
+    code = "from qeeseburger.cli import {0}; {0}(['--help'])".format(command)
+
+    def run_help():
+        subprocess.run(
+            [sys.executable, "-c", code],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    benchmark.pedantic(run_help, rounds=10, warmup_rounds=1)
@@ -0,0 +1,96 @@
+# Benchmarks strict timestamp parsing on columns of mixed-format timestamps,
+# comparing strict_parse_series()'s format registry against parsing each
+# timestamp with arrow.get() (i.e. calling strict_parse() on each one) and
+# against trying each format in turn on all of the remaining timestamps.
+import numpy as np
+import pandas as pd
+import pytest
+from qeeseburger.utils import (
+    EXPECTED_TIMESTAMP_FORMATS,
+    strict_parse,
+    strict_parse_series,
+    _compile_date_format,
+    _ymd_to_dates,
+)
+
+TIMESTAMP_COUNTS = [1000, 10000, 100000]
+# arrow.get() takes about a minute for 100,000 timestamps
+MAX_ARROW_TIMESTAMP_COUNT = 10000
+# Templates for the timestamps in each column: one per default format (apart
+# from "YYYY-M-D", which "YYYY-MM-DD" already covers), plus some invalid ones
+TEMPLATES = [
+    "{y}-{m:02}-{d:02}",
+    "{y}-{m:02}-{d:02} {h:02}:{mi:02}",
+    "{y}-{m}-{d}",
+    "{m:02}/{d:02}/{y}",
+    "{m}/{d}/{y}",
+    "{m}/{d}/{yy:02}",
+    "'{y}-{m:02}-{d:02}",
+    "{y}-{m:02}-{d:02}:",
+    "{y}-{m:02}",
+    "not collected",
+]
+
+
+def get_timestamps(num_timestamps):
+    rng = np.random.default_rng(0)
+    years = rng.integers(1990, 2021, num_timestamps)
+    timestamps = []
+    for i, y in enumerate(years):
+        timestamps.append(
+            TEMPLATES[i % len(TEMPLATES)].format(
+                y=y,
+                yy=y % 100,
+                m=rng.integers(1, 13),
+                d=rng.integers(1, 29),
+                h=rng.integers(0, 24),
+                mi=rng.integers(0, 60),
+            )
+        )
+    return timestamps
+
+
+def parse_with_arrow(timestamps):
+    valid = []
+    for t in timestamps:
+        try:
+            strict_parse(t, cache=None)
+            valid.append(True)
+        except ValueError:
+            valid.append(False)
+    return np.array(valid)
+
+
+def parse_with_format_chain(timestamps):
+    """What strict_parse_series() did before using a format registry."""
+    uniques = pd.Series(pd.unique(pd.Series(timestamps, dtype=object)))
+    unique_valid = np.zeros(len(uniques), dtype=bool)
+    remaining = np.arange(len(uniques))
+    for fmt in EXPECTED_TIMESTAMP_FORMATS:
+        if len(remaining) == 0:
+            break
+        parts = uniques.iloc[remaining].str.extract(_compile_date_format(fmt))
+        matched = parts.iloc[:, 0].notna().to_numpy()
+        parts = parts.loc[matched]
+        ymd = [
+            parts[[t for t in tokens if t in parts.columns][0]].astype(int)
+            for tokens in (["YYYY", "YY"], ["MM", "M"], ["DD", "D"])
+        ]
+        unique_valid[remaining[matched]] = _ymd_to_dates(*ymd)[0]
+        remaining = remaining[~matched]
+    return unique_valid
+
+
+@pytest.mark.parametrize("num_timestamps", TIMESTAMP_COUNTS)
+@pytest.mark.parametrize("approach", ["registry", "format_chain", "arrow"])
+def test_strict_parse_mixed_formats(benchmark, approach, num_timestamps):
+    if approach == "arrow" and num_timestamps > MAX_ARROW_TIMESTAMP_COUNT:
+        pytest.skip("Too slow")
+    timestamps = get_timestamps(num_timestamps)
+    func = {
+        "registry": lambda t: strict_parse_series(t, cache=None, pool=None),
+        "format_chain": parse_with_format_chain,
+        "arrow": parse_with_arrow,
+    }[approach]
+    benchmark.group = "strict parsing: {} timestamps".format(num_timestamps)
+    benchmark.pedantic(func, args=(timestamps,), rounds=3)
@@ -1,242 +1,169 @@
-#! /usr/bin/env python3
-import click
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
-from dateutil.parser import parse
-from qiime2 import Metadata
-
-
-@click.command()
-@click.option(
-    "-hsid",
-    "--host-subject-id",
-    required=True,
-    help="Host subject ID to set dietary phase for.",
-    type=str,
-)
-@click.option(
-    "-p",
-    "--phase-name",
-    required=True,
-    help="Key word to look for in dietary phases. Any rows in the key dates "
-    "spreadsheet where the 'Event' column contains the text 'Started "
-    "PHASENAME' or 'Stopped PHASENAME', where PHASENAME is the string you "
-    "specify here, will be treated as start/end range(s) for that phase "
-    "(these ranges are assumed to be inclusive for the start date and "
-    "exclusive on the end date).",
-    type=str,
-)
-@click.option(
-    "-k",
-    "--key-dates-spreadsheet",
-    required=True,
-    help=(
-        "Filepath to an Excel spreadsheet containing dates as the first "
-        "column and 'Event' as the second column."
-    ),
-    type=str,
-)
-@click.option(
-    "-i",
-    "--input-metadata-file",
-    required=True,
-    help=(
-        "Input metadata filepath. Must contain collection_timestamp and "
-        "host_subject_id columns."
-    ),
-    type=str,
-)
-@click.option(
-    "-o",
-    "--output-metadata-file",
-    required=True,
-    help=(
-        "Output metadata filepath. Will contain a new column named with "
-        "whatever you set the -p option to."
-    ),
-    type=str,
-)
-def add_dietary_phase(
-    host_subject_id,
-    phase_name,
-    key_dates_spreadsheet,
-    input_metadata_file,
-    output_metadata_file,
-) -> None:
-    """Encodes dietary phase information into a sample metadata file.
-
-    The main information needed for this are the phase name (-p) and the key
-    dates spreadsheet (-k). This program looks for rows in the key dates
-    spreadsheet where the "Event" column contains the text "Started PHASENAME"
-    or "Stopped PHASENAME", where PHASENAME is just the string you specified in
-    the -p option.
-
-    This program will then use the dates associated with these rows to
-    determine ranges of dates for which the given dietary phase was being
-    followed -- this is useful if the subject went on and off a diet multiple
-    times. The start date of a phase is counted as being in that range; the end
-    date is NOT counted as being in that range.
-
-    Finally, this will add a PHASENAME column to the metadata file. Samples
-    will be assigned one of three possible values in this column:
-
-        Samples where host_subject_id is equal to the -hsid parameter AND the
-        collection_timestamp falls within a dietary phase range will be
-        labelled "TRUE".
-
-        Samples where host_subject_id is equal to the -hsid parameter AND the
-        collection_timestamp DOES NOT fall within a dietary phase range will
-        be labelled "FALSE".
-
-        Samples where host_subject_id is NOT EQUAL to the -hsid parameter
-        will be labelled "not applicable".
-
-    This only treats dates as down to the day. So if the subject started a diet
-    at 12pm on a day and then ended that diet at 5pm that same day, this code
-    will treat both of these dates as occurring on the same day and thus raise
-    an error.
+from .key_dates import find_phase_intervals
+from .utils import DIAGNOSTICS, TimestampColumn, attach_cols
+
+
+def _classify_sample_dates(sample_dates, starts, stops):
+    """Assigns a dietary phase value to each of an array of sample dates.
+
+       starts and stops should be the output of find_phase_intervals(). Since
+       the ranges are sorted and don't overlap, we can find the last range
+       starting on or before each date with a single binary search.
+
+       Returns an object array of strings: "TRUE" for dates within a range,
+       "FALSE BUT TAKEN AFTER DIET START" for dates outside of all ranges but
+       after the first range started, and "FALSE" for dates before the first
+       range started.
+    """
+    # If the sample was collected before any of the ranges, then
+    # range_indices will be -1. That's fine; in this case, the sample doesn't
+    # fall in any of the ranges, so we can safely leave its value as FALSE.
+    range_indices = np.searchsorted(starts, sample_dates, side="right") - 1
+    labels = np.full(len(sample_dates), "FALSE", dtype=object)
+
+    after_start = range_indices >= 0
+    in_range = np.zeros(len(sample_dates), dtype=bool)
+    in_range[after_start] = (
+        sample_dates[after_start] < stops[range_indices[after_start]]
+    )
+    # If a sample occurred after the last range starting before it, we can
+    # conclusively say that this sample is not present in any ranges.
+    #
+    # ...However, the fact that this sample was collected *after* the diet
+    # was started for the first time could be interesting, esp. if the
+    # effects of the diet were residual. So we assign a special value for
+    # these samples; depending on how you want to interpret this data, this
+    # can be handled in a few different ways. (For stuff like plotting sample
+    # ordinations, making this distinction clear is useful.)
+    labels[after_start] = "FALSE BUT TAKEN AFTER DIET START"
+    labels[in_range] = "TRUE"
+    return labels
+
+
+def _add_dietary_phase(metadata_df, host_subject_id, phase_name, key_dates_df):
+    """Returns a DataFrame with a dietary phase column added on.
+
+       The new column will be named phase_name. See the documentation of the
+       add-diet command for details on how this column's values are assigned.
     """
 
-    m = Metadata.load(input_metadata_file)
-    m_df = m.to_dataframe()
+    phase_intervals = OrderedDict()
+    phase_intervals[host_subject_id] = OrderedDict(
+        [(phase_name, find_phase_intervals(key_dates_df, phase_name))]
+    )
+    return _add_dietary_phases(metadata_df, phase_intervals)
+
+
+def _get_dietary_phase_cols(metadata_df, phase_intervals, timestamps=None):
+    """Computes (potentially many) dietary phase columns for a DataFrame.
+
+       Returns an OrderedDict mapping phase names to the values of their
+       columns; metadata_df itself isn't modified or copied.
+
+       phase_intervals should map host subject IDs to dicts mapping phase
+       names to (starts, stops) tuples -- see key_dates.load_phase_intervals().
+       A column is computed for every phase given for any host. Each phase's
+       column is computed in the same way as in _add_dietary_phase(), but for
+       all of these hosts at once: samples from hosts that aren't in
+       phase_intervals (or that don't have intervals for a given phase) get
+       "not applicable" values.
+
+       Each sample's timestamp is only parsed once, regardless of how many
+       phase columns are added. If timestamps (a utils.TimestampColumn of
+       metadata_df's collection_timestamp column) is given, it'll be used to
+       parse the timestamps; this lets multiple transformations share parsed
+       dates.
+    """
 
     # Validate the input metadata file, somewhat
     required_cols = {"host_subject_id", "collection_timestamp"}
-    if len(required_cols & set(m_df.columns)) < len(required_cols):
+    if len(required_cols & set(metadata_df.columns)) < len(required_cols):
         raise ValueError(
             "Input metadata file must include the following columns: "
             "{}".format(required_cols)
         )
-    if phase_name in m_df.columns:
-        raise ValueError(
-            "A {} column already exists in the input metadata!".format(
-                phase_name
-            )
-        )
 
-    # Validate the key dates spreadsheet, somewhat
-    kd = pd.read_excel(key_dates_spreadsheet, index_col=0)
-    # I didn't actually know this functionality existed until I saw this SO
-    # answer: https://stackoverflow.com/a/57187654/10730311
-    if not pd.api.types.is_datetime64_any_dtype(kd.index):
-        raise ValueError(
-            "First column of the key dates spreadsheet must contain "
-            "dates/timestamps"
-        )
-    if "Event" not in kd.columns:
-        raise ValueError(
-            'Key dates spreadsheet must contain an "Event" column'
-        )
+    host_ids = list(phase_intervals.keys())
+    all_phase_names = []
+    for host_id in host_ids:
+        for phase_name in phase_intervals[host_id]:
+            if phase_name not in all_phase_names:
+                all_phase_names.append(phase_name)
+    for phase_name in all_phase_names:
+        if phase_name in metadata_df.columns:
+            raise ValueError(
+                "A {} column already exists in the input metadata!".format(
+                    phase_name
+                )
+            )
 
-    # Determine ranges for starting/stopping a given diet (this requires a
-    # decent amount of validation)
-    starting_dates = kd.loc[
-        kd["Event"].str.find("Started {}".format(phase_name)) >= 0
-    ]
-    if len(starting_dates.index) < 1:
-        raise ValueError("No starting dates for the specified phase given")
-
-    stopping_dates = kd.loc[
-        kd["Event"].str.find("Stopped {}".format(phase_name)) >= 0
-    ]
-    if len(stopping_dates.index) < 1:
-        raise ValueError("No stopping dates for the specified phase given")
-
-    if len(starting_dates.index) != len(stopping_dates.index):
-        raise ValueError(
-            "Number of starting/stopping dates must be consistent (if the "
-            "phase continues to the final sample, then you'll need to add a "
-            "stoppping row for the day of or after that sample)"
-        )
-    print(
-        'Found {} ranges for the "{}" dietary phase.'.format(
-            len(starting_dates.index), phase_name
-        )
+    # Parse the timestamps of these hosts' samples (each unique timestamp
+    # only needs to be parsed once)
+    host_indices = pd.Index(host_ids).get_indexer(
+        metadata_df["host_subject_id"]
+    )
+    relevant = host_indices >= 0
+    if timestamps is None:
+        timestamps = TimestampColumn(metadata_df["collection_timestamp"])
+    sample_dates = np.full(
+        len(metadata_df.index), np.datetime64("NaT"), "M8[D]"
+    )
+    sample_dates[relevant] = timestamps.lenient_parse(relevant)
+    # Group the relevant samples' indices by host. (Sorting once scales a lot
+    # better to lots of hosts than finding each host's samples separately.)
+    # Irrelevant samples (with a host index of -1) are sorted to the start.
+    num_irrelevant = len(relevant) - relevant.sum()
+    order = np.argsort(host_indices, kind="stable")[num_irrelevant:]
+    host_counts = np.bincount(host_indices[relevant], minlength=len(host_ids))
+    host_sample_indices = np.split(order, np.cumsum(host_counts)[:-1])
+    DIAGNOSTICS.record(
+        "key dates host not in metadata",
+        np.array(host_ids, dtype=object)[host_counts == 0],
+        "Host has key dates, but no samples in the metadata.",
     )
 
-    # We now know that we have an equal (and >= 1) number of starting and
-    # stopping dates, but we'd like to know if the dates actually make sense.
-    #
-    # This necessitates checking that every stopping date occurs later than its
-    # corresponding starting date, *and* ensuring that every starting date
-    # occurs later than the previous stopping date (i.e. the ranges are in
-    # chronological order)
-    #
-    # You can think of this graphically as something like:
-    #
-    # A1---B1 A2--B2     A3B3 A4-----B4  A5-B5 A6--B6
-    #
-    # where each A is a starting date and each B is a stopping date. Notice how
-    # these ranges are not overlapping, so they can just be represented as a
-    # single line -- this is what we're checking for here.
-    for i in range(len(starting_dates.index)):
-        # NOTE: we use .date() to just get the date, not the timestamp, of
-        # datetimes. This lets us do comparisons only down to the day level.
-        # Thanks to https://stackoverflow.com/a/13227661/10730311.
-        da = starting_dates.iloc[i].name.date()
-        db = stopping_dates.iloc[i].name.date()
-        if da >= db:
-            raise ValueError(
-                "Starting date {} occurs later or on same day as "
-                "corresponding stopping date {}.".format(da, db)
-            )
-        if i > 0:
-            prev_db = stopping_dates.iloc[i - 1].name.date()
-            if da <= prev_db:
-                raise ValueError(
-                    "Starting date {} occurs earlier or on same day as "
-                    "previous stopping date {}.".format(da, prev_db)
+    new_cols = OrderedDict()
+    missed_hosts = []
+    missed_phases = []
+    for phase_name in all_phase_names:
+        # For samples where the host subject ID *does not* match one of the
+        # specified hosts, the phase_name value will be left as
+        # "not applicable"
+        phase_values = np.full(
+            len(metadata_df.index), "not applicable", dtype=object
+        )
+        for host_id, indices in zip(host_ids, host_sample_indices):
+            if phase_name in phase_intervals[host_id]:
+                host_values = _classify_sample_dates(
+                    sample_dates[indices],
+                    *phase_intervals[host_id][phase_name]
                 )
-
-    # OK, now we know the ranges are good! We're done validating the inputs at
-    # this point.
-
-    m_df[phase_name] = "not applicable"
-
-    for sample_id in m_df.index:
-        if m_df.loc[sample_id, "host_subject_id"] == host_subject_id:
-            # Parse sample timestamp
-            sample_date = parse(m_df["collection_timestamp"][sample_id]).date()
-
-            # If the sample was collected before any of the ranges, then we'll
-            # never get into the first "if" statement in the for loop below.
-            # That's fine; in this case, the sample doesn't fall in any of the
-            # ranges, so we can safely leave its value as FALSE.
-            phase_value = "FALSE"
-
-            # Iterate backwards through ranges
-            for ii in range(len(starting_dates.index))[::-1]:
-                if sample_date >= starting_dates.iloc[ii].name.date():
-                    if sample_date < stopping_dates.iloc[ii].name.date():
-                        phase_value = "TRUE"
-                        break
-                    else:
-                        # We know that this sample occurred after the current
-                        # range. Furthermore, we're looking at the ranges in
-                        # descending order, so we know that the sample wasn't
-                        # in any ranges after this one. Therefore, we can
-                        # conclusively say that this sample is not present in
-                        # any ranges.
-                        #
-                        # ...However, the fact that this sample was collected
-                        # *after* the diet was started for the first time could
-                        # be interesting, esp. if the effects of the diet were
-                        # residual. So we assign a special value for these
-                        # samples; depending on how you want to interpret this
-                        # data, this can be handled in a few different ways.
-                        # (For stuff like plotting sample ordinations, making
-                        # this distinction clear is useful.)
-                        phase_value = "FALSE BUT TAKEN AFTER DIET START"
-                        break
-
-            m_df.loc[sample_id, phase_name] = phase_value
-
-        # For samples where the host subject ID *does not* match the one
-        # specified, the phase_name value will be left as "not applicable"
+                phase_values[indices] = host_values
+                # If none of a host's samples are in a phase, its key dates
+                # might have a typo in them
+                if len(indices) > 0 and not (host_values == "TRUE").any():
+                    missed_hosts.append(host_id)
+                    missed_phases.append(phase_name)
+        new_cols[phase_name] = phase_values
+    DIAGNOSTICS.record(
+        "no samples within a phase",
+        missed_hosts,
+        'None of the host\'s samples are within a "{}" range.',
+        missed_phases,
+    )
 
     # Cool, we're done!
+    return new_cols
 
-    Metadata(m_df).save(output_metadata_file)
 
+def _add_dietary_phases(metadata_df, phase_intervals, timestamps=None):
+    """Returns a DataFrame with (potentially many) dietary phase columns added.
 
-if __name__ == "__main__":
-    add_dietary_phase()
+       See _get_dietary_phase_cols() for details. metadata_df isn't modified.
+    """
+    return attach_cols(
+        metadata_df.copy(deep=False),
+        _get_dietary_phase_cols(metadata_df, phase_intervals, timestamps),
+    )
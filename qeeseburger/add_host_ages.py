@@ -1,20 +1,187 @@
-#! /usr/bin/env python3
-import click
-from dateutil.relativedelta import relativedelta
-from arrow import ParserError
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
 from .utils import (
-    strict_parse,
+    DIAGNOSTICS,
+    strict_parse_series,
+    read_table,
+    TimestampColumn,
+    attach_cols,
+    find_reusable_rows,
+    combine_cols,
     check_cols_present,
     check_cols_not_present,
-    manipulate_md,
 )
 
 
 APPROXIMATE_YEAR_LENGTH_IN_DAYS = 365.2422
+BIRTHDAYS_FILE_COLS = ["host_subject_id", "birthday"]
 
 
-def _add_host_ages(metadata_df, host_ids, host_birthdays, float_years=False):
-    """Returns a DataFrame with a "host age" column added on.
+def _split_dates(dates):
+    """Splits a datetime64[D] array into arrays of years, months, and days."""
+    month_starts = dates.astype("M8[M]")
+    years = dates.astype("M8[Y]").astype(np.int64) + 1970
+    months = month_starts.astype(np.int64) % 12 + 1
+    days = (dates - month_starts.astype("M8[D]")).astype(np.int64) + 1
+    return years, months, days
+
+
+def _get_whole_years(sample_dates, bday_dates):
+    """Computes the number of whole years between birthdays and sample dates.
+
+       This matches relativedelta(sample_date, bday_date).years for each
+       pair of dates (assuming that each sample date occurs on or after its
+       birthday), but works on entire arrays of datetime64[D] dates at once.
+
+       A host's "anniversary" in a given year is its birthday moved to that
+       year; for birthdays on February 29th, this is clipped to February 28th
+       in non-leap years (which is what relativedelta does).
+    """
+    sample_years = _split_dates(sample_dates)[0]
+    bday_years, bday_months, bday_days = _split_dates(bday_dates)
+
+    months_since_epoch = (sample_years - 1970) * 12 + (bday_months - 1)
+    month_starts = months_since_epoch.astype("M8[M]").astype("M8[D]")
+    month_lengths = (
+        (months_since_epoch + 1).astype("M8[M]").astype("M8[D]") - month_starts
+    ).astype(np.int64)
+    anniversaries = month_starts + (
+        np.minimum(bday_days, month_lengths) - 1
+    ).astype("m8[D]")
+
+    return sample_years - bday_years - (sample_dates < anniversaries)
+
+
+def _format_float_years(days):
+    return "{:.4f}".format(days / APPROXIMATE_YEAR_LENGTH_IN_DAYS)
+
+
+def _factorize_formatted(values, formatter):
+    """Formats an array of values, calling formatter once per unique value.
+
+       Returns (codes, formatted): formatted is a list of the formatted
+       unique values, and codes gives the position in formatted of each
+       value.
+    """
+    unique_values, inverse = np.unique(values, return_inverse=True)
+    return inverse.reshape(-1), [formatter(v) for v in unique_values]
+
+
+def _parse_birthday_lists(host_ids, host_birthdays):
+    """Converts comma-separated lists of host IDs and birthdays to a table.
+
+       Returns a pd.Series of datetime64[D] birthdays, indexed by host ID.
+    """
+    host_id_list = [i.strip() for i in host_ids.split(",")]
+    host_bday_list = [i.strip() for i in host_birthdays.split(",")]
+
+    for t in (host_id_list, host_bday_list):
+        if len(t) == 0 or (len(t) == 1 and t[0] == ""):
+            raise ValueError("No host IDs and/or birthdays were specified.")
+
+    if len(host_id_list) != len(host_bday_list):
+        raise ValueError(
+            "Number of host IDs doesn't match number of birthdays."
+        )
+
+    if len(set(host_id_list)) != len(host_id_list):
+        raise ValueError("The specified host IDs aren't unique?")
+
+    host_bday_valid, host_bday_dates = strict_parse_series(host_bday_list)
+    if not host_bday_valid.all():
+        raise ValueError("(Some of) the birthdays aren't correctly formatted.")
+
+    return pd.Series(host_bday_dates, index=pd.Index(host_id_list))
+
+
+def _describe_lines(line_numbers, max_shown=5):
+    shown = ", ".join(str(n) for n in line_numbers[:max_shown])
+    if len(line_numbers) > max_shown:
+        shown += " (and {} more)".format(len(line_numbers) - max_shown)
+    return shown
+
+
+def _load_birthdays_file(birthdays_file):
+    """Loads a table of host birthdays from a CSV or TSV file.
+
+       The file should have a header line containing (at least) the columns
+       host_subject_id and birthday. It can be compressed (e.g. .tsv.gz).
+
+       All of the rows are validated at once; if there are any problems, the
+       error message will list the offending line number(s) of the file.
+
+       Returns a pd.Series of datetime64[D] birthdays, indexed by host ID.
+    """
+    bday_df = read_table(birthdays_file)
+    check_cols_present(bday_df, set(BIRTHDAYS_FILE_COLS))
+    if len(bday_df.index) == 0:
+        raise ValueError("No host IDs and/or birthdays were specified.")
+
+    host_ids = bday_df["host_subject_id"].to_numpy()
+    line_numbers = bday_df.index.to_numpy()
+
+    missing_id = host_ids == ""
+    if missing_id.any():
+        raise ValueError(
+            "Some rows in the birthdays file don't have a host ID: see "
+            "line(s) {}.".format(_describe_lines(line_numbers[missing_id]))
+        )
+
+    duplicated = bday_df["host_subject_id"].duplicated(keep=False).to_numpy()
+    if duplicated.any():
+        dup_id = host_ids[duplicated][0]
+        raise ValueError(
+            "The host IDs in the birthdays file aren't unique: {} is on "
+            "lines {}.".format(
+                dup_id, _describe_lines(line_numbers[host_ids == dup_id])
+            )
+        )
+
+    host_bday_valid, host_bday_dates = strict_parse_series(
+        bday_df["birthday"].to_numpy()
+    )
+    if not host_bday_valid.all():
+        first_bad = np.flatnonzero(~host_bday_valid)[0]
+        raise ValueError(
+            "(Some of) the birthdays aren't correctly formatted: see line(s) "
+            '{} (e.g. "{}" for host {}).'.format(
+                _describe_lines(line_numbers[~host_bday_valid]),
+                bday_df["birthday"].iloc[first_bad],
+                host_ids[first_bad],
+            )
+        )
+
+    return pd.Series(host_bday_dates, index=pd.Index(host_ids))
+
+
+def _get_birthdays(host_ids, host_birthdays, birthdays_file):
+    """Loads the host birthdays given to add-host-ages.
+
+       Returns a pd.Series of datetime64[D] birthdays, indexed by host ID.
+    """
+    if birthdays_file is not None:
+        if host_ids or host_birthdays:
+            raise ValueError(
+                "Specify hosts either as lists of IDs and birthdays or as a "
+                "birthdays file, not both."
+            )
+        return _load_birthdays_file(birthdays_file)
+    return _parse_birthday_lists(host_ids or "", host_birthdays or "")
+
+
+def _get_host_age_cols(
+    metadata_df,
+    host_ids,
+    host_birthdays,
+    float_years=False,
+    birthdays_file=None,
+    timestamps=None,
+):
+    """Computes a "host age" column for a metadata DataFrame.
+
+       Returns an OrderedDict mapping the new column's name to its values;
+       metadata_df itself isn't modified or copied.
 
        If float_years is False, the new column will be named
        "host_age_years", and will contain just the host age down to the year.
@@ -29,7 +196,16 @@ def _add_host_ages(metadata_df, host_ids, host_birthdays, float_years=False):
        use the days_since_first_day column that add-ts-cols gives you.)
 
        IN EITHER CASE, the values will be represented in the DataFrame as
-       strings.
+       strings (stored as a pd.Categorical, so that each distinct age is only
+       stored once).
+
+       Hosts and their birthdays can be specified either as comma-separated
+       lists (host_ids and host_birthdays), or as a CSV/TSV file
+       (birthdays_file; see _load_birthdays_file()) -- but not both.
+
+       If timestamps (a utils.TimestampColumn of metadata_df's
+       collection_timestamp column) is given, it'll be used to parse the
+       timestamps; this lets multiple transformations share parsed dates.
 
        As an example: if a host's birthday is on December 1, 1990 and
        there's a sample from November 20, 1995 from that host:
@@ -37,148 +213,179 @@ def _add_host_ages(metadata_df, host_ids, host_birthdays, float_years=False):
         - that sample's "host_age" value will be 4.9693
     """
 
-    m_df = metadata_df.copy()
-
     if float_years:
         output_col_name = "host_age"
     else:
         output_col_name = "host_age_years"
 
     # Validate input a bit
-    check_cols_present(m_df, {"collection_timestamp", "host_subject_id"})
-    check_cols_not_present(m_df, {output_col_name})
+    check_cols_present(
+        metadata_df, {"collection_timestamp", "host_subject_id"}
+    )
+    check_cols_not_present(metadata_df, {output_col_name})
 
-    host_id_list = [i.strip() for i in host_ids.split(",")]
-    host_bday_list = [i.strip() for i in host_birthdays.split(",")]
+    birthdays = _get_birthdays(host_ids, host_birthdays, birthdays_file)
+    return _compute_host_age_cols(
+        metadata_df, birthdays, output_col_name, float_years, timestamps
+    )
 
-    for t in (host_id_list, host_bday_list):
-        if len(t) == 0 or (len(t) == 1 and t[0] == ""):
-            raise ValueError("No host IDs and/or birthdays were specified.")
 
-    if len(host_id_list) != len(host_bday_list):
-        raise ValueError(
-            "Number of host IDs doesn't match number of birthdays."
-        )
+def _compute_host_age_cols(
+    metadata_df, birthdays, output_col_name, float_years, timestamps=None
+):
+    """Does the work of _get_host_age_cols(), given the hosts' birthdays."""
 
-    if len(set(host_id_list)) != len(host_id_list):
-        raise ValueError("The specified host IDs aren't unique?")
+    # Figure out which birthday (if any) corresponds to each sample's host.
+    # This is a hash join against the host IDs, so it scales fine to lots of
+    # hosts.
+    host_indices = birthdays.index.get_indexer(metadata_df["host_subject_id"])
+    relevant = host_indices >= 0
 
-    try:
-        host_bday_date_list = [strict_parse(s) for s in host_bday_list]
-    except ParserError:
-        raise ValueError("(Some of) the birthdays aren't correctly formatted.")
+    # Ages are stored as a categorical: code 0 is "not applicable", code 1 is
+    # "impossible", and the actual ages come after these
+    codes = np.zeros(len(metadata_df.index), dtype=np.int64)
+    age_strs = []
+    if relevant.any():
+        # Only bother parsing the timestamps of samples from hosts we care
+        # about. Samples with invalid timestamps stay "not applicable".
+        if timestamps is None:
+            timestamps = TimestampColumn(metadata_df["collection_timestamp"])
+        sample_valid, sample_dates = timestamps.strict_parse(relevant)
+        bday_dates = birthdays.to_numpy(dtype="M8[D]")[host_indices[relevant]]
 
-    # figure out what host has what birthday
-    # precomputing this dict should save some time
-    hostid2bdaydate = {}
-    for i in range(len(host_id_list)):
-        hostid2bdaydate[host_id_list[i]] = host_bday_date_list[i]
-
-    def get_host_age_if_poss(row):
-        sample_hostid = row["host_subject_id"]
-        # Is this sample from a host we care about?
-        if sample_hostid in host_id_list:
-            # Try to parse sample date
-            try:
-                sample_date = strict_parse(str(row["collection_timestamp"]))
-            except ParserError:
-                # can't get the age for this sample -- timestamp is invalid
-                return "not applicable"
-            # Check that the date actually occurs after/on the sample's host's
-            # birthday...
-            host_bday_date = hostid2bdaydate[sample_hostid]
-            if sample_date >= host_bday_date:
-                # Success! Return the age in (integer or float) years expressed
-                # as a string
-                if float_years:
-                    return "{:.4f}".format(
-                        (sample_date - host_bday_date).days
-                        / APPROXIMATE_YEAR_LENGTH_IN_DAYS
-                    )
-                else:
-                    return str(
-                        relativedelta(sample_date, host_bday_date).years
-                    )
-            else:
-                print(
-                    "Sample {} has a timestamp date, {}, occurring before the "
-                    "host birthday date of {}.".format(
-                        row.name, sample_date, host_bday_date
-                    )
-                )
-                return "impossible"
+        # Check that each date actually occurs after/on the sample's host's
+        # birthday...
+        impossible = sample_valid & (sample_dates < bday_dates)
+        possible = sample_valid & ~impossible
+        DIAGNOSTICS.record(
+            "invalid collection_timestamp for host age",
+            metadata_df.index[relevant][~sample_valid],
+            "Timestamp {!r} couldn't be parsed.",
+            metadata_df["collection_timestamp"].to_numpy()[relevant][
+                ~sample_valid
+            ],
+        )
+        DIAGNOSTICS.record(
+            "impossible host age",
+            metadata_df.index[relevant][impossible],
+            "Timestamp date, {}, occurs before the host birthday date of {}.",
+            sample_dates[impossible].astype(object),
+            bday_dates[impossible].astype(object),
+        )
+
+        # Success! Compute the age in (integer or float) years, expressed as a
+        # string
+        if float_years:
+            age_values = (
+                sample_dates[possible] - bday_dates[possible]
+            ).astype(np.int64)
+            formatter = _format_float_years
         else:
-            return "not applicable"
-
-    m_df[output_col_name] = m_df.apply(get_host_age_if_poss, axis=1)
-    return m_df
-
-
-@click.command()
-@click.option(
-    "-i",
-    "--input-metadata-file",
-    required=True,
-    help=(
-        "Input metadata filepath. Must contain collection_timestamp and "
-        "host_subject_id columns."
-    ),
-    type=str,
-)
-@click.option(
-    "-h",
-    "--host-id-list",
-    required=True,
-    help="List of host subject IDs, separated by commas.",
-    type=str,
-)
-@click.option(
-    "-b",
-    "--host-birthday-list",
-    required=True,
-    help=(
-        "List of host birthdays, separated by commas. Each birthday should be "
-        "in YYYY-MM-DD format, and the number of birthdays should match the "
-        "number of host IDs specified."
-    ),
-    type=str,
-)
-@click.option(
-    "--float-years",
-    is_flag=True,
-    help=(
-        "If this flag is used, the host ages will be in float approximations "
-        "(using day-level precision) instead of integers down to the year."
-    ),
-    type=str,
-)
-@click.option(
-    "-o",
-    "--output-metadata-file",
-    required=True,
-    help="Output metadata filepath. Will contain a host_age_years column.",
-    type=str,
-)
-def add_host_ages(
-    input_metadata_file,
-    host_id_list,
-    host_birthday_list,
-    float_years,
-    output_metadata_file,
-) -> None:
-    """Add host age in years on to a metadata file.
-
-       The column added will be named "host_age_years" if --float-years isn't
-       set, and "host_age" if --float-years *is* set.
+            age_values = _get_whole_years(
+                sample_dates[possible], bday_dates[possible]
+            )
+            formatter = str
+        age_codes, age_strs = _factorize_formatted(age_values, formatter)
+        relevant_codes = np.ones(relevant.sum(), dtype=np.int64)
+        relevant_codes[~sample_valid] = 0
+        relevant_codes[possible] = age_codes + 2
+        codes[relevant] = relevant_codes
+
+    ages = pd.Categorical.from_codes(
+        codes, ["not applicable", "impossible"] + age_strs
+    )
+    return OrderedDict([(output_col_name, ages)])
+
+
+def _add_host_ages(
+    metadata_df,
+    host_ids,
+    host_birthdays,
+    float_years=False,
+    birthdays_file=None,
+    timestamps=None,
+):
+    """Returns a DataFrame with a "host age" column added on.
+
+       See _get_host_age_cols() for details. metadata_df isn't modified.
     """
+    return attach_cols(
+        metadata_df.copy(deep=False),
+        _get_host_age_cols(
+            metadata_df,
+            host_ids,
+            host_birthdays,
+            float_years,
+            birthdays_file,
+            timestamps,
+        ),
+    )
+
+
+def _get_incremental_host_age_cols(
+    metadata_df,
+    previous_df,
+    host_ids,
+    host_birthdays,
+    float_years=False,
+    birthdays_file=None,
+):
+    """Computes a "host age" column, reusing a previous output's values.
+
+       previous_df should be a metadata DataFrame previously output by
+       add-host-ages (with the same float_years setting). Samples with the
+       same ID, host_subject_id, and collection_timestamp in metadata_df and
+       previous_df reuse their values from previous_df; ages are only
+       computed for the other (new or changed) samples.
 
-    manipulate_md(
-        input_metadata_file,
-        [host_id_list, host_birthday_list, float_years],
-        output_metadata_file,
-        _add_host_ages,
+       This assumes that the host birthdays haven't changed since previous_df
+       was created. Otherwise, this works the same as _get_host_age_cols().
+    """
+    if float_years:
+        output_col_name = "host_age"
+    else:
+        output_col_name = "host_age_years"
+    check_cols_present(
+        metadata_df, {"collection_timestamp", "host_subject_id"}
     )
+    check_cols_not_present(metadata_df, {output_col_name})
 
+    reusable, previous_rows = find_reusable_rows(
+        metadata_df,
+        previous_df,
+        [output_col_name],
+        ["host_subject_id", "collection_timestamp"],
+    )
+    print(
+        "Reusing previous values for {} of {} sample(s).".format(
+            reusable.sum(), len(reusable)
+        )
+    )
+    birthdays = _get_birthdays(host_ids, host_birthdays, birthdays_file)
+    reused_ages = (
+        previous_df[output_col_name].to_numpy()[previous_rows].astype(str)
+    )
+
+    # The anomalies of the reused samples still need to be recorded, so we
+    # recompute the ages of the reused samples that might have anomalies
+    # (this is usually just a few samples): ones whose ages are "impossible",
+    # and ones from hosts with birthdays whose ages are "not applicable"
+    # (since their timestamps are invalid)
+    reused_hosts = metadata_df["host_subject_id"].to_numpy()[reusable]
+    anomalous = (reused_ages == "impossible") | (
+        (reused_ages == "not applicable")
+        & (birthdays.index.get_indexer(reused_hosts) >= 0)
+    )
+    reusable[reusable] = ~anomalous
 
-if __name__ == "__main__":
-    add_host_ages()
+    # Only pass on the columns we need, so we don't copy the entire
+    # DataFrame
+    stale_df = metadata_df.loc[
+        ~reusable, ["host_subject_id", "collection_timestamp"]
+    ]
+    new_cols = _compute_host_age_cols(
+        stale_df, birthdays, output_col_name, float_years
+    )
+    return combine_cols(
+        reusable, new_cols, {output_col_name: reused_ages[~anomalous]}
+    )
@@ -1,125 +1,442 @@
-#! /usr/bin/env python3
-import click
-from arrow import ParserError
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import numpy as np
+import pandas as pd
 from .utils import (
-    strict_parse,
+    DIAGNOSTICS,
+    Diagnostics,
+    FORMAT_REGISTRY,
+    PARSE_CACHE,
+    PARSE_POOL,
+    PROFILER,
+    strict_parse_series,
     check_cols_present,
     check_cols_not_present,
     manipulate_md,
+    attach_cols,
+    find_reusable_rows,
+    combine_cols,
+    read_md_header,
+    get_md_directives,
+    iter_md_chunks,
+    write_md_header,
+    write_md_rows,
 )
 
 
-def _add_extra_cols(metadata_df):
-    """Returns a DataFrame modified as expected."""
+TS_COLS = [
+    "is_collection_timestamp_valid",
+    "ordinal_timestamp",
+    "days_since_first_day",
+]
 
-    m_df = metadata_df.copy()
-    check_cols_present(m_df, {"collection_timestamp"})
-    check_cols_not_present(
-        m_df,
-        {
-            "ordinal_timestamp",
-            "days_since_first_day",
-            "is_collection_timestamp_valid",
-        },
+
+def _get_min_date(valid, dates):
+    if not valid.any():
+        raise ValueError("None of the collection_timestamp values are valid.")
+    return dates[valid].min()
+
+
+def _derive_ts_cols(valid, dates, min_date):
+    """Computes the values of the columns added by add-ts-cols.
+
+       Parameters
+       ----------
+
+       valid: np.ndarray of bool
+            Whether or not each sample's timestamp is valid.
+
+       dates: np.ndarray of datetime64[D]
+            The date of each sample's timestamp (ignored for invalid ones).
+
+       min_date: np.datetime64
+            The "first day" to compute days_since_first_day relative to.
+
+       Returns
+       -------
+
+       list of (str, pd.Categorical)
+            The name and values of each of the three new columns, in the order
+            is_collection_timestamp_valid, ordinal_timestamp,
+            days_since_first_day. The values are categoricals of strings.
+
+       Notes
+       -----
+
+       All three columns come from a single pass over the (valid) dates: we
+       convert each date to an offset from min_date, and then find the unique
+       offsets. Strings are only created once per unique date, and each
+       column is stored as a categorical -- an array of small integer codes
+       pointing into these strings. This is a lot faster, and uses a lot less
+       memory, than creating a string for every sample's date (most time
+       series studies have lots of samples that share the same date). The
+       strings are only written out for each sample when the metadata is
+       saved.
+    """
+    # Code 0 is "not applicable" (used for samples with invalid timestamps)
+    codes = np.zeros(len(valid), dtype=np.int64)
+    unique_ordinals = []
+    unique_days_since = []
+
+    if valid.any():
+        # Assign "days from first timestamp" metric for each sample (the
+        # sample(s) taken on min_date should have a value of 0, and samples
+        # taken on the next day day later would have a value of 1, ...)
+        # There is some inherent imprecision here due to different levels of
+        # precision in sample collection (e.g. down to the day vs. down to the
+        # minute), but this should be sufficient for exploratory visualization.
+        offsets = (dates[valid] - min_date).astype(np.int64)
+        unique_offsets, inverse = np.unique(offsets, return_inverse=True)
+
+        unique_dates = min_date + unique_offsets.astype("m8[D]")
+        unique_ordinals = [
+            d.replace("-", "") for d in np.datetime_as_string(unique_dates)
+        ]
+        unique_days_since = [str(o) for o in unique_offsets]
+        codes[valid] = inverse.reshape(-1) + 1
+
+    is_valid = pd.Categorical.from_codes(
+        valid.astype(np.int8), ["False", "True"]
+    )
+    ordinal_timestamps = pd.Categorical.from_codes(
+        codes, ["not applicable"] + unique_ordinals
+    )
+    days_since = pd.Categorical.from_codes(
+        codes, ["not applicable"] + unique_days_since
+    )
+
+    return list(zip(TS_COLS, [is_valid, ordinal_timestamps, days_since]))
+
+
+def _record_invalid_timestamps(sample_ids, timestamps, valid):
+    DIAGNOSTICS.record(
+        "invalid collection_timestamp",
+        sample_ids[~valid],
+        "Timestamp {!r} couldn't be parsed.",
+        np.asarray(timestamps)[~valid],
     )
 
-    # only call strict_parse() on sample timestamps once
-    sampleid2date = {}
-
-    def get_time_validity_and_parse_date(row):
-        try:
-            # we convert the timestamp to a string just in case it's something
-            # funky like a float
-            # (non-str timestamps could ostensibly be valid, for example if
-            # they're all formatted like 20200109. that being said, doing this
-            # conversion here makes me feel dirty so if you're reading this i
-            # still recommend that timestamps be specified as strings from the
-            # get-go.)
-            date = strict_parse(str(row["collection_timestamp"]))
-            sampleid2date[row.name] = date
-            # If strict_parse() didn't fail, the timestamp should be valid
-            return "True"
-        except ParserError:
-            return "False"
-
-    # 1. Add on is_collection_timestamp_valid column
-    # Use of apply() over a basic loop based on
-    # https://engineering.upside.com/a-beginners-guide-to-optimizing-pandas-code-for-speed-c09ef2c6a4d6
-    m_df["is_collection_timestamp_valid"] = m_df.apply(
-        get_time_validity_and_parse_date, axis=1
+
+def _get_extra_cols(metadata_df, min_date=None, timestamps=None):
+    """Computes the columns added by add-ts-cols.
+
+       Returns an OrderedDict mapping the new columns' names to their values
+       (see _derive_ts_cols()); metadata_df itself isn't modified or copied.
+
+       If min_date (a np.datetime64) is given, days_since_first_day will be
+       computed relative to it rather than to the earliest date in
+       metadata_df. This makes it possible to process a metadata file one
+       chunk at a time.
+
+       If timestamps (a utils.TimestampColumn of metadata_df's
+       collection_timestamp column) is given, it'll be used to parse the
+       timestamps; this lets multiple transformations share parsed dates.
+    """
+
+    check_cols_present(metadata_df, {"collection_timestamp"})
+    check_cols_not_present(metadata_df, set(TS_COLS))
+
+    # Parse all of the timestamps at once. We convert the timestamps to
+    # strings just in case they're something funky like floats (non-str
+    # timestamps could ostensibly be valid, for example if they're all
+    # formatted like 20200109. that being said, doing this conversion makes me
+    # feel dirty so if you're reading this i still recommend that timestamps
+    # be specified as strings from the get-go.)
+    if timestamps is None:
+        valid, dates = strict_parse_series(metadata_df["collection_timestamp"])
+    else:
+        valid, dates = timestamps.strict_parse()
+    _record_invalid_timestamps(
+        metadata_df.index, metadata_df["collection_timestamp"], valid
     )
 
-    # 2. Add ordinal timestamp for all samples
+    if min_date is None:
+        # Compute earliest date
+        min_date = _get_min_date(valid, dates)
+        print("Earliest date is {}.".format(min_date.astype(object)))
+
+    return OrderedDict(_derive_ts_cols(valid, dates, min_date))
+
 
-    def get_ordinal_timestamp(row):
-        if row["is_collection_timestamp_valid"] == "True":
-            return sampleid2date[row.name].isoformat().replace("-", "")
-        else:
-            return "not applicable"
+def _add_extra_cols(metadata_df, min_date=None, timestamps=None):
+    """Returns a DataFrame modified as expected.
+
+       See _get_extra_cols() for details. metadata_df isn't modified.
+    """
+    return attach_cols(
+        metadata_df.copy(deep=False),
+        _get_extra_cols(metadata_df, min_date, timestamps),
+    )
 
-    m_df["ordinal_timestamp"] = m_df.apply(get_ordinal_timestamp, axis=1)
 
-    # 3. Add days elapsed
+def _parse_ordinal_timestamps(ordinal_timestamps):
+    """Converts ordinal_timestamp values (e.g. "20190201") back to dates.
+
+       Returns a np.ndarray of datetime64[D]. Each unique value is only
+       converted once.
+    """
+    codes, uniques = pd.factorize(ordinal_timestamps)
+    unique_dates = np.array(
+        ["{}-{}-{}".format(o[:4], o[4:6], o[6:]) for o in uniques],
+        dtype="M8[D]",
+    )
+    return unique_dates[codes]
 
-    # 3.1. Compute earliest date
-    min_date = min(sampleid2date.values())
 
-    print("Earliest date is {}.".format(min_date))
+def _get_previous_min_date(previous_df):
+    """Figures out the "first day" that a previous output was computed with.
 
-    # 3.2. Assign "days from first timestamp" metric for each sample
-    # (the sample(s) taken on min_date should have a value of 0, and samples
-    # taken on the next day day later would have a value of 1, ...)
-    # There is some inherent imprecision here due to different levels of
-    # precision in sample collection (e.g. down to the day vs. down to the
-    # minute), but this should be sufficient for exploratory visualization.
+       Returns None if none of the previous output's timestamps are valid.
+    """
+    valid = previous_df["is_collection_timestamp_valid"].to_numpy() == "True"
+    if not valid.any():
+        return None
+    i = np.flatnonzero(valid)[0]
+    ordinal_date = _parse_ordinal_timestamps(
+        previous_df["ordinal_timestamp"].to_numpy()[[i]]
+    )[0]
+    days_since = int(previous_df["days_since_first_day"].iloc[i])
+    return ordinal_date - np.timedelta64(days_since, "D")
 
-    def get_days_since(row):
-        if row["is_collection_timestamp_valid"] == "True":
-            # Note the avoidance of relativedelta -- see
-            # https://stackoverflow.com/a/48262147/10730311
-            return str((sampleid2date[row.name] - min_date).days)
-        else:
-            return "not applicable"
 
-    m_df["days_since_first_day"] = m_df.apply(get_days_since, axis=1)
+def _get_incremental_extra_cols(metadata_df, previous_df):
+    """Computes the columns added by add-ts-cols, reusing a previous output.
 
-    return m_df
+       previous_df should be a metadata DataFrame previously output by
+       add-ts-cols. Samples with the same ID and collection_timestamp in
+       metadata_df and previous_df reuse their values from previous_df; only
+       the other (new or changed) samples' timestamps are parsed.
 
+       days_since_first_day is recomputed for the reused samples only if the
+       earliest date across all of the samples in metadata_df differs from
+       the "first day" used in previous_df. (This is computed from the reused
+       samples' ordinal_timestamp values, so their timestamps still don't
+       need to be parsed.)
 
-@click.command()
-@click.option(
-    "-i",
-    "--input-metadata-file",
-    required=True,
-    help=(
-        "Input metadata filepath. Must contain a collection_timestamp column."
-    ),
-    type=str,
-)
-@click.option(
-    "-o",
-    "--output-metadata-file",
-    required=True,
-    help="Output metadata filepath. Will contain some additional columns.",
-    type=str,
-)
-def add_columns(input_metadata_file, output_metadata_file) -> None:
-    """Add some useful columns for time-series studies to a metadata file.
-
-    In particular, the columns added are "is_collection_timestamp_valid",
-    "ordinal_timestamp", and "days_since_first_day".
-
-    Note that the value of days_since_first_day may vary even between samples
-    with identical collection_timestamp values if you run this script on
-    different metadata files. This is because the "first day" is computed
-    relative to all of the valid collection_timestamps in the input metadata
-    file; to ensure that the values in this column are comparable between
-    datasets, you should merge metadata and then run this script.
+       The output is the same as _get_extra_cols(metadata_df), assuming that
+       previous_df's values were computed from the same timestamps.
+    """
+    check_cols_present(metadata_df, {"collection_timestamp"})
+    check_cols_not_present(metadata_df, set(TS_COLS))
+
+    reusable, previous_rows = find_reusable_rows(
+        metadata_df, previous_df, TS_COLS, ["collection_timestamp"]
+    )
+    print(
+        "Reusing previous values for {} of {} sample(s).".format(
+            reusable.sum(), len(reusable)
+        )
+    )
+    reused_cols = OrderedDict(
+        (col, previous_df[col].to_numpy()[previous_rows]) for col in TS_COLS
+    )
+    reused_valid = reused_cols["is_collection_timestamp_valid"] == "True"
+    reused_dates = np.full(len(reused_valid), np.datetime64("NaT"), "M8[D]")
+    reused_dates[reused_valid] = _parse_ordinal_timestamps(
+        reused_cols["ordinal_timestamp"][reused_valid]
+    )
+
+    timestamps = metadata_df["collection_timestamp"].to_numpy()
+    new_valid, new_dates = strict_parse_series(timestamps[~reusable])
+    # Record the invalid timestamps of all of the samples (including the
+    # reused ones) at once, so the anomalies recorded are the same as in a
+    # full run
+    all_valid = np.empty(len(reusable), dtype=bool)
+    all_valid[~reusable] = new_valid
+    all_valid[reusable] = reused_valid
+    _record_invalid_timestamps(metadata_df.index, timestamps, all_valid)
+    min_date = _get_min_date(
+        np.concatenate([new_valid, reused_valid]),
+        np.concatenate([new_dates, reused_dates]),
+    )
+    print("Earliest date is {}.".format(min_date.astype(object)))
+
+    if min_date != _get_previous_min_date(previous_df):
+        print(
+            "The earliest date has changed, so days_since_first_day will be "
+            "recomputed for all samples."
+        )
+        reused_cols = OrderedDict(
+            _derive_ts_cols(reused_valid, reused_dates, min_date)
+        )
+
+    return combine_cols(
+        reusable,
+        OrderedDict(_derive_ts_cols(new_valid, new_dates, min_date)),
+        reused_cols,
+    )
+
+
+def _scan_min_date(input_metadata_file, chunk_size=100000):
+    """Returns the earliest valid collection_timestamp date in a file.
+
+       Only the collection_timestamp column is loaded, one chunk of samples at
+       a time. Returns None if none of the timestamps are valid.
+
+       Also checks that the file has a collection_timestamp column, and that
+       it doesn't already contain any of the columns we'd add on.
+    """
+    header, _ = read_md_header(input_metadata_file)
+    header_df = pd.DataFrame(columns=header[1:])
+    check_cols_present(header_df, {"collection_timestamp"})
+    check_cols_not_present(header_df, set(TS_COLS))
+
+    min_date = None
+    for chunk in iter_md_chunks(
+        input_metadata_file, chunk_size, usecols=["collection_timestamp"]
+    ):
+        valid, dates = strict_parse_series(chunk["collection_timestamp"])
+        if valid.any():
+            chunk_min_date = dates[valid].min()
+            if min_date is None or chunk_min_date < min_date:
+                min_date = chunk_min_date
+    return min_date
+
+
+def _stream_add_extra_cols(
+    input_metadata_file, output_metadata_file, chunk_size
+):
+    """Does the same thing as _add_extra_cols(), but one chunk at a time.
+
+       The input file is read twice. The first pass only looks at the
+       collection_timestamp column, in order to find the earliest date in the
+       entire file; the second pass then adds on the new columns to each chunk
+       of samples and writes it to the output file. Only one chunk of samples
+       is kept in memory at once.
+
+       Comments in the input file aren't preserved in the output file, but
+       directives (e.g. #q2:types) are. If the input file has a #q2:types
+       directive, the new columns are declared as categorical.
     """
+    # 1. Find the earliest date
+    with PROFILER.span("find earliest date"):
+        min_date = _scan_min_date(input_metadata_file, chunk_size)
+    if min_date is None:
+        raise ValueError("None of the collection_timestamp values are valid.")
+    print("Earliest date is {}.".format(min_date.astype(object)))
+
+    # 2. Add on the new columns to each chunk, and write it out
+    header, _ = read_md_header(input_metadata_file)
+    directives = get_md_directives(input_metadata_file, include_types=True)
+    with open(output_metadata_file, "w") as f:
+        write_md_header(f, header + TS_COLS, directives)
+        for chunk in iter_md_chunks(input_metadata_file, chunk_size):
+            with PROFILER.span("transform"):
+                attach_cols(chunk, _get_extra_cols(chunk, min_date))
+            with PROFILER.span("save metadata"):
+                write_md_rows(f, chunk)
+
+
+def _add_extra_cols_to_file(
+    input_metadata_file, output_metadata_file, min_date, backend
+):
+    """Processes one file for _batch_add_extra_cols().
+
+       Returns a Diagnostics containing the anomalies found in this file,
+       since this may be run in a worker process (whose DIAGNOSTICS would
+       otherwise be lost).
+    """
+    DIAGNOSTICS.clear()
     manipulate_md(
-        input_metadata_file, [], output_metadata_file, _add_extra_cols
+        input_metadata_file,
+        [min_date],
+        output_metadata_file,
+        _get_extra_cols,
+        backend,
     )
+    file_diagnostics = Diagnostics(DIAGNOSTICS.max_examples)
+    file_diagnostics.merge(DIAGNOSTICS)
+    return file_diagnostics
+
+
+def _init_batch_worker(formats, parse_jobs, parse_cache):
+    """Sets up a worker process for _batch_add_extra_cols().
+
+       Worker processes don't necessarily inherit this process' state (e.g.
+       if they're started using "spawn"), so the timestamp formats, number of
+       parsing jobs, and parse cache entries in use are copied over.
+    """
+    FORMAT_REGISTRY.set_formats(formats)
+    PARSE_POOL.jobs = parse_jobs
+    PARSE_CACHE.clear()
+    PARSE_CACHE.merge(parse_cache)
+
 
+def _run_in_batch_worker(func, *args):
+    """Returns func(*args), and the worker's parse cache after running it.
 
-if __name__ == "__main__":
-    add_columns()
+       The parse cache's hit/miss counts only cover this call to func.
+    """
+    PARSE_CACHE.hits = 0
+    PARSE_CACHE.misses = 0
+    return func(*args), PARSE_CACHE.copy()
+
+
+def _batch_add_extra_cols(
+    input_metadata_files, output_metadata_files, file_jobs=1, backend="native"
+):
+    """Runs add-ts-cols on many files, using the same "first day" for each.
+
+       First, all of the input files are scanned (just looking at their
+       collection_timestamp columns) to find the earliest date across all of
+       them. Each input file is then processed and written to the
+       corresponding output file, with days_since_first_day computed relative
+       to this earliest date -- so days_since_first_day values are comparable
+       across all of the output files, without having to merge the input files
+       together first.
+
+       If file_jobs is greater than 1, the files are scanned and processed in
+       parallel using a pool of this many processes. Either way, the
+       anomalies found in all of the files are recorded in DIAGNOSTICS, and
+       the timestamps parsed in all of the files are added to PARSE_CACHE.
+    """
+    if len(input_metadata_files) != len(output_metadata_files):
+        raise ValueError(
+            "Number of input files doesn't match number of output files."
+        )
+
+    def run_all(func, *iterables):
+        if file_jobs == 1 or len(input_metadata_files) == 1:
+            return list(map(func, *iterables))
+        with ProcessPoolExecutor(
+            max_workers=file_jobs,
+            initializer=_init_batch_worker,
+            initargs=(
+                FORMAT_REGISTRY.formats,
+                PARSE_POOL.jobs,
+                PARSE_CACHE.copy(),
+            ),
+        ) as executor:
+            results = []
+            for result, worker_cache in executor.map(
+                functools.partial(_run_in_batch_worker, func), *iterables
+            ):
+                PARSE_CACHE.merge(worker_cache)
+                results.append(result)
+            return results
+
+    # 1. Find the earliest date across all of the files
+    file_min_dates = run_all(_scan_min_date, input_metadata_files)
+    file_min_dates = [d for d in file_min_dates if d is not None]
+    if len(file_min_dates) == 0:
+        raise ValueError(
+            "None of the collection_timestamp values in any of the input "
+            "files are valid."
+        )
+    min_date = min(file_min_dates)
+    print("Earliest date is {}.".format(min_date.astype(object)))
+
+    # 2. Process each file using this date, and collect the anomalies found
+    # in each file
+    n = len(input_metadata_files)
+    all_diagnostics = run_all(
+        _add_extra_cols_to_file,
+        input_metadata_files,
+        output_metadata_files,
+        [min_date] * n,
+        [backend] * n,
+    )
+    DIAGNOSTICS.clear()
+    for file_diagnostics in all_diagnostics:
+        DIAGNOSTICS.merge(file_diagnostics)
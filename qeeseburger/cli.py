@@ -0,0 +1,1108 @@
+# Qeeseburger's command-line interface.
+#
+# This module should only import click at the top level: the modules that
+# actually do stuff (and the heavy libraries they depend on, like pandas and
+# QIIME 2) are imported inside each command's function. This way, things like
+# "add-ts-cols --help" (or a typo in an option) don't have to wait for these
+# libraries to be imported.
+import os
+import click
+
+
+# Options shared by multiple commands
+_parse_cache_option = click.option(
+    "--parse-cache",
+    required=False,
+    default=None,
+    help=(
+        "Optional filepath of a timestamp parse cache. If this file exists, "
+        "previously parsed timestamps will be loaded from it; the cache will "
+        "then be saved to this file, so later runs on the same study can "
+        "reuse it."
+    ),
+    type=str,
+)
+_io_backend_option = click.option(
+    "--io-backend",
+    default="native",
+    show_default=True,
+    help=(
+        'How to read and write metadata files. "native" reads and writes '
+        "QIIME 2 metadata files directly, treating every value as a string "
+        '(this is fast, and doesn\'t require QIIME 2). "qiime2" uses '
+        "QIIME 2's Metadata API, which also validates the metadata."
+    ),
+    type=click.Choice(["native", "qiime2"]),
+)
+_key_dates_cache_option = click.option(
+    "--key-dates-cache",
+    required=False,
+    default=None,
+    help=(
+        "Optional filepath of a key dates cache. The validated date ranges "
+        "of each phase will be saved to this file, so later runs with the "
+        "same key dates file (as long as it hasn't been modified) don't need "
+        "to read it again."
+    ),
+    type=str,
+)
+_parse_jobs_option = click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    show_default=True,
+    help=(
+        "Number of processes to use for parsing timestamps that can't be "
+        "parsed in bulk (e.g. timestamps in unusual formats). Small numbers "
+        "of these timestamps are always parsed in a single process."
+    ),
+    type=click.IntRange(min=1),
+)
+_timestamp_formats_option = click.option(
+    "--timestamp-formats",
+    default=None,
+    help=(
+        "Optional file of extra timestamp formats to accept (one arrow "
+        'format string per line, e.g. "D MMMM YYYY"), in addition to the '
+        "default formats. Each format must include a year, month, and day."
+    ),
+    type=click.Path(exists=True, dir_okay=False),
+)
+_profile_option = click.option(
+    "--profile",
+    default=None,
+    help=(
+        "Optional filepath to write a profile of this command to. If this "
+        'ends in ".prof", a cProfile dump (which can be viewed with e.g. '
+        "pstats or snakeviz) is written; otherwise, a JSON report of how "
+        "long each stage of the command (loading the metadata, parsing "
+        "timestamps, etc.) took, and of the peak memory use after each "
+        "stage, is written."
+    ),
+    type=str,
+)
+_diagnostics_report_option = click.option(
+    "--diagnostics-report",
+    "diagnostics",
+    default=None,
+    help=(
+        "Optional filepath to write a TSV report of the anomalies found "
+        "(e.g. invalid timestamps, or samples taken before their host's "
+        "birthday) to, listing up to 1,000 examples of each kind of anomaly. "
+        "Either way, a one-line summary of the anomalies is printed at the "
+        "end."
+    ),
+    type=str,
+)
+_previous_output_option = click.option(
+    "--previous-output",
+    default=None,
+    help=(
+        "Optional filepath of this command's output from a previous run "
+        "(e.g. before new samples were added to the input metadata file). "
+        "Samples with the same ID and timestamp (and host) as in this file "
+        "will reuse their values from it, so only new or changed samples "
+        "are processed."
+    ),
+    type=click.Path(exists=True, dir_okay=False),
+)
+
+
+@click.command()
+@click.option(
+    "-i",
+    "--input-metadata-file",
+    required=True,
+    help=(
+        "Input metadata filepath. Must contain a collection_timestamp column."
+    ),
+    type=str,
+)
+@click.option(
+    "-o",
+    "--output-metadata-file",
+    required=True,
+    help="Output metadata filepath. Will contain some additional columns.",
+    type=str,
+)
+@_parse_cache_option
+@_parse_jobs_option
+@_timestamp_formats_option
+@_io_backend_option
+@click.option(
+    "--stream",
+    is_flag=True,
+    help=(
+        "If this flag is used, the input metadata file will be processed in "
+        "chunks of samples rather than being loaded all at once. Use this "
+        "for metadata files that are too large to fit in memory. (This "
+        "can't be used with --io-backend qiime2.)"
+    ),
+)
+@click.option(
+    "--chunk-size",
+    default=100000,
+    show_default=True,
+    help="Number of samples per chunk (only used if --stream is used).",
+    type=click.IntRange(min=1),
+)
+@_previous_output_option
+@_diagnostics_report_option
+@_profile_option
+def add_columns(
+    input_metadata_file,
+    output_metadata_file,
+    parse_cache,
+    jobs,
+    timestamp_formats,
+    io_backend,
+    stream,
+    chunk_size,
+    previous_output,
+    diagnostics,
+    profile,
+) -> None:
+    """Add some useful columns for time-series studies to a metadata file.
+
+    In particular, the columns added are "is_collection_timestamp_valid",
+    "ordinal_timestamp", and "days_since_first_day".
+
+    Note that the value of days_since_first_day may vary even between samples
+    with identical collection_timestamp values if you run this script on
+    different metadata files. This is because the "first day" is computed
+    relative to all of the valid collection_timestamps in the input metadata
+    file; to ensure that the values in this column are comparable between
+    datasets, you should merge metadata and then run this script.
+
+    If --previous-output is used, only samples that are new (or whose
+    collection_timestamp changed) since the previous output was created are
+    processed; days_since_first_day is only recomputed for the other samples
+    if the earliest date in the input metadata file has changed.
+    """
+    if stream and previous_output is not None:
+        raise click.UsageError(
+            "--stream and --previous-output can't be used together."
+        )
+    if stream and io_backend != "native":
+        raise click.UsageError(
+            "--stream can only be used with the native I/O backend."
+        )
+
+    from .utils import (
+        PROFILER,
+        manipulate_md,
+        parse_cache_file,
+        parse_jobs,
+        diagnostics_file,
+        profile_run,
+        timestamp_formats_file,
+        load_metadata,
+    )
+    from .add_timeseries_cols import (
+        _get_extra_cols,
+        _get_incremental_extra_cols,
+        _stream_add_extra_cols,
+    )
+
+    with profile_run(profile, "add-ts-cols"):
+        with timestamp_formats_file(timestamp_formats), parse_jobs(jobs):
+            with parse_cache_file(parse_cache), diagnostics_file(diagnostics):
+                if stream:
+                    _stream_add_extra_cols(
+                        input_metadata_file, output_metadata_file, chunk_size
+                    )
+                elif previous_output is not None:
+                    with PROFILER.span("load previous output"):
+                        previous_df = load_metadata(
+                            previous_output, io_backend
+                        )
+                    manipulate_md(
+                        input_metadata_file,
+                        [previous_df],
+                        output_metadata_file,
+                        _get_incremental_extra_cols,
+                        io_backend,
+                    )
+                else:
+                    manipulate_md(
+                        input_metadata_file,
+                        [],
+                        output_metadata_file,
+                        _get_extra_cols,
+                        io_backend,
+                    )
+
+
+@click.command()
+@click.option(
+    "-i",
+    "--input-metadata-file",
+    "input_metadata_files",
+    required=True,
+    multiple=True,
+    help=(
+        "Input metadata filepath. Must contain a collection_timestamp column. "
+        "You can specify this option multiple times."
+    ),
+    type=str,
+)
+@click.option(
+    "-d",
+    "--output-dir",
+    required=True,
+    help=(
+        "Directory to write output metadata files to. Each output file will "
+        "have the same filename as its input file. This directory will be "
+        "created if it doesn't already exist."
+    ),
+    type=str,
+)
+@click.option(
+    "--file-jobs",
+    default=1,
+    show_default=True,
+    help=(
+        "Number of processes to use for processing files in parallel. (This "
+        "is separate from --jobs, which is used within each file.)"
+    ),
+    type=click.IntRange(min=1),
+)
+@_parse_cache_option
+@_parse_jobs_option
+@_timestamp_formats_option
+@_io_backend_option
+@_diagnostics_report_option
+@_profile_option
+def add_columns_batch(
+    input_metadata_files,
+    output_dir,
+    file_jobs,
+    parse_cache,
+    jobs,
+    timestamp_formats,
+    io_backend,
+    diagnostics,
+    profile,
+):
+    """Run add-ts-cols on multiple metadata files at once.
+
+    The "first day" used for the days_since_first_day column is computed
+    relative to all of the valid collection_timestamps in ALL of the input
+    metadata files. So, days_since_first_day values are comparable between
+    all of the output metadata files -- this is equivalent to merging the
+    input metadata files and then running add-ts-cols, but doesn't require
+    loading all of the metadata into memory at once.
+    """
+    from .utils import (
+        parse_cache_file,
+        parse_jobs,
+        diagnostics_file,
+        profile_run,
+        timestamp_formats_file,
+    )
+    from .add_timeseries_cols import _batch_add_extra_cols
+
+    filenames = [os.path.basename(f) for f in input_metadata_files]
+    if len(set(filenames)) < len(filenames):
+        raise click.UsageError("Input metadata filenames must be unique.")
+    os.makedirs(output_dir, exist_ok=True)
+    with profile_run(profile, "add-ts-cols-batch"):
+        with timestamp_formats_file(timestamp_formats), parse_jobs(jobs):
+            with parse_cache_file(parse_cache), diagnostics_file(diagnostics):
+                _batch_add_extra_cols(
+                    input_metadata_files,
+                    [os.path.join(output_dir, f) for f in filenames],
+                    file_jobs,
+                    io_backend,
+                )
+
+
+@click.command()
+@click.option(
+    "-i",
+    "--input-metadata-file",
+    required=True,
+    help=(
+        "Input metadata filepath. Must contain collection_timestamp and "
+        "host_subject_id columns."
+    ),
+    type=str,
+)
+@click.option(
+    "-h",
+    "--host-id-list",
+    default=None,
+    help=(
+        "List of host subject IDs, separated by commas. Required unless "
+        "--birthdays-file is used."
+    ),
+    type=str,
+)
+@click.option(
+    "-b",
+    "--host-birthday-list",
+    default=None,
+    help=(
+        "List of host birthdays, separated by commas. Each birthday should be "
+        "in YYYY-MM-DD format, and the number of birthdays should match the "
+        "number of host IDs specified. Required unless --birthdays-file is "
+        "used."
+    ),
+    type=str,
+)
+@click.option(
+    "--birthdays-file",
+    default=None,
+    help=(
+        "CSV or TSV file (optionally compressed, e.g. .tsv.gz) of host "
+        "birthdays, as an alternative to -h and -b. Must have a header line "
+        "including host_subject_id and birthday columns. Files with a .csv "
+        "extension are read as comma-separated; all others are read as "
+        "tab-separated."
+    ),
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--float-years",
+    is_flag=True,
+    help=(
+        "If this flag is used, the host ages will be in float approximations "
+        "(using day-level precision) instead of integers down to the year."
+    ),
+    type=str,
+)
+@click.option(
+    "-o",
+    "--output-metadata-file",
+    required=True,
+    help="Output metadata filepath. Will contain a host_age_years column.",
+    type=str,
+)
+@_parse_cache_option
+@_parse_jobs_option
+@_timestamp_formats_option
+@_io_backend_option
+@_previous_output_option
+@_diagnostics_report_option
+@_profile_option
+def add_host_ages(
+    input_metadata_file,
+    host_id_list,
+    host_birthday_list,
+    birthdays_file,
+    float_years,
+    output_metadata_file,
+    parse_cache,
+    jobs,
+    timestamp_formats,
+    io_backend,
+    previous_output,
+    diagnostics,
+    profile,
+) -> None:
+    """Add host age in years on to a metadata file.
+
+       The column added will be named "host_age_years" if --float-years isn't
+       set, and "host_age" if --float-years *is* set.
+
+       Hosts can be given either with -h and -b, or with --birthdays-file.
+
+       If --previous-output is used, only samples that are new (or whose
+       host_subject_id or collection_timestamp changed) since the previous
+       output was created are processed. This assumes that the host birthdays
+       haven't changed since then.
+    """
+    using_lists = host_id_list is not None or host_birthday_list is not None
+    if birthdays_file is not None and using_lists:
+        raise click.UsageError(
+            "Use either -h and -b, or --birthdays-file, but not both."
+        )
+    if birthdays_file is None and not using_lists:
+        raise click.UsageError(
+            "Either -h and -b, or --birthdays-file, must be used."
+        )
+
+    from .utils import (
+        PROFILER,
+        manipulate_md,
+        parse_cache_file,
+        parse_jobs,
+        diagnostics_file,
+        profile_run,
+        timestamp_formats_file,
+        load_metadata,
+    )
+    from .add_host_ages import (
+        _get_host_age_cols,
+        _get_incremental_host_age_cols,
+    )
+
+    params = [host_id_list, host_birthday_list, float_years, birthdays_file]
+    func = _get_host_age_cols
+    with profile_run(profile, "add-host-ages"):
+        if previous_output is not None:
+            with PROFILER.span("load previous output"):
+                params = [load_metadata(previous_output, io_backend)] + params
+            func = _get_incremental_host_age_cols
+        with timestamp_formats_file(timestamp_formats), parse_jobs(jobs):
+            with parse_cache_file(parse_cache), diagnostics_file(diagnostics):
+                manipulate_md(
+                    input_metadata_file,
+                    params,
+                    output_metadata_file,
+                    func,
+                    io_backend,
+                )
+
+
+@click.command()
+@click.option(
+    "-hsid",
+    "--host-subject-id",
+    required=True,
+    help="Host subject ID to set dietary phase for.",
+    type=str,
+)
+@click.option(
+    "-p",
+    "--phase-name",
+    required=True,
+    help="Key word to look for in dietary phases. Any rows in the key dates "
+    "spreadsheet where the 'Event' column contains the text 'Started "
+    "PHASENAME' or 'Stopped PHASENAME', where PHASENAME is the string you "
+    "specify here, will be treated as start/end range(s) for that phase "
+    "(these ranges are assumed to be inclusive for the start date and "
+    "exclusive on the end date).",
+    type=str,
+)
+@click.option(
+    "-k",
+    "--key-dates-spreadsheet",
+    required=True,
+    help=(
+        "Filepath to an Excel spreadsheet (or a CSV/TSV file) containing "
+        "dates as the first column and 'Event' as the second column."
+    ),
+    type=str,
+)
+@click.option(
+    "-i",
+    "--input-metadata-file",
+    required=True,
+    help=(
+        "Input metadata filepath. Must contain collection_timestamp and "
+        "host_subject_id columns."
+    ),
+    type=str,
+)
+@click.option(
+    "-o",
+    "--output-metadata-file",
+    required=True,
+    help=(
+        "Output metadata filepath. Will contain a new column named with "
+        "whatever you set the -p option to."
+    ),
+    type=str,
+)
+@_parse_cache_option
+@_parse_jobs_option
+@_key_dates_cache_option
+@_io_backend_option
+@_diagnostics_report_option
+@_profile_option
+def add_dietary_phase(
+    host_subject_id,
+    phase_name,
+    key_dates_spreadsheet,
+    input_metadata_file,
+    output_metadata_file,
+    parse_cache,
+    jobs,
+    key_dates_cache,
+    io_backend,
+    diagnostics,
+    profile,
+) -> None:
+    """Encodes dietary phase information into a sample metadata file.
+
+    The main information needed for this are the phase name (-p) and the key
+    dates spreadsheet (-k). This program looks for rows in the key dates
+    spreadsheet where the "Event" column contains the text "Started PHASENAME"
+    or "Stopped PHASENAME", where PHASENAME is just the string you specified in
+    the -p option.
+
+    This program will then use the dates associated with these rows to
+    determine ranges of dates for which the given dietary phase was being
+    followed -- this is useful if the subject went on and off a diet multiple
+    times. The start date of a phase is counted as being in that range; the end
+    date is NOT counted as being in that range.
+
+    Finally, this will add a PHASENAME column to the metadata file. Samples
+    will be assigned one of three possible values in this column:
+
+        Samples where host_subject_id is equal to the -hsid parameter AND the
+        collection_timestamp falls within a dietary phase range will be
+        labelled "TRUE".
+
+        Samples where host_subject_id is equal to the -hsid parameter AND the
+        collection_timestamp DOES NOT fall within a dietary phase range will
+        be labelled "FALSE".
+
+        Samples where host_subject_id is NOT EQUAL to the -hsid parameter
+        will be labelled "not applicable".
+
+    This only treats dates as down to the day. So if the subject started a diet
+    at 12pm on a day and then ended that diet at 5pm that same day, this code
+    will treat both of these dates as occurring on the same day and thus raise
+    an error.
+    """
+
+    from .utils import (
+        PROFILER,
+        manipulate_md,
+        parse_cache_file,
+        parse_jobs,
+        diagnostics_file,
+        profile_run,
+    )
+    from .key_dates import load_phase_intervals
+    from .add_dietary_phase import _get_dietary_phase_cols
+
+    with profile_run(profile, "add-diet"), parse_jobs(jobs):
+        with PROFILER.span("load key dates"):
+            phase_intervals = load_phase_intervals(
+                key_dates_spreadsheet,
+                host_subject_id,
+                phase_name,
+                key_dates_cache,
+            )
+        with parse_cache_file(parse_cache), diagnostics_file(diagnostics):
+            manipulate_md(
+                input_metadata_file,
+                [phase_intervals],
+                output_metadata_file,
+                _get_dietary_phase_cols,
+                io_backend,
+            )
+
+
+@click.command()
+@click.option(
+    "-k",
+    "--key-dates-workbook",
+    required=True,
+    help=(
+        "Filepath to an Excel workbook (or a CSV/TSV file) of key dates. "
+        "Each sheet should look like the key dates spreadsheet used by "
+        "add-diet (dates as the first column, and an 'Event' column). If a "
+        "sheet has a host_subject_id column, its rows will be split up by "
+        "host; otherwise, the sheet's name will be used as the host subject "
+        "ID for all of its rows. CSV/TSV files must have a host_subject_id "
+        "column."
+    ),
+    type=str,
+)
+@click.option(
+    "-i",
+    "--input-metadata-file",
+    required=True,
+    help=(
+        "Input metadata filepath. Must contain collection_timestamp and "
+        "host_subject_id columns."
+    ),
+    type=str,
+)
+@click.option(
+    "-o",
+    "--output-metadata-file",
+    required=True,
+    help=(
+        "Output metadata filepath. Will contain a new column for each phase "
+        "found in the key dates workbook."
+    ),
+    type=str,
+)
+@_parse_cache_option
+@_parse_jobs_option
+@_key_dates_cache_option
+@_io_backend_option
+@_diagnostics_report_option
+@_profile_option
+def add_dietary_phases(
+    key_dates_workbook,
+    input_metadata_file,
+    output_metadata_file,
+    parse_cache,
+    jobs,
+    key_dates_cache,
+    io_backend,
+    diagnostics,
+    profile,
+) -> None:
+    """Encodes all dietary phases for many hosts into a metadata file.
+
+    This is like running add-diet for every host and phase in a key dates
+    workbook, but a lot faster: the metadata and key dates are only loaded
+    once, and the output metadata file is only written once.
+
+    Every phase with a "Started PHASENAME" event in the workbook will be
+    added to the metadata as a PHASENAME column, with values assigned as
+    described in add-diet's documentation. Samples from hosts that don't have
+    any key dates for a phase will be labelled "not applicable" in that
+    phase's column.
+
+    Unlike add-diet (which accepts any event containing "Started PHASENAME"
+    or "Stopped PHASENAME"), events have to match these exactly (ignoring
+    whitespace), since otherwise the ranges of e.g. a "keto lite" phase
+    would also count as "keto" ranges. So an event like "Started keto (day
+    1)" starts a phase named "keto (day 1)", not "keto".
+    """
+
+    from .utils import (
+        PROFILER,
+        manipulate_md,
+        parse_cache_file,
+        parse_jobs,
+        diagnostics_file,
+        profile_run,
+    )
+    from .key_dates import load_phase_intervals
+    from .add_dietary_phase import _get_dietary_phase_cols
+
+    with profile_run(profile, "add-diet-batch"), parse_jobs(jobs):
+        with PROFILER.span("load key dates"):
+            phase_intervals = load_phase_intervals(
+                key_dates_workbook, cache_filepath=key_dates_cache
+            )
+        with parse_cache_file(parse_cache), diagnostics_file(diagnostics):
+            manipulate_md(
+                input_metadata_file,
+                [phase_intervals],
+                output_metadata_file,
+                _get_dietary_phase_cols,
+                io_backend,
+            )
+
+
+@click.group()
+def qeeseburger() -> None:
+    """Runs multiple Qeeseburger commands on a metadata file at once."""
+
+
+@qeeseburger.command()
+@click.option(
+    "-s",
+    "--spec",
+    required=True,
+    help=(
+        "Filepath to a JSON (or, if PyYAML is installed, YAML) file listing "
+        "the transforms to apply, in order."
+    ),
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "-i",
+    "--input-metadata-file",
+    required=True,
+    help="Input metadata filepath.",
+    type=str,
+)
+@click.option(
+    "-o",
+    "--output-metadata-file",
+    required=True,
+    help="Output metadata filepath.",
+    type=str,
+)
+@_parse_cache_option
+@_parse_jobs_option
+@_timestamp_formats_option
+@_io_backend_option
+@_diagnostics_report_option
+@_profile_option
+def run(
+    spec,
+    input_metadata_file,
+    output_metadata_file,
+    parse_cache,
+    jobs,
+    timestamp_formats,
+    io_backend,
+    diagnostics,
+    profile,
+) -> None:
+    """Applies a pipeline of transforms to a metadata file.
+
+    This is equivalent to running add-ts-cols, add-host-ages, add-diet, and/or
+    add-diet-batch one after another, but the metadata file is only loaded
+    and written once (and each timestamp is only parsed once).
+
+    The spec file should contain a "transforms" list. Each transform has a
+    "transform" key naming the command to run, and the command's other
+    options (using underscores instead of dashes, e.g. "phase_name") as
+    other keys. For example:
+
+    \b
+    {"transforms": [
+        {"transform": "add-ts-cols"},
+        {"transform": "add-host-ages", "birthdays_file": "bdays.tsv"},
+        {"transform": "add-diet", "host_subject_id": "ABC",
+         "phase_name": "keto", "key_dates_spreadsheet": "kd.xlsx"}
+    ]}
+    """
+
+    from .utils import (
+        parse_cache_file,
+        parse_jobs,
+        diagnostics_file,
+        profile_run,
+        timestamp_formats_file,
+    )
+    from .pipeline import load_spec, run_pipeline
+
+    try:
+        pipeline_spec = load_spec(spec)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="'-s' / '--spec'")
+    with profile_run(profile, "run"):
+        with timestamp_formats_file(timestamp_formats), parse_jobs(jobs):
+            with parse_cache_file(parse_cache), diagnostics_file(diagnostics):
+                run_pipeline(
+                    input_metadata_file,
+                    pipeline_spec,
+                    output_metadata_file,
+                    io_backend,
+                )
+
+
+# Options shared by the SourceTracker2 commands
+_st_subsets_options = [
+    click.option(
+        "-i",
+        "--input-metadata-file",
+        required=True,
+        help=(
+            "Input metadata filepath, containing both the source samples "
+            "(e.g. from the American Gut Project) and the sink samples."
+        ),
+        type=str,
+    ),
+    click.option(
+        "-d",
+        "--output-dir",
+        required=True,
+        help=(
+            "Directory to write one metadata file per category to, named "
+            'after the category (e.g. "animal-distal-gut.tsv"). This '
+            "directory will be created if it doesn't already exist."
+        ),
+        type=str,
+    ),
+    click.option(
+        "-c",
+        "--category",
+        "categories",
+        multiple=True,
+        default=("Animal distal gut", "Animal secretion", "Animal surface"),
+        show_default=True,
+        help=(
+            "Category to select sources from, and to write a metadata file of "
+            "sinks for. You can specify this option multiple times."
+        ),
+        type=str,
+    ),
+    click.option(
+        "-h",
+        "--host-id",
+        "host_ids",
+        multiple=True,
+        help=(
+            "Only use samples from this host as sinks. You can specify this "
+            "option multiple times. If this isn't used, all of the "
+            "(non-source) samples in each category are sinks."
+        ),
+        type=str,
+    ),
+    click.option(
+        "--source-prefix",
+        default="10317.",
+        show_default=True,
+        help="Samples whose IDs start with this can be selected as sources.",
+        type=str,
+    ),
+    click.option(
+        "--max-sources",
+        default=100,
+        show_default=True,
+        help=(
+            "Maximum number of sources to select from each category. The "
+            "sources are the first samples in each category (sorted by sample "
+            "ID) whose IDs start with --source-prefix."
+        ),
+        type=click.IntRange(min=1),
+    ),
+    click.option(
+        "--category-col",
+        default="empo_3",
+        show_default=True,
+        help="Metadata column containing each sample's category.",
+        type=str,
+    ),
+    click.option(
+        "--host-col",
+        default="coarse_host_id",
+        show_default=True,
+        help="Metadata column containing each sample's host (used with -h).",
+        type=str,
+    ),
+    click.option(
+        "--keep-col",
+        "keep_cols",
+        multiple=True,
+        help=(
+            "Extra metadata column to include in the output files (e.g. a "
+            "column to pass to SourceTracker2's --p-shared-id-column). By "
+            "default, the output files only include the category column and a "
+            "SourceSink column. You can specify this option multiple times."
+        ),
+        type=str,
+    ),
+    click.option(
+        "--prefixed-sinks",
+        is_flag=True,
+        help=(
+            "Let samples whose IDs start with --source-prefix, but that "
+            "weren't selected as sources, be sinks. By default, these samples "
+            "aren't included in the output files at all."
+        ),
+    ),
+    click.option(
+        "--shards",
+        default=1,
+        show_default=True,
+        help=(
+            "Split each category's sinks into this many shards (sorted by "
+            "sample ID), each of which gets its own metadata file with all of "
+            'the sources, e.g. "animal-distal-gut-shard-1.tsv". This lets '
+            "SourceTracker2 be run on a big category's sinks in parallel."
+        ),
+        type=click.IntRange(min=1),
+    ),
+    _io_backend_option,
+]
+
+
+def _add_options(options):
+    """Returns a decorator that adds a list of click options to a command."""
+
+    def decorator(func):
+        for option in reversed(options):
+            func = option(func)
+        return func
+
+    return decorator
+
+
+@qeeseburger.command(name="st-subsets")
+@_add_options(_st_subsets_options)
+def st_subsets(
+    input_metadata_file,
+    output_dir,
+    categories,
+    host_ids,
+    source_prefix,
+    max_sources,
+    category_col,
+    host_col,
+    keep_cols,
+    prefixed_sinks,
+    shards,
+    io_backend,
+) -> None:
+    """Prepares metadata for detecting misclassified samples with ST2.
+
+    For each category (e.g. "Animal distal gut"), this writes a metadata
+    file containing the same set of "source" samples -- the first
+    --max-sources samples of each category whose IDs start with
+    --source-prefix -- plus all of this category's "sink" samples. A
+    "SourceSink" column is set to "Source" or "Sink" accordingly.
+
+    Each file can then be passed to "qiime sourcetracker2 gibbs" (using the
+    category column as --p-source-category-column, and SourceSink as
+    --p-source-sink-column). If --shards is more than 1, each category's
+    sinks are split up into multiple files instead, which all have the same
+    sources.
+    """
+    from .utils import diagnostics_file
+    from .sourcetracking import prepare_st_metadata
+
+    with diagnostics_file(None):
+        prepare_st_metadata(
+            input_metadata_file,
+            output_dir,
+            list(categories),
+            list(host_ids),
+            source_prefix,
+            max_sources,
+            category_col,
+            host_col,
+            list(keep_cols),
+            prefixed_sinks,
+            io_backend,
+            shards,
+        )
+
+
+@qeeseburger.command(name="st-run")
+@_add_options(_st_subsets_options)
+@click.option(
+    "-t",
+    "--feature-table",
+    required=True,
+    help=(
+        "Feature table (.qza) filepath to pass to SourceTracker2. This can "
+        'include "{slug}" or "{category}" to use a different table for each '
+        'category, e.g. "{slug}-table.qza" (where the slug of '
+        '"Animal distal gut" is "animal-distal-gut").'
+    ),
+    type=str,
+)
+@click.option(
+    "--command",
+    default=None,
+    help=(
+        "Command to run for each metadata file, instead of "
+        '"qiime sourcetracker2 gibbs" (with the options used by '
+        "st2-fix-mcs.pbs). This can include the fields {category}, {slug}, "
+        "{shard}, {metadata}, {category_col}, {feature_table}, and "
+        "{output_dir}, which will be filled in for each metadata file."
+    ),
+    type=str,
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    show_default=True,
+    help="Number of metadata files to run SourceTracker2 on at once.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--merge-output",
+    "merge_outputs",
+    multiple=True,
+    default=("mixing_proportions.qza", "mixing_proportion_stds.qza"),
+    show_default=True,
+    help=(
+        "Output file (in each job's output directory) to merge across each "
+        "category's shards, if --shards is more than 1. .qza files are "
+        "merged using QIIME 2; other files are merged as TSV files. You can "
+        "specify this option multiple times."
+    ),
+    type=str,
+)
+def st_run(
+    input_metadata_file,
+    output_dir,
+    categories,
+    host_ids,
+    source_prefix,
+    max_sources,
+    category_col,
+    host_col,
+    keep_cols,
+    prefixed_sinks,
+    shards,
+    io_backend,
+    feature_table,
+    command,
+    jobs,
+    merge_outputs,
+) -> None:
+    """Runs SourceTracker2 on each category's sources and sinks.
+
+    This does the same thing as st-subsets, and then runs "qiime
+    sourcetracker2 gibbs" (or --command) on each category's metadata file,
+    running up to --jobs of these at once. Each category's output is written
+    to a directory named after the category in --output-dir; its log is
+    written next to this directory, as [category].log.
+
+    The exit status and run time of each category's job are printed at the
+    end, and saved to st2-jobs.tsv in --output-dir. If any of the jobs fail,
+    this command fails -- but only after all of the jobs have finished.
+
+    If --shards is more than 1, each shard of each category is run as a
+    separate job (named after its metadata file, e.g.
+    "animal-distal-gut-shard-1"). Once all of the jobs have succeeded, the
+    --merge-output files of each category's shards are merged, and written
+    to the category's directory in --output-dir.
+    """
+    from .utils import diagnostics_file
+    from .sourcetracking import (
+        DEFAULT_ST2_COMMAND,
+        merge_st_shards,
+        prepare_st_metadata,
+        run_st_jobs,
+    )
+
+    with diagnostics_file(None):
+        metadata_filepaths = prepare_st_metadata(
+            input_metadata_file,
+            output_dir,
+            list(categories),
+            list(host_ids),
+            source_prefix,
+            max_sources,
+            category_col,
+            host_col,
+            list(keep_cols),
+            prefixed_sinks,
+            io_backend,
+            shards,
+        )
+    try:
+        results = run_st_jobs(
+            metadata_filepaths,
+            feature_table,
+            output_dir,
+            command or DEFAULT_ST2_COMMAND,
+            category_col,
+            jobs,
+        )
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    num_failed = 0
+    for result in results:
+        status = "succeeded"
+        if result["exit_status"] != 0:
+            status = "failed (exit status {})".format(result["exit_status"])
+            num_failed += 1
+        print(
+            '"{}"{} {} after {} seconds; see {}.'.format(
+                result["category"],
+                " (shard {})".format(result["shard"]) if shards > 1 else "",
+                status,
+                result["seconds"],
+                result["log_file"],
+            )
+        )
+    if num_failed > 0:
+        raise click.ClickException(
+            "{} of {} SourceTracker2 job(s) failed.".format(
+                num_failed, len(results)
+            )
+        )
+    if shards > 1 and merge_outputs:
+        try:
+            merged_filepaths = merge_st_shards(
+                metadata_filepaths, output_dir, list(merge_outputs)
+            )
+        except (ImportError, OSError, ValueError) as e:
+            raise click.ClickException(
+                "Couldn't merge the shards' outputs: {}".format(e)
+            )
+        for merged_filepath in merged_filepaths:
+            print(
+                "Merged the shards' outputs into {}.".format(merged_filepath)
+            )
@@ -0,0 +1,395 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+from dateutil.parser import parse
+from .utils import read_table
+
+
+EXCEL_EXTENSIONS = (".xls", ".xlsx", ".xlsm", ".xlsb", ".odf", ".ods", ".odt")
+
+# Increment this whenever the format of key dates cache files changes
+_CACHE_VERSION = 2
+
+
+def _is_excel_file(filepath):
+    return filepath.lower().endswith(EXCEL_EXTENSIONS)
+
+
+def _read_key_dates_table(filepath):
+    """Reads a CSV/TSV file of key dates into a DataFrame indexed by date.
+
+       The first column's values are parsed with dateutil, the same way that
+       sample timestamps are parsed by add-diet. If any of these values can't
+       be parsed, the values are left as strings (and _check_key_dates() will
+       then complain about them).
+    """
+    df = read_table(filepath)
+    dates = df.iloc[:, 0]
+    try:
+        index = pd.DatetimeIndex([parse(d) for d in dates], name=dates.name)
+    except (ValueError, OverflowError):
+        index = pd.Index(dates)
+    kd = df.iloc[:, 1:]
+    kd.index = index
+    return kd
+
+
+def load_key_dates(filepath):
+    """Loads a key dates spreadsheet into a DataFrame indexed by date.
+
+       filepath can be either an Excel spreadsheet (in which case only its
+       first sheet is used) or a CSV/TSV file (see utils.read_table()). In
+       either case, the first column should contain dates.
+    """
+    if _is_excel_file(filepath):
+        return pd.read_excel(filepath, index_col=0)
+    return _read_key_dates_table(filepath)
+
+
+def load_key_dates_by_host(filepath):
+    """Loads key dates for multiple hosts from a file.
+
+       If filepath is an Excel workbook, see _split_key_dates_by_host() for
+       details on how its sheets are assigned to hosts. If filepath is a
+       CSV/TSV file, it must have a host_subject_id column.
+    """
+    if _is_excel_file(filepath):
+        sheets = pd.read_excel(filepath, sheet_name=None, index_col=0)
+    else:
+        sheets = {None: _read_key_dates_table(filepath)}
+    return _split_key_dates_by_host(sheets)
+
+
+def _split_key_dates_by_host(sheets):
+    """Splits up key dates DataFrames by host subject ID.
+
+       sheets should map sheet names to key dates DataFrames (i.e. the output
+       of pd.read_excel() with sheet_name=None). Each sheet can either contain
+       a host_subject_id column, in which case its rows are split up by host,
+       or not, in which case the sheet's name is used as the host subject ID
+       for all of its rows.
+
+       A sheet name of None means that the key dates came from a CSV/TSV
+       file, rather than from an Excel workbook; these key dates must have a
+       host_subject_id column.
+
+       Returns an OrderedDict mapping host subject IDs (as strings) to key
+       dates DataFrames.
+    """
+    key_dates_by_host = OrderedDict()
+    for sheet_name, kd in sheets.items():
+        if sheet_name is None and "host_subject_id" not in kd.columns:
+            raise ValueError(
+                "Key dates in CSV/TSV files must include a host_subject_id "
+                "column."
+            )
+        if "host_subject_id" in kd.columns:
+            host_ids = kd["host_subject_id"].astype(str).str.strip()
+            groups = kd.drop(columns="host_subject_id").groupby(
+                host_ids.to_numpy(), sort=False
+            )
+        else:
+            groups = [(str(sheet_name), kd)]
+        for host_id, host_kd in groups:
+            if host_id in key_dates_by_host:
+                raise ValueError(
+                    "Host {} has key dates in multiple sheets.".format(host_id)
+                )
+            key_dates_by_host[host_id] = host_kd
+    return key_dates_by_host
+
+
+def _check_key_dates(key_dates_df):
+    """Checks that a key dates DataFrame looks reasonable."""
+
+    # I didn't actually know this functionality existed until I saw this SO
+    # answer: https://stackoverflow.com/a/57187654/10730311
+    if not pd.api.types.is_datetime64_any_dtype(key_dates_df.index):
+        raise ValueError(
+            "First column of the key dates spreadsheet must contain "
+            "dates/timestamps"
+        )
+    if "Event" not in key_dates_df.columns:
+        raise ValueError(
+            'Key dates spreadsheet must contain an "Event" column'
+        )
+
+
+def _find_phase_names(key_dates_df):
+    """Returns the names of all phases with "Started PHASENAME" events.
+
+       Names are returned in the order in which they're first started.
+    """
+    _check_key_dates(key_dates_df)
+    names = key_dates_df["Event"].str.extract(
+        r"^\s*Started\s+(.*\S)\s*$", expand=False
+    )
+    return list(pd.unique(names.dropna()))
+
+
+def _get_phase_events(key_dates_df, verb, phase_name, exact):
+    """Returns the rows of the key dates with "[verb] [phase_name]" events."""
+    events = key_dates_df["Event"]
+    if exact:
+        pattern = r"^\s*{}\s+{}\s*$".format(verb, re.escape(phase_name))
+        return key_dates_df.loc[events.str.match(pattern, na=False)]
+    return key_dates_df.loc[
+        events.str.find("{} {}".format(verb, phase_name)) >= 0
+    ]
+
+
+def find_phase_intervals(key_dates_df, phase_name, exact=False):
+    """Finds and validates the date ranges of a dietary phase.
+
+       By default, any event containing "Started [phase_name]" (or "Stopped
+       [phase_name]") counts. If exact is True, events have to match these
+       exactly (ignoring whitespace): this is needed when the phase names
+       were found using _find_phase_names(), since otherwise the ranges of
+       e.g. a "keto lite" phase would also be counted as "keto" ranges.
+
+       Returns a tuple of (starts, stops): two sorted np.ndarrays of
+       datetime64[D] dates, where the i-th range of the phase starts on
+       starts[i] (inclusive) and stops on stops[i] (exclusive). The ranges are
+       guaranteed not to overlap.
+    """
+
+    # Validate the key dates spreadsheet, somewhat
+    kd = key_dates_df
+    _check_key_dates(kd)
+
+    # Determine ranges for starting/stopping a given diet (this requires a
+    # decent amount of validation)
+    starting_dates = _get_phase_events(kd, "Started", phase_name, exact)
+    if len(starting_dates.index) < 1:
+        raise ValueError("No starting dates for the specified phase given")
+
+    stopping_dates = _get_phase_events(kd, "Stopped", phase_name, exact)
+    if len(stopping_dates.index) < 1:
+        raise ValueError("No stopping dates for the specified phase given")
+
+    if len(starting_dates.index) != len(stopping_dates.index):
+        raise ValueError(
+            "Number of starting/stopping dates must be consistent (if the "
+            "phase continues to the final sample, then you'll need to add a "
+            "stoppping row for the day of or after that sample)"
+        )
+
+    # We now know that we have an equal (and >= 1) number of starting and
+    # stopping dates, but we'd like to know if the dates actually make sense.
+    #
+    # This necessitates checking that every stopping date occurs later than its
+    # corresponding starting date, *and* ensuring that every starting date
+    # occurs later than the previous stopping date (i.e. the ranges are in
+    # chronological order)
+    #
+    # You can think of this graphically as something like:
+    #
+    # A1---B1 A2--B2     A3B3 A4-----B4  A5-B5 A6--B6
+    #
+    # where each A is a starting date and each B is a stopping date. Notice how
+    # these ranges are not overlapping, so they can just be represented as a
+    # single line -- this is what we're checking for here.
+    #
+    # NOTE: we convert the dates to datetime64[D] to just get the date, not
+    # the timestamp, of datetimes. This lets us do comparisons only down to
+    # the day level.
+    starts = starting_dates.index.to_numpy().astype("M8[D]")
+    stops = stopping_dates.index.to_numpy().astype("M8[D]")
+    for i in range(len(starts)):
+        da = starts[i]
+        db = stops[i]
+        if da >= db:
+            raise ValueError(
+                "Starting date {} occurs later or on same day as "
+                "corresponding stopping date {}.".format(da, db)
+            )
+        if i > 0:
+            prev_db = stops[i - 1]
+            if da <= prev_db:
+                raise ValueError(
+                    "Starting date {} occurs earlier or on same day as "
+                    "previous stopping date {}.".format(da, prev_db)
+                )
+
+    return starts, stops
+
+
+def _find_all_phase_intervals(key_dates_by_host):
+    """Finds and validates the ranges of every phase started for every host.
+
+       Returns an OrderedDict mapping host subject IDs to OrderedDicts
+       mapping phase names to (starts, stops) tuples (see
+       find_phase_intervals()).
+    """
+    phase_intervals = OrderedDict()
+    for host_id, kd in key_dates_by_host.items():
+        phase_intervals[host_id] = OrderedDict(
+            (p, find_phase_intervals(kd, p, exact=True))
+            for p in _find_phase_names(kd)
+        )
+    if not any(phase_intervals.values()):
+        raise ValueError(
+            'No "Started PHASENAME" events found in the key dates.'
+        )
+    return phase_intervals
+
+
+def _summarize_phase_intervals(phase_intervals):
+    """Returns a one-line summary of the ranges of some dietary phases.
+
+       (Rather than printing a line for each host and phase, which for
+       add-diet-batch could be thousands of lines.)
+    """
+    num_ranges = 0
+    phase_names = set()
+    for host_intervals in phase_intervals.values():
+        for phase_name, (starts, stops) in host_intervals.items():
+            num_ranges += len(starts)
+            phase_names.add(phase_name)
+    if len(phase_intervals) == 1 and len(phase_names) == 1:
+        return 'Found {} ranges for the "{}" dietary phase.'.format(
+            num_ranges, phase_names.pop()
+        )
+    return "Found {} ranges of {} dietary phases for {} hosts.".format(
+        num_ranges, len(phase_names), len(phase_intervals)
+    )
+
+
+def _get_file_signature(filepath):
+    """Returns a file's modification time (in ns) and SHA-256 hash."""
+
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return os.stat(filepath).st_mtime_ns, sha256.hexdigest()
+
+
+def _load_interval_cache(cache_filepath, signature):
+    """Loads the phase intervals saved in a cache file.
+
+       Returns a dict mapping request keys (see load_phase_intervals()) to
+       phase intervals. If the cache file doesn't exist, or if it was created
+       from a different version of the key dates file, this returns an empty
+       dict.
+    """
+    if not os.path.exists(cache_filepath):
+        return {}
+    with np.load(cache_filepath, allow_pickle=False) as data:
+        info = json.loads(data["info"].item())
+        dates = data["dates"]
+    if (
+        info["version"] != _CACHE_VERSION
+        or info["mtime_ns"] != signature[0]
+        or info["sha256"] != signature[1]
+    ):
+        return {}
+
+    requests = {}
+    pos = 0
+    for request_key, entries in info["requests"]:
+        phase_intervals = OrderedDict()
+        for host_id, phase_name, num_ranges in entries:
+            mid = pos + num_ranges
+            end = mid + num_ranges
+            phase_intervals.setdefault(host_id, OrderedDict())[phase_name] = (
+                dates[pos:mid],
+                dates[mid:end],
+            )
+            pos = end
+        requests[request_key] = phase_intervals
+    return requests
+
+
+def _save_interval_cache(cache_filepath, signature, requests):
+    """Saves phase intervals to a cache file.
+
+       The cache is a NumPy .npz file containing all of the start/stop dates
+       in a single datetime64[D] array, along with a small JSON description
+       of which dates belong to which host and phase.
+    """
+    all_dates = [np.array([], dtype="M8[D]")]
+    request_entries = []
+    for request_key, phase_intervals in requests.items():
+        entries = []
+        for host_id, host_intervals in phase_intervals.items():
+            for phase_name, (starts, stops) in host_intervals.items():
+                entries.append([host_id, phase_name, len(starts)])
+                all_dates.extend([starts, stops])
+        request_entries.append([request_key, entries])
+    info = {
+        "version": _CACHE_VERSION,
+        "mtime_ns": signature[0],
+        "sha256": signature[1],
+        "requests": request_entries,
+    }
+    # Use a file object, since np.savez() would otherwise add a .npz
+    # extension to the filepath
+    with open(cache_filepath, "wb") as f:
+        np.savez(
+            f,
+            info=np.array(json.dumps(info)),
+            dates=np.concatenate(all_dates).astype("M8[D]"),
+        )
+
+
+def load_phase_intervals(
+    key_dates_file, host_subject_id=None, phase_name=None, cache_filepath=None
+):
+    """Loads and validates the date ranges of dietary phases from a file.
+
+       If host_subject_id and phase_name are given, key_dates_file is treated
+       as just containing this host's key dates (as in add-diet), and only
+       this phase's ranges are found. Otherwise, the key dates are split up
+       by host (see load_key_dates_by_host()), and the ranges of every phase
+       started for every host are found.
+
+       If cache_filepath is given, the validated ranges will be saved to this
+       file. Later calls using the same cache file (and the same arguments)
+       will then just load the ranges from the cache, without having to read
+       key_dates_file -- as long as key_dates_file's modification time and
+       contents haven't changed.
+
+       Returns
+       -------
+
+       OrderedDict
+            Maps host subject IDs to OrderedDicts mapping phase names to
+            (starts, stops) tuples (see find_phase_intervals()).
+    """
+    if (host_subject_id is None) != (phase_name is None):
+        raise ValueError(
+            "Either both or neither of host_subject_id and phase_name must be "
+            "given."
+        )
+
+    request_key = json.dumps([host_subject_id, phase_name])
+    requests = {}
+    if cache_filepath is not None:
+        signature = _get_file_signature(key_dates_file)
+        requests = _load_interval_cache(cache_filepath, signature)
+        if request_key in requests:
+            print("Using cached key dates from {}.".format(cache_filepath))
+            print(_summarize_phase_intervals(requests[request_key]))
+            return requests[request_key]
+
+    if host_subject_id is not None:
+        kd = load_key_dates(key_dates_file)
+        phase_intervals = OrderedDict()
+        phase_intervals[host_subject_id] = OrderedDict(
+            [(phase_name, find_phase_intervals(kd, phase_name))]
+        )
+    else:
+        phase_intervals = _find_all_phase_intervals(
+            load_key_dates_by_host(key_dates_file)
+        )
+    print(_summarize_phase_intervals(phase_intervals))
+
+    if cache_filepath is not None:
+        requests[request_key] = phase_intervals
+        _save_interval_cache(cache_filepath, signature, requests)
+    return phase_intervals
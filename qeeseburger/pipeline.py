@@ -0,0 +1,180 @@
+import inspect
+import json
+from .add_timeseries_cols import _get_extra_cols
+from .add_host_ages import _get_host_age_cols
+from .add_dietary_phase import _get_dietary_phase_cols
+from .key_dates import load_phase_intervals
+from .utils import (
+    PROFILER,
+    TimestampColumn,
+    attach_cols,
+    load_metadata,
+    save_metadata,
+    get_md_directives,
+)
+
+
+# Each of these functions takes as input a metadata DataFrame, a
+# TimestampColumn of its collection_timestamp column (or None, if the metadata
+# doesn't have this column), and the transform's parameters from the pipeline
+# spec; and returns the new columns to add to the DataFrame (see
+# utils.attach_cols()). The parameters have the same names as the
+# corresponding command's options.
+def _run_add_ts_cols(metadata_df, timestamps):
+    return _get_extra_cols(metadata_df, timestamps=timestamps)
+
+
+def _run_add_host_ages(
+    metadata_df,
+    timestamps,
+    host_id_list=None,
+    host_birthday_list=None,
+    birthdays_file=None,
+    float_years=False,
+):
+    return _get_host_age_cols(
+        metadata_df,
+        host_id_list,
+        host_birthday_list,
+        float_years,
+        birthdays_file,
+        timestamps=timestamps,
+    )
+
+
+def _run_add_diet(
+    metadata_df,
+    timestamps,
+    host_subject_id,
+    phase_name,
+    key_dates_spreadsheet,
+    key_dates_cache=None,
+):
+    phase_intervals = load_phase_intervals(
+        key_dates_spreadsheet, host_subject_id, phase_name, key_dates_cache
+    )
+    return _get_dietary_phase_cols(metadata_df, phase_intervals, timestamps)
+
+
+def _run_add_diet_batch(
+    metadata_df, timestamps, key_dates_workbook, key_dates_cache=None
+):
+    phase_intervals = load_phase_intervals(
+        key_dates_workbook, cache_filepath=key_dates_cache
+    )
+    return _get_dietary_phase_cols(metadata_df, phase_intervals, timestamps)
+
+
+TRANSFORMS = {
+    "add-ts-cols": _run_add_ts_cols,
+    "add-host-ages": _run_add_host_ages,
+    "add-diet": _run_add_diet,
+    "add-diet-batch": _run_add_diet_batch,
+}
+
+
+def _check_spec(spec):
+    """Checks that a pipeline spec is formatted correctly.
+
+       This checks the transforms' names and parameters (so that typos in the
+       spec are caught before doing any actual work), but not the parameters'
+       values.
+    """
+    if not isinstance(spec, dict) or not isinstance(
+        spec.get("transforms"), list
+    ):
+        raise ValueError(
+            'Pipeline spec must be a mapping with a "transforms" list.'
+        )
+    if len(spec["transforms"]) == 0:
+        raise ValueError("Pipeline spec doesn't include any transforms.")
+
+    for i, t in enumerate(spec["transforms"], 1):
+        if not isinstance(t, dict) or "transform" not in t:
+            raise ValueError(
+                "Transform {} in the pipeline spec must be a mapping with a "
+                '"transform" key.'.format(i)
+            )
+        params = dict(t)
+        name = params.pop("transform")
+        if name not in TRANSFORMS:
+            raise ValueError(
+                'Transform {} in the pipeline spec, "{}", isn\'t one of: '
+                "{}".format(i, name, ", ".join(sorted(TRANSFORMS)))
+            )
+        try:
+            inspect.signature(TRANSFORMS[name]).bind(None, None, **params)
+        except TypeError as e:
+            raise ValueError(
+                'Transform {} in the pipeline spec ("{}") has invalid '
+                "parameters: {}".format(i, name, e)
+            )
+
+
+def load_spec(filepath):
+    """Loads and checks a pipeline spec from a JSON or YAML file.
+
+       Files with a .yml or .yaml extension are read as YAML (this requires
+       PyYAML to be installed); everything else is read as JSON.
+
+       The spec should look like this (written here as JSON):
+
+       {"transforms": [
+           {"transform": "add-ts-cols"},
+           {"transform": "add-host-ages", "birthdays_file": "bdays.tsv"},
+           {"transform": "add-diet", "host_subject_id": "ABC",
+            "phase_name": "keto", "key_dates_spreadsheet": "kd.xlsx"}
+       ]}
+
+       Each transform's "transform" value is the name of a command, and its
+       other values are that command's options, with dashes replaced by
+       underscores. (The input/output and I/O options of these commands
+       aren't used, since these are set for the whole pipeline.)
+    """
+    with open(filepath, "r") as f:
+        if filepath.lower().endswith((".yml", ".yaml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError(
+                    "PyYAML needs to be installed in order to read YAML "
+                    "pipeline specs."
+                )
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    _check_spec(spec)
+    return spec
+
+
+def run_pipeline(
+    input_metadata_file, spec, output_metadata_file, backend="native"
+):
+    """Applies all of the transforms in a pipeline spec to a metadata file.
+
+       The metadata file is only loaded and saved once, and each unique
+       collection_timestamp is only parsed once (by each kind of parser --
+       add-diet parses timestamps more leniently than the other commands).
+    """
+    _check_spec(spec)
+    with PROFILER.span("load metadata"):
+        m_df = load_metadata(input_metadata_file, backend)
+        directives = None
+        if backend == "native":
+            directives = get_md_directives(
+                input_metadata_file, include_types=True
+            )
+
+    timestamps = None
+    if "collection_timestamp" in m_df.columns:
+        timestamps = TimestampColumn(m_df["collection_timestamp"])
+
+    for t in spec["transforms"]:
+        params = dict(t)
+        name = params.pop("transform")
+        print('Running "{}"...'.format(name))
+        with PROFILER.span("transform: {}".format(name)):
+            attach_cols(m_df, TRANSFORMS[name](m_df, timestamps, **params))
+
+    with PROFILER.span("save metadata"):
+        save_metadata(m_df, output_metadata_file, backend, directives)
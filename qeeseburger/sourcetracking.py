@@ -0,0 +1,511 @@
+# Prepares metadata for running SourceTracker2 (through QIIME 2) in order to
+# detect misclassified samples: for each EMPO category, we write out a
+# metadata file containing a fixed set of "source" samples (e.g. from the
+# American Gut Project) and all of the "sink" samples of this category.
+import csv
+import os
+import re
+import shlex
+import subprocess
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from .utils import (
+    DIAGNOSTICS,
+    check_cols_present,
+    iter_md_chunks,
+    load_metadata,
+    read_md_header,
+    save_metadata,
+)
+
+
+DEFAULT_CATEGORIES = [
+    "Animal distal gut",
+    "Animal secretion",
+    "Animal surface",
+]
+# AGP sample IDs start with this (the AGP's Qiita study ID)
+DEFAULT_SOURCE_PREFIX = "10317."
+SOURCE_SINK_COL = "SourceSink"
+# What st2-fix-mcs.pbs ran for each category. See _get_st_job_args() for the
+# fields that can be used in these templates.
+DEFAULT_ST2_COMMAND = (
+    "qiime sourcetracker2 gibbs "
+    "--i-feature-table {feature_table} "
+    "--m-sample-metadata-file {metadata} "
+    "--p-source-category-column {category_col} "
+    "--p-source-sink-column SourceSink "
+    "--p-source-column-value Source "
+    "--p-sink-column-value Sink "
+    "--p-source-rarefaction-depth 0 "
+    "--p-sink-rarefaction-depth 0 "
+    "--output-dir {output_dir} "
+    "--p-no-loo "
+    "--verbose"
+)
+
+
+def get_category_slug(category):
+    """Converts a category to something usable in filenames.
+
+       For example, "Animal distal gut" becomes "animal-distal-gut".
+    """
+    return re.sub(r"[^a-z0-9]+", "-", category.lower()).strip("-")
+
+
+def _get_needed_cols(category_col, host_col, host_ids, keep_cols):
+    needed_cols = [category_col]
+    if host_ids:
+        needed_cols.append(host_col)
+    for col in keep_cols:
+        if col not in needed_cols:
+            needed_cols.append(col)
+    return needed_cols
+
+
+def load_st_metadata(
+    filepath,
+    category_col="empo_3",
+    host_col="coarse_host_id",
+    host_ids=None,
+    keep_cols=(),
+    backend="native",
+):
+    """Loads just the columns of a metadata file needed for SourceTracker2.
+
+       These are category_col, host_col (if host_ids are given), and
+       keep_cols. With the "native" backend, only these columns are read from
+       the file.
+    """
+    needed_cols = _get_needed_cols(category_col, host_col, host_ids, keep_cols)
+    if backend == "native":
+        header, _ = read_md_header(filepath)
+        check_cols_present(pd.DataFrame(columns=header[1:]), set(needed_cols))
+        return next(iter_md_chunks(filepath, usecols=needed_cols))
+    metadata_df = load_metadata(filepath, backend)
+    check_cols_present(metadata_df, set(needed_cols))
+    return metadata_df[needed_cols]
+
+
+def get_st_subsets(
+    metadata_df,
+    categories=DEFAULT_CATEGORIES,
+    host_ids=None,
+    source_prefix=DEFAULT_SOURCE_PREFIX,
+    max_sources=100,
+    category_col="empo_3",
+    host_col="coarse_host_id",
+    keep_cols=(),
+    prefixed_sinks=False,
+):
+    """Selects the source and sink samples for each category.
+
+       The sources are the same for every category: for each category, the
+       (at most) max_sources samples in this category whose IDs start with
+       source_prefix, in sorted order.
+
+       The sinks of a category are all of the samples in this category
+       (other than the selected sources) whose host_col value is one of
+       host_ids. If host_ids is None or empty, all of the samples in the
+       category (other than the selected sources) are sinks.
+
+       Samples whose IDs start with source_prefix, but that weren't selected
+       as sources (since their category already had max_sources sources),
+       aren't sinks either -- otherwise, there could be thousands of e.g.
+       American Gut Project samples in each category's sinks. If
+       prefixed_sinks is True, these samples can be sinks (this is what
+       prepare_for_sourcetracking.py used to do).
+
+       Returns
+       -------
+
+       OrderedDict mapping each category to a DataFrame of its sources and
+       then its sinks. Each DataFrame only contains category_col, keep_cols,
+       and a SOURCE_SINK_COL column (set to "Source" or "Sink").
+    """
+    needed_cols = _get_needed_cols(category_col, host_col, host_ids, keep_cols)
+    check_cols_present(metadata_df, set(needed_cols))
+    if SOURCE_SINK_COL in keep_cols:
+        raise ValueError(
+            "The {} column is added by this command, so it can't be "
+            "kept.".format(SOURCE_SINK_COL)
+        )
+    if len(categories) == 0:
+        raise ValueError("At least one category must be given.")
+    if len(set(categories)) < len(categories):
+        raise ValueError("Categories must be unique.")
+
+    # Group the samples by category once, rather than filtering the entire
+    # DataFrame for each category. Samples that aren't in any of the
+    # categories (with a category index of -1) are sorted to the start.
+    cat_indices = pd.Index(categories).get_indexer(metadata_df[category_col])
+    in_a_category = cat_indices >= 0
+    num_irrelevant = len(cat_indices) - in_a_category.sum()
+    order = np.argsort(cat_indices, kind="stable")[num_irrelevant:]
+    cat_counts = np.bincount(
+        cat_indices[in_a_category], minlength=len(categories)
+    )
+    cat_positions = np.split(order, np.cumsum(cat_counts)[:-1])
+
+    sample_ids = metadata_df.index.to_numpy(dtype=object).astype(str)
+    is_source_candidate = np.char.startswith(sample_ids, source_prefix)
+    if host_ids:
+        is_host_sample = metadata_df[host_col].isin(host_ids).to_numpy()
+    else:
+        is_host_sample = np.ones(len(sample_ids), dtype=bool)
+
+    # 1. Select the sources from each category
+    source_positions = []
+    for category, positions in zip(categories, cat_positions):
+        candidates = positions[is_source_candidate[positions]]
+        candidates = candidates[np.argsort(sample_ids[candidates])]
+        source_positions.append(candidates[:max_sources])
+        print(
+            'Selected {} source sample(s) from "{}".'.format(
+                len(source_positions[-1]), category
+            )
+        )
+    source_positions = np.concatenate(source_positions)
+    is_source = np.zeros(len(sample_ids), dtype=bool)
+    is_source[source_positions] = True
+
+    # 2. Combine these with each category's sinks
+    is_sink_candidate = is_host_sample & ~is_source
+    if not prefixed_sinks:
+        is_sink_candidate &= ~is_source_candidate
+    output_df = metadata_df[
+        [category_col] + [c for c in keep_cols if c != category_col]
+    ]
+    subsets = OrderedDict()
+    no_sinks = []
+    for category, positions in zip(categories, cat_positions):
+        sink_positions = positions[is_sink_candidate[positions]]
+        print(
+            'Found {} sink sample(s) for "{}".'.format(
+                len(sink_positions), category
+            )
+        )
+        if len(sink_positions) == 0:
+            no_sinks.append(category)
+        subset_df = output_df.iloc[
+            np.concatenate([source_positions, sink_positions])
+        ].copy()
+        subset_df[SOURCE_SINK_COL] = np.repeat(
+            ["Source", "Sink"], [len(source_positions), len(sink_positions)]
+        )
+        subsets[category] = subset_df
+    DIAGNOSTICS.record(
+        "category without sinks",
+        no_sinks,
+        "None of this category's samples are sinks.",
+    )
+    return subsets
+
+
+def shard_st_subset(subset_df, num_shards):
+    """Splits a category's sources and sinks into multiple subsets.
+
+       Each shard contains all of the sources, and a contiguous range of the
+       sinks (sorted by sample ID, so that the shards don't depend on the
+       order of the samples in the metadata file). If there are fewer sinks
+       than num_shards, each sink gets its own shard. Returns a list of
+       DataFrames.
+    """
+    if num_shards == 1:
+        return [subset_df]
+    is_sink = subset_df[SOURCE_SINK_COL].to_numpy() == "Sink"
+    source_positions = np.flatnonzero(~is_sink)
+    sink_positions = np.flatnonzero(is_sink)
+    sink_ids = subset_df.index.to_numpy(dtype=object)[sink_positions]
+    sink_positions = sink_positions[np.argsort(sink_ids.astype(str))]
+    num_shards = max(min(num_shards, len(sink_positions)), 1)
+    bounds = np.linspace(0, len(sink_positions), num_shards + 1).astype(int)
+    return [
+        subset_df.iloc[np.concatenate([source_positions, sink_positions[a:b]])]
+        for a, b in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def write_st_subsets(subsets, output_dir, backend="native", shards=1):
+    """Writes each category's subset to output_dir, as [category slug].tsv.
+
+       If shards is greater than 1, each category's subset is split up using
+       shard_st_subset(), and each shard is written to
+       [category slug]-shard-[shard number].tsv (where shards are numbered
+       starting from 1).
+
+       backend is the metadata I/O backend to use: see utils.save_metadata().
+       Returns an OrderedDict mapping each category to a list of its files'
+       paths (one per shard).
+    """
+    slugs = [get_category_slug(category) for category in subsets]
+    if len(set(slugs)) < len(slugs):
+        raise ValueError(
+            "Some categories would be written to the same file: please "
+            "make sure that the categories' names differ in more than just "
+            "punctuation and capitalization."
+        )
+    filepaths = OrderedDict()
+    for slug, (category, subset_df) in zip(slugs, subsets.items()):
+        filepaths[category] = []
+        for i, shard_df in enumerate(shard_st_subset(subset_df, shards), 1):
+            filename = "{}.tsv".format(slug)
+            if shards > 1:
+                filename = "{}-shard-{}.tsv".format(slug, i)
+            filepaths[category].append(os.path.join(output_dir, filename))
+            save_metadata(shard_df, filepaths[category][-1], backend)
+    return filepaths
+
+
+def prepare_st_metadata(
+    input_metadata_file,
+    output_dir,
+    categories=DEFAULT_CATEGORIES,
+    host_ids=None,
+    source_prefix=DEFAULT_SOURCE_PREFIX,
+    max_sources=100,
+    category_col="empo_3",
+    host_col="coarse_host_id",
+    keep_cols=(),
+    prefixed_sinks=False,
+    backend="native",
+    shards=1,
+):
+    """Writes each category's sources and sinks from a metadata file.
+
+       See get_st_subsets() and write_st_subsets() for details. output_dir
+       is created if it doesn't already exist. Returns an OrderedDict mapping
+       each category to a list of its metadata files' paths.
+    """
+    metadata_df = load_st_metadata(
+        input_metadata_file,
+        category_col,
+        host_col,
+        host_ids,
+        keep_cols,
+        backend,
+    )
+    subsets = get_st_subsets(
+        metadata_df,
+        categories,
+        host_ids,
+        source_prefix,
+        max_sources,
+        category_col,
+        host_col,
+        keep_cols,
+        prefixed_sinks,
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    return write_st_subsets(subsets, output_dir, backend, shards)
+
+
+def _get_job_name(metadata_filepath):
+    """E.g. "out/animal-distal-gut-shard-2.tsv" -> "animal-distal-gut-shard-2".
+    """
+    return os.path.splitext(os.path.basename(metadata_filepath))[0]
+
+
+def _fill_in_template(template, fields):
+    try:
+        return template.format(**fields)
+    except (KeyError, IndexError) as e:
+        raise ValueError(
+            "Unrecognized field in template {!r}: {}".format(template, e)
+        )
+
+
+def _get_st_job_args(command, fields):
+    """Fills in a command template, and splits it into arguments.
+
+       The template is split up (like a shell would) before its fields are
+       filled in, so fields containing spaces (like category names) are
+       still passed as single arguments. The fields available are:
+
+       - {category}: the category's name (e.g. "Animal distal gut")
+       - {slug}: the category's slug (e.g. "animal-distal-gut")
+       - {shard}: the shard number (starting from 1) of this job's metadata
+       - {metadata}: the filepath of this job's metadata file
+       - {category_col}: the metadata column containing the categories
+       - {feature_table}: the feature table filepath (which may itself use
+         {slug} or {category}, e.g. "{slug}-table.qza")
+       - {output_dir}: the directory this job should write its output to
+    """
+    return [_fill_in_template(arg, fields) for arg in shlex.split(command)]
+
+
+def _run_st_job(category, shard, args, log_filepath):
+    """Runs a command, logging its output. Returns the job's results."""
+    start_time = time.perf_counter()
+    with open(log_filepath, "w") as log:
+        try:
+            exit_status = subprocess.call(
+                args, stdout=log, stderr=subprocess.STDOUT
+            )
+        except OSError as e:
+            # E.g. the command doesn't exist. Use the same exit status a
+            # shell would.
+            log.write("{}\n".format(e))
+            exit_status = 127
+    return OrderedDict(
+        [
+            ("category", category),
+            ("shard", shard),
+            ("exit_status", exit_status),
+            ("seconds", round(time.perf_counter() - start_time, 3)),
+            ("log_file", log_filepath),
+        ]
+    )
+
+
+def run_st_jobs(
+    metadata_filepaths,
+    feature_table,
+    output_dir,
+    command=DEFAULT_ST2_COMMAND,
+    category_col="empo_3",
+    jobs=1,
+):
+    """Runs SourceTracker2 (or another command) on each metadata file.
+
+       metadata_filepaths should map categories to lists of their metadata
+       files (one per shard), as returned by write_st_subsets(). Each
+       metadata file's job runs command (see _get_st_job_args()), writing its
+       output to [output_dir]/[job name] and its stdout/stderr to
+       [output_dir]/[job name].log, where the job name is the metadata
+       file's name without its extension (e.g. "animal-distal-gut").
+
+       If jobs is greater than 1, up to this many jobs are run at once. Each
+       job's command runs in its own process anyway, so these are started
+       from a pool of threads (which just wait for the commands to finish).
+
+       Returns a list of each job's results (in the same order as
+       metadata_filepaths), which are also written to
+       [output_dir]/st2-jobs.tsv. Jobs that fail don't stop the other jobs
+       from running: check each job's exit_status.
+    """
+    job_categories = []
+    job_shards = []
+    job_args = []
+    log_filepaths = []
+    for category, filepaths in metadata_filepaths.items():
+        slug = get_category_slug(category)
+        for shard, filepath in enumerate(filepaths, 1):
+            fields = {"category": category, "slug": slug, "shard": shard}
+            fields["feature_table"] = _fill_in_template(feature_table, fields)
+            fields["metadata"] = filepath
+            fields["category_col"] = category_col
+            job_name = _get_job_name(filepath)
+            fields["output_dir"] = os.path.join(output_dir, job_name)
+            job_categories.append(category)
+            job_shards.append(shard)
+            job_args.append(_get_st_job_args(command, fields))
+            log_filepaths.append(os.path.join(output_dir, job_name + ".log"))
+
+    all_job_params = (job_categories, job_shards, job_args, log_filepaths)
+    if jobs > 1 and len(job_args) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_run_st_job, *all_job_params))
+    else:
+        results = list(map(_run_st_job, *all_job_params))
+
+    with open(os.path.join(output_dir, "st2-jobs.tsv"), "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(list(results[0].keys()))
+        for result in results:
+            writer.writerow(list(result.values()))
+    return results
+
+
+def _load_st_table(filepath):
+    """Loads a table output by SourceTracker2 as a DataFrame.
+
+       .qza files are loaded using QIIME 2 (which needs to be installed).
+       Other files are read as TSV files, keeping their values as strings;
+       the "# Constructed from biom file" line that biom adds to the start of
+       exported tables is skipped.
+
+       Returns (table, semantic type), where the semantic type is None for
+       TSV files.
+    """
+    if filepath.endswith(".qza"):
+        from qiime2 import Artifact
+
+        artifact = Artifact.load(filepath)
+        return artifact.view(pd.DataFrame), artifact.type
+
+    with open(filepath, "r") as f:
+        skiprows = int(f.readline().startswith("# Constructed from biom"))
+    table = pd.read_csv(
+        filepath,
+        sep="\t",
+        index_col=0,
+        skiprows=skiprows,
+        dtype=str,
+        keep_default_na=False,
+    )
+    return table, None
+
+
+def _merge_shard_tables(tables):
+    """Combines the tables (e.g. of mixing proportions) of a category's shards.
+
+       Since each shard has the same sources but different sinks, the tables
+       are concatenated along whichever axis they have different labels for
+       (SourceTracker2's tables have sinks as rows, but exported QIIME 2
+       tables have them as columns).
+    """
+    first = tables[0]
+    if all(set(t.columns) == set(first.columns) for t in tables):
+        merged = pd.concat([t[first.columns] for t in tables])
+        if merged.index.is_unique:
+            return merged
+    if all(set(t.index) == set(first.index) for t in tables):
+        merged = pd.concat([t.loc[first.index] for t in tables], axis=1)
+        if merged.columns.is_unique:
+            return merged
+    raise ValueError(
+        "The shards' tables don't have the same sources, or have some of the "
+        "same sinks."
+    )
+
+
+def merge_st_shards(metadata_filepaths, output_dir, filenames):
+    """Merges the outputs of each category's shards' SourceTracker2 runs.
+
+       For each category in metadata_filepaths (see run_st_jobs()), and each
+       filename in filenames (e.g. "mixing_proportions.qza"), the tables in
+       [output_dir]/[job name]/[filename] for each of the category's shards
+       are merged into a single table, and written to
+       [output_dir]/[category slug]/[filename] -- the same place where this
+       table would be if the category's sinks weren't split into shards.
+
+       Returns a list of the merged tables' filepaths.
+    """
+    merged_filepaths = []
+    for category, filepaths in metadata_filepaths.items():
+        category_dir = os.path.join(output_dir, get_category_slug(category))
+        os.makedirs(category_dir, exist_ok=True)
+        for filename in filenames:
+            tables = []
+            for filepath in filepaths:
+                job_dir = os.path.join(output_dir, _get_job_name(filepath))
+                table, semantic_type = _load_st_table(
+                    os.path.join(job_dir, filename)
+                )
+                tables.append(table)
+            merged = _merge_shard_tables(tables)
+            merged_filepath = os.path.join(category_dir, filename)
+            if semantic_type is None:
+                merged.to_csv(merged_filepath, sep="\t")
+            else:
+                from qiime2 import Artifact
+
+                Artifact.import_data(semantic_type, merged).save(
+                    merged_filepath
+                )
+            merged_filepaths.append(merged_filepath)
+    return merged_filepaths
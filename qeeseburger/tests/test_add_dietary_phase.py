@@ -0,0 +1,201 @@
+import pytest
+import numpy as np
+import pandas as pd
+from ..add_dietary_phase import (
+    _add_dietary_phase,
+    _add_dietary_phases,
+    _classify_sample_dates,
+)
+from ..key_dates import (
+    find_phase_intervals,
+    _split_key_dates_by_host,
+    _find_all_phase_intervals,
+)
+from ..utils import DIAGNOSTICS
+
+
+def get_key_dates(dates, events):
+    return pd.DataFrame({"Event": events}, index=pd.to_datetime(dates))
+
+
+def get_test_data():
+    kd = get_key_dates(
+        [
+            "2019-02-01",
+            "2019-02-10",
+            "2019-02-15",
+            "2019-03-01",
+            "2019-03-05",
+        ],
+        [
+            "Started keto",
+            "Stopped keto",
+            "Moved to a new city",
+            "Started keto again",
+            "Stopped keto",
+        ],
+    )
+    md = pd.DataFrame(
+        {
+            "host_subject_id": ["ABC", "ABC", "ABC", "ABC", "ABC", "DEF"],
+            "collection_timestamp": [
+                "2019-01-31",  # before the first range
+                "2019-02-01",  # start dates are inclusive
+                "2019-02-10",  # stop dates are exclusive
+                "3/4/2019",  # in the second range
+                "2019-03-10 12:30",  # after the last range
+                "2019-02-05",  # different host
+            ],
+        },
+        index=["S1", "S2", "S3", "S4", "S5", "S6"],
+    )
+    return md, kd
+
+
+def test_good():
+    md, kd = get_test_data()
+    new_md = _add_dietary_phase(md, "ABC", "keto", kd)
+    assert list(new_md["keto"]) == [
+        "FALSE",
+        "TRUE",
+        "FALSE BUT TAKEN AFTER DIET START",
+        "TRUE",
+        "FALSE BUT TAKEN AFTER DIET START",
+        "not applicable",
+    ]
+    # The input DataFrame shouldn't be modified
+    assert "keto" not in md.columns
+
+
+def test_classify_sample_dates_no_samples():
+    starts, stops = find_phase_intervals(get_test_data()[1], "keto")
+    labels = _classify_sample_dates(np.array([], dtype="M8[D]"), starts, stops)
+    assert len(labels) == 0
+
+
+def test_phase_column_already_present():
+    md, kd = get_test_data()
+    md["keto"] = "something"
+    with pytest.raises(ValueError) as einfo:
+        _add_dietary_phase(md, "ABC", "keto", kd)
+    assert "A keto column already exists" in str(einfo.value)
+
+
+def test_inconsistent_number_of_dates():
+    kd = get_key_dates(
+        ["2019-02-01", "2019-02-10", "2019-03-01"],
+        ["Started keto", "Stopped keto", "Started keto"],
+    )
+    with pytest.raises(ValueError) as einfo:
+        _add_dietary_phase(get_test_data()[0], "ABC", "keto", kd)
+    assert "Number of starting/stopping dates must be" in str(einfo.value)
+
+
+def test_stop_before_start():
+    kd = get_key_dates(
+        ["2019-02-10", "2019-02-01"], ["Started keto", "Stopped keto"]
+    )
+    with pytest.raises(ValueError) as einfo:
+        _add_dietary_phase(get_test_data()[0], "ABC", "keto", kd)
+    assert (
+        "Starting date 2019-02-10 occurs later or on same day as "
+        "corresponding stopping date 2019-02-01." in str(einfo.value)
+    )
+
+
+def test_overlapping_ranges():
+    kd = get_key_dates(
+        ["2019-02-01", "2019-02-10", "2019-02-10", "2019-02-20"],
+        ["Started keto", "Stopped keto", "Started keto", "Stopped keto"],
+    )
+    with pytest.raises(ValueError) as einfo:
+        _add_dietary_phase(get_test_data()[0], "ABC", "keto", kd)
+    assert (
+        "Starting date 2019-02-10 occurs earlier or on same day as "
+        "previous stopping date 2019-02-10." in str(einfo.value)
+    )
+
+
+def get_multi_host_key_dates():
+    kd = get_key_dates(
+        [
+            "2019-02-01",
+            "2019-02-03",
+            "2019-02-10",
+            "2019-02-15",
+            "2019-02-01",
+            "2019-02-06",
+        ],
+        [
+            "Started keto",
+            "Started antibiotics",
+            "Stopped keto",
+            "Stopped antibiotics",
+            "Started keto",
+            "Stopped keto",
+        ],
+    )
+    kd["host_subject_id"] = ["ABC", "ABC", "ABC", "ABC", "DEF", "DEF"]
+    return kd
+
+
+def test_add_dietary_phases():
+    md = get_test_data()[0]
+    by_host = _split_key_dates_by_host({"Sheet1": get_multi_host_key_dates()})
+    new_md = _add_dietary_phases(md, _find_all_phase_intervals(by_host))
+    assert list(new_md.columns[-2:]) == ["keto", "antibiotics"]
+    assert list(new_md["keto"]) == [
+        "FALSE",
+        "TRUE",
+        "FALSE BUT TAKEN AFTER DIET START",
+        "FALSE BUT TAKEN AFTER DIET START",
+        "FALSE BUT TAKEN AFTER DIET START",
+        "TRUE",
+    ]
+    # DEF never started antibiotics
+    assert list(new_md["antibiotics"]) == [
+        "FALSE",
+        "FALSE",
+        "TRUE",
+        "FALSE BUT TAKEN AFTER DIET START",
+        "FALSE BUT TAKEN AFTER DIET START",
+        "not applicable",
+    ]
+    # Adding a single phase for a single host should give the same results as
+    # add-diet
+    for host_id in ("ABC", "DEF"):
+        single_md = _add_dietary_phases(
+            md,
+            {
+                host_id: {
+                    "keto": find_phase_intervals(by_host[host_id], "keto")
+                }
+            },
+        )
+        assert single_md.equals(
+            _add_dietary_phase(md, host_id, "keto", by_host[host_id])
+        )
+
+
+def test_add_dietary_phases_diagnostics():
+    md, kd = get_test_data()
+    intervals = find_phase_intervals(kd, "keto")
+    # GHI has key dates but no samples; and none of DEF's samples are within
+    # its "keto" ranges (which are ABC's ranges, shifted a year back)
+    phase_intervals = {
+        "ABC": {"keto": intervals},
+        "DEF": {
+            "keto": tuple(d - np.timedelta64(365, "D") for d in intervals)
+        },
+        "GHI": {"keto": intervals},
+    }
+    DIAGNOSTICS.clear()
+    _add_dietary_phases(md, phase_intervals)
+    assert DIAGNOSTICS.examples == {
+        "key dates host not in metadata": [
+            ("GHI", "Host has key dates, but no samples in the metadata.")
+        ],
+        "no samples within a phase": [
+            ("DEF", 'None of the host\'s samples are within a "keto" range.')
+        ],
+    }
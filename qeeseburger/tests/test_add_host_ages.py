@@ -1,6 +1,11 @@
 import pytest
 import pandas as pd
-from ..add_host_ages import _add_host_ages
+from ..add_host_ages import (
+    _add_host_ages,
+    _get_host_age_cols,
+    _get_incremental_host_age_cols,
+)
+from ..utils import DIAGNOSTICS
 
 
 # TODO: test badly formatted dates in the dataset; test impossible birthdays
@@ -38,6 +43,7 @@ def test_good():
     assert new_md.at["S4", "host_age_years"] == "14"
     assert new_md.at["S5", "host_age_years"] == "2"
     assert new_md.at["S6", "host_age_years"] == "not applicable"
+    assert new_md["host_age_years"].dtype == "category"
 
 
 def test_no_ids_or_bdays_given():
@@ -74,3 +80,168 @@ def test_float_years():
     )
     new_md = _add_host_ages(md, "ABC", "1990-12-01", float_years=True)
     assert new_md.at["S1", "host_age"] == "4.9693"
+
+
+def test_leap_day_birthday():
+    # relativedelta treats a February 29th birthday as occurring on February
+    # 28th in non-leap years
+    md = pd.DataFrame(
+        {
+            "host_subject_id": ["ABC", "ABC", "ABC", "ABC"],
+            "collection_timestamp": [
+                "2001-02-27",
+                "2001-02-28",
+                "2004-02-28",
+                "2004-02-29",
+            ],
+        },
+        index=["S1", "S2", "S3", "S4"],
+    )
+    new_md = _add_host_ages(md, "ABC", "2000-02-29")
+    assert list(new_md["host_age_years"]) == ["0", "1", "3", "4"]
+
+
+def test_impossible_and_invalid_timestamps():
+    md = pd.DataFrame(
+        {
+            "host_subject_id": ["ABC", "ABC", "ABC"],
+            "collection_timestamp": ["1999-12-31", "not a date", "2001-05-06"],
+        },
+        index=["S1", "S2", "S3"],
+    )
+    DIAGNOSTICS.clear()
+    new_md = _add_host_ages(md, "ABC", "2000-05-06")
+    assert list(new_md["host_age_years"]) == [
+        "impossible",
+        "not applicable",
+        "1",
+    ]
+    assert DIAGNOSTICS.examples == {
+        "invalid collection_timestamp for host age": [
+            ("S2", "Timestamp 'not a date' couldn't be parsed.")
+        ],
+        "impossible host age": [
+            (
+                "S1",
+                "Timestamp date, 1999-12-31, occurs before the host birthday "
+                "date of 2000-05-06.",
+            )
+        ],
+    }
+
+
+@pytest.mark.parametrize(
+    "filename,sep", [("bdays.tsv", "\t"), ("bdays.csv.gz", ",")]
+)
+def test_birthdays_file(tmpdir, filename, sep):
+    bdays_fp = str(tmpdir.join(filename))
+    pd.DataFrame(
+        {
+            "host_subject_id": ["ABC", "DEF"],
+            "birthday": ["2000-05-06", "1993-02-18"],
+        }
+    ).to_csv(bdays_fp, sep=sep, index=False)
+    md = get_test_data()[0]
+    new_md = _add_host_ages(md, None, None, birthdays_file=bdays_fp)
+    assert new_md.equals(_add_host_ages(*get_test_data()))
+
+
+def write_bdays_file(tmpdir, lines):
+    bdays_fp = str(tmpdir.join("bdays.tsv"))
+    with open(bdays_fp, "w") as f:
+        f.write("host_subject_id\tbirthday\n")
+        f.write("".join(line + "\n" for line in lines))
+    return bdays_fp
+
+
+def test_birthdays_file_redundant_ids(tmpdir):
+    bdays_fp = write_bdays_file(
+        tmpdir, ["ABC\t2000-05-06", "DEF\t1993-02-18", "ABC\t2000-05-07"]
+    )
+    with pytest.raises(ValueError) as einfo:
+        _add_host_ages(get_test_data()[0], None, None, birthdays_file=bdays_fp)
+    assert "ABC is on lines 2, 4." in str(einfo.value)
+
+
+def test_birthdays_file_badly_formatted_bdays(tmpdir):
+    bdays_fp = write_bdays_file(
+        tmpdir, ["ABC\t2000-05-06", "DEF\tlol", "GHI\t2001-02-30"]
+    )
+    with pytest.raises(ValueError) as einfo:
+        _add_host_ages(get_test_data()[0], None, None, birthdays_file=bdays_fp)
+    assert "birthdays aren't correctly formatted" in str(einfo.value)
+    assert 'line(s) 3, 4 (e.g. "lol" for host DEF)' in str(einfo.value)
+
+
+def test_birthdays_file_blank_lines(tmpdir):
+    # Blank lines are skipped, but still count towards the line numbers
+    bdays_fp = write_bdays_file(
+        tmpdir, ["ABC\t2000-05-06", "", "\t", "DEF\tlol", ""]
+    )
+    with pytest.raises(ValueError) as einfo:
+        _add_host_ages(get_test_data()[0], None, None, birthdays_file=bdays_fp)
+    assert 'line(s) 5 (e.g. "lol" for host DEF)' in str(einfo.value)
+
+
+def test_birthdays_file_and_lists_given(tmpdir):
+    data = get_test_data()
+    bdays_fp = write_bdays_file(tmpdir, ["ABC\t2000-05-06"])
+    with pytest.raises(ValueError) as einfo:
+        _add_host_ages(*data, birthdays_file=bdays_fp)
+    assert "not both" in str(einfo.value)
+
+
+def test_incremental():
+    md, host_ids, host_bdays = get_test_data()
+    previous_md = _add_host_ages(md, host_ids, host_bdays).astype(str)
+    # Check that the previous values are actually reused, not recomputed
+    previous_md.loc["S1", "host_age_years"] = "reused"
+
+    # S2's timestamp changed, S3's host changed, S6 was removed, and S7 was
+    # added
+    md.loc["S2", "collection_timestamp"] = "1995-07-21"
+    md.loc["S3", "host_subject_id"] = "DEF"
+    md.loc["S7"] = ["ABC", "2020-05-06"]
+    md = md.drop("S6")
+    new_cols = _get_incremental_host_age_cols(
+        md, previous_md, host_ids, host_bdays
+    )
+    expected_ages = list(
+        _get_host_age_cols(md, host_ids, host_bdays)["host_age_years"]
+    )
+    expected_ages[0] = "reused"
+    assert list(new_cols["host_age_years"]) == list(expected_ages)
+    assert list(expected_ages[1:3]) == ["2", "20"]
+
+
+def get_diagnostics(func, *args):
+    DIAGNOSTICS.clear()
+    func(*args)
+    return dict(DIAGNOSTICS.counts), dict(DIAGNOSTICS.examples)
+
+
+def test_incremental_diagnostics():
+    md, host_ids, host_bdays = get_test_data()
+    # S8 was taken before its host's birthday, and S9's timestamp is invalid
+    md.loc["S8"] = ["ABC", "1999-01-01"]
+    md.loc["S9"] = ["DEF", "oops"]
+    previous_md = _add_host_ages(md, host_ids, host_bdays).astype(str)
+    # S10 is new, and also invalid
+    md.loc["S10"] = ["ABC", "2019"]
+
+    # The anomalies of the reused samples are still recorded
+    full = get_diagnostics(_get_host_age_cols, md, host_ids, host_bdays)
+    assert full[0] == {
+        "invalid collection_timestamp for host age": 2,
+        "impossible host age": 1,
+    }
+    assert (
+        get_diagnostics(
+            _get_incremental_host_age_cols,
+            md,
+            previous_md,
+            host_ids,
+            host_bdays,
+        )
+        == full
+    )
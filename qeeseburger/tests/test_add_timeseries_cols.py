@@ -1,6 +1,16 @@
+import tracemalloc
 import pytest
+import numpy as np
 import pandas as pd
-from ..add_timeseries_cols import _add_extra_cols
+from ..add_timeseries_cols import (
+    _add_extra_cols,
+    _get_extra_cols,
+    _get_incremental_extra_cols,
+    _derive_ts_cols,
+    _stream_add_extra_cols,
+    _batch_add_extra_cols,
+)
+from ..utils import DIAGNOSTICS, attach_cols, load_metadata, PARSE_CACHE
 
 
 def get_test_data():
@@ -22,7 +32,7 @@ def test_good():
     new_metadata_df = _add_extra_cols(get_test_data())
 
     # All of these timestamps are valid
-    assert new_metadata_df["is_collection_timestamp_valid"].all()
+    assert (new_metadata_df["is_collection_timestamp_valid"] == "True").all()
 
     # Check ordinal_timestamp values
     assert new_metadata_df.loc["S1", "ordinal_timestamp"] == "20140103"
@@ -86,3 +96,246 @@ def test_output_cols_in_input():
         assert (
             "already includes at least one of the following columns"
         ) in str(einfo.value)
+
+
+def test_nonexistent_date():
+    """Tests that timestamps describing impossible dates are invalid."""
+
+    m_df = get_test_data()
+    m_df.loc["S1", "collection_timestamp"] = "2014-02-30"
+    new_m_df = _add_extra_cols(m_df)
+
+    assert new_m_df.loc["S1", "is_collection_timestamp_valid"] == "False"
+    assert new_m_df.loc["S1", "ordinal_timestamp"] == "not applicable"
+    assert new_m_df.loc["S1", "days_since_first_day"] == "not applicable"
+    # The earliest valid date is now S2's date
+    assert new_m_df.loc["S2", "days_since_first_day"] == "0"
+    assert new_m_df.loc["S4", "days_since_first_day"] == "375"
+
+
+def test_no_valid_timestamps():
+    m_df = get_test_data()
+    m_df["collection_timestamp"] = "2012-10"
+    with pytest.raises(ValueError) as einfo:
+        _add_extra_cols(m_df)
+    assert "None of the collection_timestamp values are valid" in str(
+        einfo.value
+    )
+
+
+def test_derive_ts_cols():
+    valid = np.array([True, False, True, True])
+    dates = np.array(
+        ["2014-01-05", "NaT", "2014-01-03", "2014-01-05"], dtype="M8[D]"
+    )
+    cols = _derive_ts_cols(valid, dates, np.datetime64("2014-01-03"))
+    assert [c[0] for c in cols] == [
+        "is_collection_timestamp_valid",
+        "ordinal_timestamp",
+        "days_since_first_day",
+    ]
+    assert list(cols[0][1]) == ["True", "False", "True", "True"]
+    assert list(cols[1][1]) == [
+        "20140105",
+        "not applicable",
+        "20140103",
+        "20140105",
+    ]
+    assert list(cols[2][1]) == ["2", "not applicable", "0", "2"]
+    # Samples from the same day share the same string objects
+    assert cols[1][1][0] is cols[1][1][3]
+    assert cols[2][1][0] is cols[2][1][3]
+    for c in cols:
+        assert isinstance(c[1], pd.Categorical)
+
+
+def test_min_date_given():
+    new_m_df = _add_extra_cols(
+        get_test_data(), min_date=np.datetime64("2014-01-01")
+    )
+    assert new_m_df.loc["S1", "days_since_first_day"] == "2"
+    assert new_m_df.loc["S4", "days_since_first_day"] == "378"
+
+
+def get_updated_test_data():
+    # S2's timestamp changed, and S5 was added
+    m_df = get_test_data()
+    m_df.loc["S2", "collection_timestamp"] = "1/6/2014"
+    m_df.loc["S5"] = ["DEF", "2015-02-01"]
+    return m_df
+
+
+def test_incremental():
+    # (Previous outputs are loaded from a file, so their values are strings)
+    previous_m_df = _add_extra_cols(get_test_data()).astype(str)
+    # Check that the previous values are actually reused, not recomputed
+    previous_m_df.loc["S4", "ordinal_timestamp"] = "20150115"
+    previous_m_df.loc["S4", "days_since_first_day"] = "377"
+
+    m_df = get_updated_test_data()
+    PARSE_CACHE.clear()
+    new_cols = _get_incremental_extra_cols(m_df, previous_m_df)
+    assert PARSE_CACHE.misses == 2
+    expected_cols = _get_extra_cols(m_df)
+    assert list(new_cols.keys()) == list(expected_cols.keys())
+    for col in expected_cols:
+        expected_values = list(expected_cols[col])
+        if col != "is_collection_timestamp_valid":
+            expected_values[3] = {
+                "ordinal_timestamp": "20150115",
+                "days_since_first_day": "377",
+            }[col]
+        assert list(new_cols[col]) == expected_values
+
+
+def test_incremental_diagnostics():
+    m_df = get_test_data()
+    m_df.loc["S3", "collection_timestamp"] = "asdf"
+    previous_m_df = _add_extra_cols(m_df).astype(str)
+    m_df.loc["S5"] = ["DEF", "2015-02"]
+
+    # The invalid timestamps of the reused samples are still recorded, in the
+    # same order as in a full run
+    DIAGNOSTICS.clear()
+    _get_extra_cols(m_df)
+    expected = (dict(DIAGNOSTICS.counts), dict(DIAGNOSTICS.examples))
+    assert expected[0] == {"invalid collection_timestamp": 2}
+    DIAGNOSTICS.clear()
+    _get_incremental_extra_cols(m_df, previous_m_df)
+    assert (dict(DIAGNOSTICS.counts), dict(DIAGNOSTICS.examples)) == expected
+
+
+@pytest.mark.parametrize("first_timestamp", ["1/2/14", "1/4/14", "oops"])
+def test_incremental_min_date_changed(capsys, first_timestamp):
+    # S1 has the earliest date, so changing it moves the "first day"
+    previous_m_df = _add_extra_cols(get_test_data()).astype(str)
+    m_df = get_updated_test_data()
+    m_df.loc["S1", "collection_timestamp"] = first_timestamp
+    new_cols = _get_incremental_extra_cols(m_df, previous_m_df)
+    assert "The earliest date has changed" in capsys.readouterr().out
+    expected_cols = _get_extra_cols(m_df)
+    for col in expected_cols:
+        assert list(new_cols[col]) == list(expected_cols[col])
+
+
+def test_incremental_previous_output_lacks_cols():
+    with pytest.raises(ValueError) as einfo:
+        _get_incremental_extra_cols(get_test_data(), get_test_data())
+    assert "previous output file doesn't include" in str(einfo.value)
+
+
+def get_peak_memory(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_attach_cols_doesnt_copy():
+    # A wide metadata file, with lots of columns that aren't touched
+    m_df = get_test_data()
+    m_df = pd.concat([m_df] * 1000, ignore_index=True)
+    extra = pd.DataFrame(
+        {"col{}".format(i): ["value"] * len(m_df) for i in range(300)}
+    )
+    m_df = pd.concat([m_df, extra], axis=1)
+
+    copy_peak = get_peak_memory(m_df.copy)
+    attach_peak = get_peak_memory(
+        lambda df: attach_cols(df, _get_extra_cols(df)), m_df
+    )
+    assert attach_peak < 0.2 * copy_peak
+    assert list(m_df.columns[-3:]) == [
+        "is_collection_timestamp_valid",
+        "ordinal_timestamp",
+        "days_since_first_day",
+    ]
+
+
+def test_stream(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    output_fp = str(tmpdir.join("output.tsv"))
+    with open(input_fp, "w") as f:
+        f.write(
+            "# a comment\n"
+            "sample-id\thost_subject_id\tcollection_timestamp\n"
+            "#q2:types\tcategorical\tcategorical\n"
+            "S1\tABC\t1/3/14\n"
+            "S2\tDEF\t1/4/2014\n"
+            "# another comment\n"
+            "\n"
+            "S3\tABC\tasodifjoaisdjf\n"
+            "S4\tABC\t2015-01-14\n"
+            "S5\t\t12/31/2013\n"
+        )
+    # Use a small chunk size, so that the earliest date (in the last chunk)
+    # has to be found before the first chunk is written out
+    _stream_add_extra_cols(input_fp, output_fp, 2)
+
+    with open(output_fp, "r") as f:
+        output_lines = f.read().splitlines()
+    assert output_lines == [
+        "sample-id\thost_subject_id\tcollection_timestamp"
+        "\tis_collection_timestamp_valid\tordinal_timestamp"
+        "\tdays_since_first_day",
+        "#q2:types\tcategorical\tcategorical"
+        "\tcategorical\tcategorical\tcategorical",
+        "S1\tABC\t1/3/14\tTrue\t20140103\t3",
+        "S2\tDEF\t1/4/2014\tTrue\t20140104\t4",
+        "S3\tABC\tasodifjoaisdjf\tFalse\tnot applicable\tnot applicable",
+        "S4\tABC\t2015-01-14\tTrue\t20150114\t379",
+        "S5\t\t12/31/2013\tTrue\t20131231\t0",
+    ]
+
+
+def test_stream_lack_of_required_cols(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    with open(input_fp, "w") as f:
+        f.write("sample-id\thost_subject_id\nS1\tABC\n")
+    with pytest.raises(ValueError) as einfo:
+        _stream_add_extra_cols(input_fp, str(tmpdir.join("out.tsv")), 10)
+    assert "must include the following columns" in str(einfo.value)
+
+
+@pytest.mark.parametrize("file_jobs", [1, 2])
+def test_batch(tmpdir, file_jobs):
+    input_fps = [str(tmpdir.join("in{}.tsv".format(i))) for i in range(3)]
+    output_fps = [str(tmpdir.join("out{}.tsv".format(i))) for i in range(3)]
+    with open(input_fps[0], "w") as f:
+        f.write("id\tcollection_timestamp\nS1\t1/4/2014\nS2\tasdf\n")
+    with open(input_fps[1], "w") as f:
+        f.write("id\tcollection_timestamp\nS3\t2014-01-01\n")
+    with open(input_fps[2], "w") as f:
+        f.write("id\tcollection_timestamp\nS4\t2015-01-01\nS5\tnope\n")
+
+    PARSE_CACHE.clear()
+    _batch_add_extra_cols(input_fps, output_fps, file_jobs=file_jobs)
+    # The timestamps parsed in each file (even in worker processes) are all
+    # added to the parse cache
+    assert len(PARSE_CACHE) == 5
+    assert PARSE_CACHE.misses == 5
+    # The anomalies found in each file (even in worker processes) are all
+    # recorded
+    assert DIAGNOSTICS.counts == {"invalid collection_timestamp": 2}
+    assert [
+        e[0] for e in DIAGNOSTICS.examples["invalid collection_timestamp"]
+    ] == ["S2", "S5"]
+
+    out0 = load_metadata(output_fps[0])
+    assert out0.loc["S1", "days_since_first_day"] == "3"
+    assert out0.loc["S2", "days_since_first_day"] == "not applicable"
+    out1 = load_metadata(output_fps[1])
+    assert out1.loc["S3", "days_since_first_day"] == "0"
+    out2 = load_metadata(output_fps[2])
+    assert out2.loc["S4", "days_since_first_day"] == "365"
+
+
+def test_batch_no_valid_timestamps(tmpdir):
+    input_fp = str(tmpdir.join("in.tsv"))
+    with open(input_fp, "w") as f:
+        f.write("id\tcollection_timestamp\nS1\t2012-10\n")
+    with pytest.raises(ValueError) as einfo:
+        _batch_add_extra_cols([input_fp], [str(tmpdir.join("out.tsv"))])
+    assert "in any of the input files are valid" in str(einfo.value)
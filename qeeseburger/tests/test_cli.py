@@ -0,0 +1,387 @@
+import json
+import os
+import shlex
+import subprocess
+import sys
+import pytest
+import pandas as pd
+from click.testing import CliRunner
+from ..cli import (
+    add_columns,
+    add_columns_batch,
+    add_host_ages,
+    add_dietary_phase,
+    add_dietary_phases,
+    run,
+    st_subsets,
+    st_run,
+)
+
+
+def test_cli_import_is_lightweight():
+    # Run this in a new Python process, since other tests have probably
+    # already imported pandas/etc. in this one
+    code = (
+        "import sys\n"
+        "import qeeseburger.cli\n"
+        "heavy = {'numpy', 'pandas', 'arrow', 'dateutil', 'qiime2'}\n"
+        "print(sorted(m for m in sys.modules if m.split('.')[0] in heavy))\n"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code])
+    assert output.decode().strip() == "[]"
+
+
+def test_help():
+    runner = CliRunner()
+    for command in (
+        add_columns,
+        add_columns_batch,
+        add_host_ages,
+        add_dietary_phase,
+        add_dietary_phases,
+        run,
+        st_subsets,
+        st_run,
+    ):
+        result = runner.invoke(command, ["--help"])
+        assert result.exit_code == 0
+        assert "Usage:" in result.output
+
+
+def test_add_columns_native_backend(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    output_fp = str(tmpdir.join("output.tsv"))
+    with open(input_fp, "w") as f:
+        f.write(
+            "sample-id\tcollection_timestamp\n"
+            "S1\t2014-01-05\n"
+            "S2\t1/3/14\n"
+        )
+    result = CliRunner().invoke(add_columns, ["-i", input_fp, "-o", output_fp])
+    assert result.exit_code == 0
+    with open(output_fp, "r") as f:
+        assert f.read() == (
+            "sample-id\tcollection_timestamp\tis_collection_timestamp_valid"
+            "\tordinal_timestamp\tdays_since_first_day\n"
+            # Like qiime2.Metadata.save(), a #q2:types directive is always
+            # written, declaring the new columns as categorical
+            "#q2:types\t\tcategorical\tcategorical\tcategorical\n"
+            "S1\t2014-01-05\tTrue\t20140105\t2\n"
+            "S2\t1/3/14\tTrue\t20140103\t0\n"
+        )
+
+
+def test_add_columns_timestamp_formats(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    formats_fp = str(tmpdir.join("formats.txt"))
+    output_fp = str(tmpdir.join("output.tsv"))
+    with open(input_fp, "w") as f:
+        f.write("sample-id\tcollection_timestamp\nS1\t5 January 2014\n")
+    with open(formats_fp, "w") as f:
+        f.write("D MMMM YYYY\n")
+    result = CliRunner().invoke(
+        add_columns,
+        ["-i", input_fp, "-o", output_fp, "--timestamp-formats", formats_fp],
+    )
+    assert result.exit_code == 0
+    with open(output_fp, "r") as f:
+        assert (
+            f.read().splitlines()[2] == "S1\t5 January 2014\tTrue\t20140105\t0"
+        )
+
+
+def test_add_columns_previous_output(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    previous_fp = str(tmpdir.join("previous.tsv"))
+    output_fp = str(tmpdir.join("output.tsv"))
+    with open(input_fp, "w") as f:
+        f.write("sample-id\tcollection_timestamp\nS1\t2014-01-05\n")
+    runner = CliRunner()
+    runner.invoke(add_columns, ["-i", input_fp, "-o", previous_fp])
+    with open(input_fp, "a") as f:
+        f.write("S2\t1/3/14\n")
+    result = runner.invoke(
+        add_columns,
+        ["-i", input_fp, "-o", output_fp, "--previous-output", previous_fp],
+    )
+    assert result.exit_code == 0
+    assert "Reusing previous values for 1 of 2 sample(s)." in result.output
+    with open(output_fp, "r") as f:
+        assert f.read().splitlines()[2:] == [
+            "S1\t2014-01-05\tTrue\t20140105\t2",
+            "S2\t1/3/14\tTrue\t20140103\t0",
+        ]
+
+    result = runner.invoke(
+        add_columns,
+        [
+            "-i",
+            input_fp,
+            "-o",
+            output_fp,
+            "--previous-output",
+            previous_fp,
+            "--stream",
+        ],
+    )
+    assert result.exit_code == 2
+
+    # Streaming always uses the native reader/writer
+    result = runner.invoke(
+        add_columns,
+        [
+            "-i",
+            input_fp,
+            "-o",
+            output_fp,
+            "--stream",
+            "--io-backend",
+            "qiime2",
+        ],
+    )
+    assert result.exit_code == 2
+    assert "native I/O backend" in result.output
+
+
+def test_add_columns_profile(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    output_fp = str(tmpdir.join("output.tsv"))
+    profile_fp = str(tmpdir.join("profile.json"))
+    with open(input_fp, "w") as f:
+        f.write("sample-id\tcollection_timestamp\nS1\t2014-01-05\n")
+    result = CliRunner().invoke(
+        add_columns,
+        ["-i", input_fp, "-o", output_fp, "--profile", profile_fp],
+    )
+    assert result.exit_code == 0
+    with open(profile_fp, "r") as f:
+        spans = json.load(f)["spans"]
+    assert [s["name"] for s in spans] == [
+        "add-ts-cols > load metadata",
+        "add-ts-cols > transform > strict parsing",
+        "add-ts-cols > transform",
+        "add-ts-cols > save metadata",
+        "add-ts-cols",
+    ]
+    for s in spans:
+        assert s["calls"] == 1
+        assert s["seconds"] >= 0
+        assert s["max_rss_mb"] > 0
+
+
+def test_add_columns_batch_shared_options(tmpdir):
+    input_fps = [str(tmpdir.join("in{}.tsv".format(i))) for i in range(2)]
+    output_dir = str(tmpdir.join("out"))
+    formats_fp = str(tmpdir.join("formats.txt"))
+    cache_fp = str(tmpdir.join("cache.json"))
+    with open(input_fps[0], "w") as f:
+        f.write("sample-id\tcollection_timestamp\nS1\t5 January 2014\n")
+    with open(input_fps[1], "w") as f:
+        f.write("sample-id\tcollection_timestamp\nS2\t2014-01-03\n")
+    with open(formats_fp, "w") as f:
+        f.write("D MMMM YYYY\n")
+    result = CliRunner().invoke(
+        add_columns_batch,
+        [
+            "-i",
+            input_fps[0],
+            "-i",
+            input_fps[1],
+            "-d",
+            output_dir,
+            "--file-jobs",
+            "2",
+            "-j",
+            "1",
+            "--timestamp-formats",
+            formats_fp,
+            "--parse-cache",
+            cache_fp,
+        ],
+    )
+    assert result.exit_code == 0
+    # The extra timestamp formats are used in the worker processes, too
+    with open(os.path.join(output_dir, "in0.tsv"), "r") as f:
+        assert (
+            f.read().splitlines()[2] == "S1\t5 January 2014\tTrue\t20140105\t2"
+        )
+    # ... and the timestamps they parse are saved to the parse cache
+    with open(cache_fp, "r") as f:
+        cached = [e[0] for e in json.load(f)["entries"]]
+    assert "5 January 2014" in cached
+    assert "2014-01-03" in cached
+
+
+def test_add_host_ages_needs_one_source_of_birthdays(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    bdays_fp = str(tmpdir.join("bdays.tsv"))
+    for fp in (input_fp, bdays_fp):
+        with open(fp, "w") as f:
+            f.write("sample_name\thost_subject_id\n")
+    runner = CliRunner()
+    base_args = ["-i", input_fp, "-o", str(tmpdir.join("output.tsv"))]
+    for extra_args in (
+        [],
+        ["-h", "ABC", "-b", "2000-01-01", "--birthdays-file", bdays_fp],
+    ):
+        result = runner.invoke(add_host_ages, base_args + extra_args)
+        assert result.exit_code == 2
+        assert "--birthdays-file" in result.output
+
+
+def test_add_host_ages_diagnostics_report(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    report_fp = str(tmpdir.join("report.tsv"))
+    with open(input_fp, "w") as f:
+        f.write(
+            "sample-id\thost_subject_id\tcollection_timestamp\n"
+            "S1\tABC\t1999-12-31\n"
+            "S2\tABC\t1999-12-30\n"
+            "S3\tABC\t2001-05-06\n"
+        )
+    result = CliRunner().invoke(
+        add_host_ages,
+        [
+            "-i",
+            input_fp,
+            "-o",
+            str(tmpdir.join("output.tsv")),
+            "-h",
+            "ABC",
+            "-b",
+            "2000-05-06",
+            "--diagnostics-report",
+            report_fp,
+        ],
+    )
+    assert result.exit_code == 0
+    assert "Found 2 anomalies (impossible host age: 2)." in result.output
+    with open(report_fp, "r") as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "kind\tid\tdetails"
+    assert [line.split("\t")[:2] for line in lines[1:]] == [
+        ["impossible host age", "S1"],
+        ["impossible host age", "S2"],
+    ]
+
+
+def test_add_dietary_phases_workbook(tmpdir):
+    pytest.importorskip("openpyxl")
+    input_fp = str(tmpdir.join("input.tsv"))
+    output_fp = str(tmpdir.join("output.tsv"))
+    workbook_fp = str(tmpdir.join("key_dates.xlsx"))
+    with open(input_fp, "w") as f:
+        f.write(
+            "sample-id\thost_subject_id\tcollection_timestamp\n"
+            "S1\tABC\t2019-02-05\n"
+            "S2\tDEF\t2019-02-05\n"
+            "S3\tGHI\t2019-02-05\n"
+        )
+    with pd.ExcelWriter(workbook_fp) as writer:
+        for host_id, event in (("ABC", "keto"), ("DEF", "fasting")):
+            pd.DataFrame(
+                {"Event": ["Started " + event, "Stopped " + event]},
+                index=pd.to_datetime(["2019-02-01", "2019-02-10"]),
+            ).to_excel(writer, sheet_name=host_id)
+    result = CliRunner().invoke(
+        add_dietary_phases,
+        ["-k", workbook_fp, "-i", input_fp, "-o", output_fp],
+    )
+    assert result.exit_code == 0
+    with open(output_fp, "r") as f:
+        assert f.read() == (
+            "sample-id\thost_subject_id\tcollection_timestamp\tketo\tfasting\n"
+            "#q2:types\t\t\tcategorical\tcategorical\n"
+            "S1\tABC\t2019-02-05\tTRUE\tnot applicable\n"
+            "S2\tDEF\t2019-02-05\tnot applicable\tTRUE\n"
+            "S3\tGHI\t2019-02-05\tnot applicable\tnot applicable\n"
+        )
+
+
+def test_st_subsets(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    output_dir = str(tmpdir.join("output"))
+    with open(input_fp, "w") as f:
+        f.write(
+            "sample_name\tempo_3\tcoarse_host_id\tother\n"
+            "10317.B\tAnimal distal gut\tAGP\tx\n"
+            "10317.A\tAnimal distal gut\tAGP\tx\n"
+            "10317.C\tSoil\tAGP\tx\n"
+            "S1\tAnimal distal gut\thost1\tx\n"
+            "S2\tAnimal distal gut\thost2\tx\n"
+            "S3\tSoil\thost1\tx\n"
+        )
+    result = CliRunner().invoke(
+        st_subsets,
+        [
+            "-i",
+            input_fp,
+            "-d",
+            output_dir,
+            "-c",
+            "Animal distal gut",
+            "-c",
+            "Soil",
+            "-h",
+            "host1",
+            "--max-sources",
+            "1",
+        ],
+    )
+    assert result.exit_code == 0
+    with open(str(tmpdir.join("output", "animal-distal-gut.tsv")), "r") as f:
+        assert f.read() == (
+            "sample_name\tempo_3\tSourceSink\n"
+            "10317.A\tAnimal distal gut\tSource\n"
+            "10317.C\tSoil\tSource\n"
+            "S1\tAnimal distal gut\tSink\n"
+        )
+    with open(str(tmpdir.join("output", "soil.tsv")), "r") as f:
+        assert f.read().splitlines()[-1] == "S3\tSoil\tSink"
+
+
+def test_st_run(tmpdir):
+    input_fp = str(tmpdir.join("input.tsv"))
+    output_dir = str(tmpdir.join("output"))
+    with open(input_fp, "w") as f:
+        f.write(
+            "sample_name\tempo_3\n"
+            "10317.A\tAnimal distal gut\n"
+            "S1\tAnimal distal gut\n"
+            "S2\tSoil\n"
+            "S3\tAnimal distal gut\n"
+        )
+    base_args = ["-i", input_fp, "-d", output_dir, "-t", "table.qza"]
+    base_args += ["-c", "Animal distal gut", "-c", "Soil", "-j", "2"]
+    # Something that succeeds for every category
+    command = "{} -c pass".format(shlex.quote(sys.executable))
+    result = CliRunner().invoke(st_run, base_args + ["--command", command])
+    assert result.exit_code == 0
+    assert '"Soil" succeeded' in result.output
+    assert os.path.exists(os.path.join(output_dir, "soil.tsv"))
+
+    command = '{} -c \'import sys; sys.exit("{{slug}}" == "soil")\''.format(
+        shlex.quote(sys.executable)
+    )
+    result = CliRunner().invoke(st_run, base_args + ["--command", command])
+    assert result.exit_code == 1
+    assert '"Soil" failed (exit status 1)' in result.output
+    assert "1 of 2 SourceTracker2 job(s) failed." in result.output
+
+    # Each shard's job writes a table for its sinks, which are then merged
+    command = (
+        "{} -c 'import os, sys\n"
+        "os.makedirs(sys.argv[1])\n"
+        'with open(os.path.join(sys.argv[1], "mp.txt"), "w") as f:\n'
+        '    f.write("\\tSoil\\n" + sys.argv[2] + "\\t1.0\\n")\' '
+        "{{output_dir}} S{{shard}}"
+    ).format(shlex.quote(sys.executable))
+    result = CliRunner().invoke(
+        st_run,
+        base_args
+        + ["--shards", "2", "--command", command, "--merge-output", "mp.txt"],
+    )
+    assert result.exit_code == 0
+    assert '"Soil" (shard 1) succeeded' in result.output
+    with open(os.path.join(output_dir, "animal-distal-gut", "mp.txt")) as f:
+        assert f.read() == "\tSoil\nS1\t1.0\nS2\t1.0\n"
@@ -0,0 +1,226 @@
+import os
+import pytest
+import pandas as pd
+from .. import key_dates
+from ..key_dates import (
+    find_phase_intervals,
+    load_key_dates,
+    load_key_dates_by_host,
+    load_phase_intervals,
+    _split_key_dates_by_host,
+    _find_phase_names,
+    _find_all_phase_intervals,
+)
+
+
+def get_key_dates(dates, events):
+    return pd.DataFrame({"Event": events}, index=pd.to_datetime(dates))
+
+
+def get_multi_host_key_dates():
+    kd = get_key_dates(
+        ["2019-02-01", "2019-02-03", "2019-02-10", "2019-02-01", "2019-02-06"],
+        [
+            "Started keto",
+            "Started keto again",
+            "Stopped keto",
+            "Started fasting",
+            "Stopped fasting",
+        ],
+    )
+    kd["host_subject_id"] = ["ABC", "ABC", "ABC", "DEF", "DEF"]
+    return kd
+
+
+def write_key_dates_file(tmpdir, filename, sep="\t"):
+    fp = str(tmpdir.join(filename))
+    with open(fp, "w") as f:
+        f.write(
+            sep.join(["Date", "Event", "host_subject_id"])
+            + "\n"
+            + "".join(
+                sep.join(row) + "\n"
+                for row in (
+                    ("2019-02-01", "Started keto", "ABC"),
+                    ("2/10/2019", "Stopped keto", "ABC"),
+                    ("2019-03-01", "Started fasting", "DEF"),
+                    ("2019-03-05", "Stopped fasting", "DEF"),
+                )
+            )
+        )
+    return fp
+
+
+def test_find_phase_intervals():
+    kd = get_multi_host_key_dates()
+    starts, stops = find_phase_intervals(kd, "fasting")
+    assert list(starts.astype(str)) == ["2019-02-01"]
+    assert list(stops.astype(str)) == ["2019-02-06"]
+
+
+def test_find_phase_names():
+    kd = get_multi_host_key_dates()
+    assert _find_phase_names(kd) == ["keto", "keto again", "fasting"]
+
+
+def test_split_key_dates_by_host():
+    kd = get_multi_host_key_dates()
+    other_kd = get_key_dates(["2019-01-01"], ["Started fasting"])
+    by_host = _split_key_dates_by_host({"Sheet1": kd, "GHI": other_kd})
+    assert list(by_host.keys()) == ["ABC", "DEF", "GHI"]
+    assert list(by_host["DEF"]["Event"]) == [
+        "Started fasting",
+        "Stopped fasting",
+    ]
+    assert "host_subject_id" not in by_host["ABC"].columns
+    assert by_host["GHI"] is other_kd
+
+
+def test_split_key_dates_by_host_redundant_host():
+    kd = get_multi_host_key_dates()
+    other_kd = get_key_dates(["2019-01-01"], ["Started fasting"])
+    with pytest.raises(ValueError) as einfo:
+        _split_key_dates_by_host({"Sheet1": kd, "DEF": other_kd})
+    assert "Host DEF has key dates in multiple sheets." in str(einfo.value)
+
+
+def test_find_all_phase_intervals_similar_names():
+    kd = get_key_dates(
+        ["2019-01-01", "2019-02-01", "2019-03-01", "2019-04-01"],
+        [
+            "Started keto",
+            "Stopped keto",
+            "Started  keto lite ",
+            "Stopped keto lite",
+        ],
+    )
+    intervals = _find_all_phase_intervals({"ABC": kd})["ABC"]
+    assert list(intervals.keys()) == ["keto", "keto lite"]
+    for phase_name, expected in (
+        ("keto", (["2019-01-01"], ["2019-02-01"])),
+        ("keto lite", (["2019-03-01"], ["2019-04-01"])),
+    ):
+        starts, stops = intervals[phase_name]
+        assert list(starts.astype(str)) == expected[0]
+        assert list(stops.astype(str)) == expected[1]
+
+
+def test_find_phase_intervals_exact():
+    kd = get_key_dates(
+        ["2019-01-01", "2019-02-01"], ["Started keto (day 1)", "Stopped keto"]
+    )
+    # add-diet counts any event containing "Started keto"...
+    starts, stops = find_phase_intervals(kd, "keto")
+    assert list(starts.astype(str)) == ["2019-01-01"]
+    # ...but add-diet-batch only counts exact matches, so "keto (day 1)" is
+    # its own phase (which is never stopped)
+    assert _find_phase_names(kd) == ["keto (day 1)"]
+    with pytest.raises(ValueError) as einfo:
+        find_phase_intervals(kd, "keto", exact=True)
+    assert "No starting dates" in str(einfo.value)
+    with pytest.raises(ValueError) as einfo:
+        _find_all_phase_intervals({"ABC": kd})
+    assert "No stopping dates" in str(einfo.value)
+
+
+def test_find_all_phase_intervals_no_phases():
+    kd = get_key_dates(["2019-02-15"], ["Moved to a new city"])
+    with pytest.raises(ValueError) as einfo:
+        _find_all_phase_intervals({"ABC": kd})
+    assert 'No "Started PHASENAME" events found' in str(einfo.value)
+
+
+@pytest.mark.parametrize(
+    "filename,sep", [("key_dates.tsv", "\t"), ("key_dates.csv", ",")]
+)
+def test_load_key_dates_table(tmpdir, filename, sep):
+    kd = load_key_dates(write_key_dates_file(tmpdir, filename, sep))
+    assert list(kd.index.strftime("%Y-%m-%d")) == [
+        "2019-02-01",
+        "2019-02-10",
+        "2019-03-01",
+        "2019-03-05",
+    ]
+    assert list(kd.columns) == ["Event", "host_subject_id"]
+
+    by_host = load_key_dates_by_host(
+        write_key_dates_file(tmpdir, filename, sep)
+    )
+    assert list(by_host.keys()) == ["ABC", "DEF"]
+
+
+def test_load_key_dates_table_bad_dates(tmpdir):
+    fp = str(tmpdir.join("key_dates.tsv"))
+    with open(fp, "w") as f:
+        f.write("Date\tEvent\nnot a date\tStarted keto\n")
+    with pytest.raises(ValueError) as einfo:
+        find_phase_intervals(load_key_dates(fp), "keto")
+    assert "must contain dates/timestamps" in str(einfo.value)
+
+
+def test_load_key_dates_table_without_hosts(tmpdir):
+    fp = str(tmpdir.join("key_dates.tsv"))
+    with open(fp, "w") as f:
+        f.write("Date\tEvent\n2019-02-01\tStarted keto\n")
+    with pytest.raises(ValueError) as einfo:
+        load_key_dates_by_host(fp)
+    assert "must include a host_subject_id column" in str(einfo.value)
+
+
+def test_load_phase_intervals_summary(tmpdir, capsys):
+    kd_fp = write_key_dates_file(tmpdir, "key_dates.tsv")
+    load_phase_intervals(kd_fp)
+    # Just one line is printed, rather than one per host and phase
+    assert capsys.readouterr().out == (
+        "Found 2 ranges of 2 dietary phases for 2 hosts.\n"
+    )
+    load_phase_intervals(kd_fp, "XYZ", "keto")
+    assert capsys.readouterr().out == (
+        'Found 1 ranges for the "keto" dietary phase.\n'
+    )
+
+
+def test_load_phase_intervals_cache_summary(tmpdir, capsys):
+    kd_fp = write_key_dates_file(tmpdir, "key_dates.tsv")
+    cache_fp = str(tmpdir.join("key_dates_cache"))
+    load_phase_intervals(kd_fp, cache_filepath=cache_fp)
+    summary = capsys.readouterr().out
+    # The same summary is printed whether or not the cache is used
+    load_phase_intervals(kd_fp, cache_filepath=cache_fp)
+    assert capsys.readouterr().out == (
+        "Using cached key dates from {}.\n".format(cache_fp) + summary
+    )
+
+
+def test_load_phase_intervals_cache(tmpdir, monkeypatch):
+    kd_fp = write_key_dates_file(tmpdir, "key_dates.tsv")
+    cache_fp = str(tmpdir.join("key_dates_cache"))
+    all_intervals = load_phase_intervals(kd_fp, cache_filepath=cache_fp)
+    keto_intervals = load_phase_intervals(
+        kd_fp, "XYZ", "keto", cache_filepath=cache_fp
+    )
+    assert os.path.exists(cache_fp)
+
+    # Now that both of these requests are cached, we shouldn't need to read
+    # the key dates file again
+    def fail(*args):
+        raise AssertionError("Key dates file was read")
+
+    monkeypatch.setattr(key_dates, "read_table", fail)
+    for args, expected in (
+        ((), all_intervals),
+        (("XYZ", "keto"), keto_intervals),
+    ):
+        cached = load_phase_intervals(kd_fp, *args, cache_filepath=cache_fp)
+        assert list(cached.keys()) == list(expected.keys())
+        for host_id in expected:
+            assert list(cached[host_id]) == list(expected[host_id])
+            for phase_name, (starts, stops) in expected[host_id].items():
+                assert list(cached[host_id][phase_name][0]) == list(starts)
+                assert list(cached[host_id][phase_name][1]) == list(stops)
+
+    # If the key dates file changes, the cache shouldn't be used
+    with open(kd_fp, "a") as f:
+        f.write("2019-04-01\tStarted keto\tABC\n")
+    with pytest.raises(AssertionError):
+        load_phase_intervals(kd_fp, cache_filepath=cache_fp)
@@ -0,0 +1,139 @@
+import json
+import pytest
+from ..pipeline import load_spec, run_pipeline
+from ..utils import PARSE_CACHE, manipulate_md
+from ..add_timeseries_cols import _get_extra_cols
+from ..add_host_ages import _get_host_age_cols
+from ..add_dietary_phase import _get_dietary_phase_cols
+from ..key_dates import load_phase_intervals
+
+
+def write_inputs(tmpdir):
+    md_fp = str(tmpdir.join("input.tsv"))
+    with open(md_fp, "w") as f:
+        f.write(
+            "sample_name\thost_subject_id\tcollection_timestamp\n"
+            "#q2:types\tcategorical\tcategorical\n"
+            "S1\tABC\t2019-02-01\n"
+            "S2\tABC\t2/12/2019\n"
+            "S3\tDEF\t2019-02-05\n"
+            "S4\tDEF\tnot a date\n"
+            "S5\tGHI\t2019-01-01\n"
+        )
+    kd_fp = str(tmpdir.join("key_dates.tsv"))
+    with open(kd_fp, "w") as f:
+        f.write(
+            "Date\tEvent\n"
+            "2019-02-01\tStarted keto\n"
+            "2019-02-10\tStopped keto\n"
+        )
+    spec = {
+        "transforms": [
+            {"transform": "add-ts-cols"},
+            {
+                "transform": "add-host-ages",
+                "host_id_list": "ABC,DEF",
+                "host_birthday_list": "2000-01-01,1990-02-03",
+            },
+            {
+                "transform": "add-diet",
+                "host_subject_id": "ABC",
+                "phase_name": "keto",
+                "key_dates_spreadsheet": kd_fp,
+            },
+        ]
+    }
+    return md_fp, kd_fp, spec
+
+
+def test_run_pipeline(tmpdir):
+    md_fp, kd_fp, spec = write_inputs(tmpdir)
+    output_fp = str(tmpdir.join("output.tsv"))
+    run_pipeline(md_fp, spec, output_fp)
+
+    # Running each of the commands one after another should give the same
+    # output
+    chained_fps = [str(tmpdir.join("chained{}.tsv".format(i))) for i in (1, 2)]
+    chained_fps.append(str(tmpdir.join("chained_output.tsv")))
+    manipulate_md(md_fp, [], chained_fps[0], _get_extra_cols)
+    manipulate_md(
+        chained_fps[0],
+        ["ABC,DEF", "2000-01-01,1990-02-03"],
+        chained_fps[1],
+        _get_host_age_cols,
+    )
+    manipulate_md(
+        chained_fps[1],
+        [load_phase_intervals(kd_fp, "ABC", "keto")],
+        chained_fps[2],
+        _get_dietary_phase_cols,
+    )
+    with open(output_fp, "r") as f1, open(chained_fps[2], "r") as f2:
+        output = f1.read()
+        assert output == f2.read()
+    assert output.splitlines()[2] == (
+        "S1\tABC\t2019-02-01\tTrue\t20190201\t31\t19\tTRUE"
+    )
+
+
+def test_run_pipeline_parses_timestamps_once(tmpdir):
+    md_fp, kd_fp, spec = write_inputs(tmpdir)
+    PARSE_CACHE.clear()
+    run_pipeline(md_fp, spec, str(tmpdir.join("output.tsv")))
+    # Each unique timestamp is parsed once by add-ts-cols (and reused by
+    # add-host-ages, which also parses the two birthdays); ABC's two
+    # timestamps are then parsed once by add-diet
+    assert PARSE_CACHE.misses == 5 + 2 + 2
+    assert PARSE_CACHE.hits == 0
+
+
+@pytest.mark.parametrize(
+    "spec,message",
+    [
+        ([], 'must be a mapping with a "transforms" list'),
+        ({"transforms": []}, "doesn't include any transforms"),
+        ({"transforms": [{"phase_name": "keto"}]}, '"transform" key'),
+        (
+            {"transforms": [{"transform": "add-ts-cols"}, {"transform": "x"}]},
+            'Transform 2 in the pipeline spec, "x", isn\'t one of',
+        ),
+        (
+            {"transforms": [{"transform": "add-diet", "phase_name": "keto"}]},
+            'Transform 1 in the pipeline spec ("add-diet") has invalid',
+        ),
+        (
+            {"transforms": [{"transform": "add-ts-cols", "stream": True}]},
+            "unexpected keyword argument 'stream'",
+        ),
+    ],
+)
+def test_load_spec_invalid(tmpdir, spec, message):
+    spec_fp = str(tmpdir.join("spec.json"))
+    with open(spec_fp, "w") as f:
+        json.dump(spec, f)
+    with pytest.raises(ValueError) as einfo:
+        load_spec(spec_fp)
+    assert message in str(einfo.value)
+
+
+def test_load_spec_yaml(tmpdir):
+    pytest.importorskip("yaml")
+    spec_fp = str(tmpdir.join("spec.yml"))
+    with open(spec_fp, "w") as f:
+        f.write(
+            "transforms:\n"
+            "  - transform: add-ts-cols\n"
+            "  - transform: add-host-ages\n"
+            "    birthdays_file: bdays.tsv\n"
+            "    float_years: true\n"
+        )
+    assert load_spec(spec_fp) == {
+        "transforms": [
+            {"transform": "add-ts-cols"},
+            {
+                "transform": "add-host-ages",
+                "birthdays_file": "bdays.tsv",
+                "float_years": True,
+            },
+        ]
+    }
@@ -0,0 +1,299 @@
+import os
+import shlex
+import sys
+import pytest
+import numpy as np
+import pandas as pd
+from ..sourcetracking import (
+    get_category_slug,
+    load_st_metadata,
+    get_st_subsets,
+    shard_st_subset,
+    write_st_subsets,
+    run_st_jobs,
+    merge_st_shards,
+)
+from ..utils import load_metadata, save_metadata
+
+CATEGORIES = ["Animal distal gut", "Animal secretion", "Animal surface"]
+# Stands in for SourceTracker2: writes its arguments to [output_dir]/args.txt,
+# and fails for the "Soil" category
+STUB_COMMAND = (
+    shlex.quote(sys.executable)
+    + " -c "
+    + shlex.quote(
+        "import os, sys\n"
+        "os.makedirs(sys.argv[1])\n"
+        "with open(os.path.join(sys.argv[1], 'args.txt'), 'w') as f:\n"
+        "    f.write('\\n'.join(sys.argv[2:]))\n"
+        "print('Running on', sys.argv[2])\n"
+        "sys.exit(3 if sys.argv[2] == 'Soil' else 0)\n"
+    )
+    + " {output_dir} {category} {metadata} {feature_table} {category_col}"
+)
+
+
+def get_test_data(num_samples=500, seed=0):
+    rng = np.random.default_rng(seed)
+    sample_ids = [
+        "{}.S{}".format(rng.choice(["10317", "11111"]), i)
+        for i in rng.permutation(num_samples)
+    ]
+    return pd.DataFrame(
+        {
+            "empo_3": rng.choice(CATEGORIES + ["Soil"], num_samples),
+            "coarse_host_id": rng.choice(
+                ["host1", "host2", "AGP"], num_samples
+            ),
+            "other": "stuff",
+        },
+        index=pd.Index(sample_ids, name="sample_name"),
+    )
+
+
+def get_subsets_slowly(df, host_ids, max_sources):
+    """What prepare_for_sourcetracking.py used to do."""
+    agp_sample_ids = set(df.loc[df.index.str.startswith("10317.")].index)
+    agp_ids_to_use = []
+    for e in CATEGORIES:
+        empo3subset = df[df["empo_3"] == e]
+        agp_from_this_empo3 = set(empo3subset.index) & agp_sample_ids
+        agp_ids_to_use += sorted(agp_from_this_empo3)[:max_sources]
+    subsets = {}
+    for e in CATEGORIES:
+        empo3subset = df[df["empo_3"] == e]
+        empo3_sampleids = [
+            i
+            for i in empo3subset[
+                empo3subset["coarse_host_id"].isin(host_ids)
+            ].index
+            if i not in agp_ids_to_use
+        ]
+        subsets[e] = (agp_ids_to_use, empo3_sampleids)
+    return subsets
+
+
+@pytest.mark.parametrize("max_sources", [1, 10, 1000])
+def test_get_st_subsets(max_sources):
+    df = get_test_data()
+    host_ids = ["host1", "host2"]
+    subsets = get_st_subsets(
+        df, CATEGORIES, host_ids, "10317.", max_sources, prefixed_sinks=True
+    )
+    expected = get_subsets_slowly(df, host_ids, max_sources)
+    assert list(subsets.keys()) == CATEGORIES
+    for category, subset_df in subsets.items():
+        sources, sinks = expected[category]
+        assert list(subset_df.index) == sources + sinks
+        assert list(subset_df["SourceSink"]) == (
+            ["Source"] * len(sources) + ["Sink"] * len(sinks)
+        )
+        assert list(subset_df.columns) == ["empo_3", "SourceSink"]
+        assert subset_df.index.name == "sample_name"
+        assert (
+            subset_df["empo_3"].to_numpy() == df.loc[subset_df.index, "empo_3"]
+        ).all()
+
+
+def test_get_st_subsets_all_hosts_and_kept_cols():
+    df = get_test_data()
+    subsets = get_st_subsets(
+        df, ["Animal surface"], max_sources=5, keep_cols=["coarse_host_id"]
+    )
+    subset_df = subsets["Animal surface"]
+    assert list(subset_df.columns) == [
+        "empo_3",
+        "coarse_host_id",
+        "SourceSink",
+    ]
+    # Without any host IDs, every (unprefixed) sample is a sink
+    in_category = df.loc[df["empo_3"] == "Animal surface"].index
+    sinks = subset_df.index[subset_df["SourceSink"] == "Sink"]
+    assert sorted(sinks) == sorted(
+        in_category[~in_category.str.startswith("10317.")]
+    )
+    assert (subset_df["SourceSink"] == "Source").sum() == 5
+
+    # Unless prefixed_sinks is True, in which case the other prefixed samples
+    # are sinks too
+    subset_df = get_st_subsets(
+        df, ["Animal surface"], max_sources=5, prefixed_sinks=True
+    )["Animal surface"]
+    assert sorted(subset_df.index) == sorted(in_category)
+
+
+def test_get_st_subsets_bad_params():
+    df = get_test_data(10)
+    for categories, keep_cols in (
+        ([], []),
+        (["Soil", "Soil"], []),
+        (["Soil"], ["SourceSink"]),
+    ):
+        with pytest.raises(ValueError):
+            get_st_subsets(df, categories, keep_cols=keep_cols)
+    # The host column is only needed if host IDs are given
+    get_st_subsets(df, ["Soil"], host_col="host_subject_id")
+    with pytest.raises(ValueError) as einfo:
+        get_st_subsets(df, ["Soil"], ["ABC"], host_col="host_subject_id")
+    assert "host_subject_id" in str(einfo.value)
+
+
+def test_load_and_write_st_subsets(tmpdir):
+    df = get_test_data()
+    md_fp = str(tmpdir.join("metadata.tsv"))
+    save_metadata(df, md_fp)
+    loaded_df = load_st_metadata(md_fp, host_ids=["host1"])
+    assert list(loaded_df.columns) == ["empo_3", "coarse_host_id"]
+
+    subsets = get_st_subsets(loaded_df, CATEGORIES, ["host1"])
+    filepaths = write_st_subsets(subsets, str(tmpdir))
+    assert filepaths["Animal distal gut"] == [
+        str(tmpdir.join("animal-distal-gut.tsv"))
+    ]
+    for category, fps in filepaths.items():
+        assert load_metadata(fps[0]).equals(subsets[category])
+
+    filepaths = write_st_subsets(subsets, str(tmpdir), shards=3)
+    assert filepaths["Animal surface"] == [
+        str(tmpdir.join("animal-surface-shard-{}.tsv".format(i)))
+        for i in (1, 2, 3)
+    ]
+    for category, fps in filepaths.items():
+        shards = [load_metadata(fp) for fp in fps]
+        expected = shard_st_subset(subsets[category], 3)
+        assert all(s.equals(e) for s, e in zip(shards, expected))
+
+    with pytest.raises(ValueError) as einfo:
+        write_st_subsets({"Soil": df, "soil!": df}, str(tmpdir))
+    assert "same file" in str(einfo.value)
+
+
+@pytest.mark.parametrize("num_shards", [1, 2, 7, 1000])
+def test_shard_st_subset(num_shards):
+    subset_df = get_st_subsets(get_test_data(), CATEGORIES, max_sources=5)[
+        "Animal surface"
+    ]
+    sources = subset_df.index[subset_df["SourceSink"] == "Source"]
+    sinks = subset_df.index[subset_df["SourceSink"] == "Sink"]
+    shards = shard_st_subset(subset_df, num_shards)
+    assert len(shards) == min(num_shards, len(sinks))
+    if num_shards == 1:
+        assert shards[0] is subset_df
+        return
+    n = len(sources)
+    shard_sinks = []
+    for shard_df in shards:
+        assert list(shard_df.index[:n]) == list(sources)
+        assert (shard_df["SourceSink"].iloc[n:] == "Sink").all()
+        assert (shard_df.columns == subset_df.columns).all()
+        shard_sinks += list(shard_df.index[n:])
+    # Every sink is in exactly one shard, and the shards don't depend on the
+    # order of the samples
+    assert shard_sinks == sorted(sinks)
+    sizes = [len(shard_df.index) - n for shard_df in shards]
+    assert max(sizes) - min(sizes) <= 1
+    reordered = shard_st_subset(subset_df.iloc[::-1], num_shards)
+    for shard_df, reordered_df in zip(shards, reordered):
+        assert list(shard_df.index[n:]) == list(reordered_df.index[n:])
+
+
+def test_get_category_slug():
+    assert get_category_slug("Animal distal gut") == "animal-distal-gut"
+    assert get_category_slug(" Plant (rhizosphere) ") == "plant-rhizosphere"
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_run_st_jobs(tmpdir, jobs):
+    output_dir = str(tmpdir)
+    metadata_filepaths = {
+        "Animal distal gut": ["animal-distal-gut.tsv"],
+        "Soil": ["soil-shard-1.tsv", "soil-shard-2.tsv"],
+    }
+    results = run_st_jobs(
+        metadata_filepaths,
+        "{slug}-table.qza",
+        output_dir,
+        STUB_COMMAND,
+        jobs=jobs,
+    )
+    assert [r["category"] for r in results] == [
+        "Animal distal gut",
+        "Soil",
+        "Soil",
+    ]
+    assert [r["shard"] for r in results] == [1, 1, 2]
+    assert [r["exit_status"] for r in results] == [0, 3, 3]
+    for r in results:
+        assert r["seconds"] >= 0
+    with open(results[0]["log_file"], "r") as f:
+        assert f.read() == "Running on Animal distal gut\n"
+    with open(os.path.join(output_dir, "animal-distal-gut", "args.txt")) as f:
+        assert f.read().split("\n") == [
+            "Animal distal gut",
+            "animal-distal-gut.tsv",
+            "animal-distal-gut-table.qza",
+            "empo_3",
+        ]
+    with open(os.path.join(output_dir, "st2-jobs.tsv"), "r") as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "category\tshard\texit_status\tseconds\tlog_file"
+    assert [line.split("\t")[:3] for line in lines[1:]] == [
+        ["Animal distal gut", "1", "0"],
+        ["Soil", "1", "3"],
+        ["Soil", "2", "3"],
+    ]
+    assert results[2]["log_file"] == os.path.join(
+        output_dir, "soil-shard-2.log"
+    )
+
+
+def test_run_st_jobs_bad_commands(tmpdir):
+    with pytest.raises(ValueError) as einfo:
+        run_st_jobs({"Soil": ["soil.tsv"]}, "t.qza", str(tmpdir), "st2 {oops}")
+    assert "oops" in str(einfo.value)
+    # Commands that don't exist fail with the same exit status a shell gives
+    results = run_st_jobs(
+        {"Soil": ["soil.tsv"]}, "t.qza", str(tmpdir), "qeeseburger-nonexistent"
+    )
+    assert results[0]["exit_status"] == 127
+
+
+def test_merge_st_shards(tmpdir):
+    output_dir = str(tmpdir)
+    metadata_filepaths = {
+        "Soil": ["soil-shard-1.tsv", "soil-shard-2.tsv"],
+        "Animal surface": ["animal-surface-shard-1.tsv"],
+    }
+    tables = {
+        "soil-shard-1": "\tSoil\tUnknown\nS1\t0.25\t0.75\n",
+        "soil-shard-2": "\tUnknown\tSoil\nS3\t0.1\t0.9\nS2\t1.0\t0\n",
+        "animal-surface-shard-1": (
+            "# Constructed from biom file\n#OTU ID\tS5\nSoil\t0.5\n"
+            "Unknown\t0.5\n"
+        ),
+    }
+    for job_name, table in tables.items():
+        os.makedirs(os.path.join(output_dir, job_name))
+        with open(os.path.join(output_dir, job_name, "mp.txt"), "w") as f:
+            f.write(table)
+    merged_filepaths = merge_st_shards(
+        metadata_filepaths, output_dir, ["mp.txt"]
+    )
+    assert merged_filepaths == [
+        os.path.join(output_dir, "soil", "mp.txt"),
+        os.path.join(output_dir, "animal-surface", "mp.txt"),
+    ]
+    with open(merged_filepaths[0], "r") as f:
+        assert f.read() == (
+            "\tSoil\tUnknown\nS1\t0.25\t0.75\nS3\t0.9\t0.1\nS2\t0\t1.0\n"
+        )
+    # Tables with sinks as columns are merged along the columns
+    with open(merged_filepaths[1], "r") as f:
+        assert f.read() == "#OTU ID\tS5\nSoil\t0.5\nUnknown\t0.5\n"
+
+    # Shards that don't have the same sources can't be merged
+    with open(os.path.join(output_dir, "soil-shard-2", "mp.txt"), "w") as f:
+        f.write("\tSoil\tPlant\nS3\t0.1\t0.9\n")
+    with pytest.raises(ValueError) as einfo:
+        merge_st_shards(metadata_filepaths, output_dir, ["mp.txt"])
+    assert "same sources" in str(einfo.value)
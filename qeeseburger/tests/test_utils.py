@@ -1,7 +1,37 @@
+import json
+import pstats
 import pytest
+import numpy as np
+import pandas as pd
 from arrow import ParserError
 from datetime import date
-from ..utils import strict_parse
+from ..utils import (
+    strict_parse,
+    strict_parse_series,
+    lenient_parse,
+    lenient_parse_series,
+    ParseCache,
+    ParsePool,
+    FormatRegistry,
+    PARSE_CACHE,
+    PARSE_POOL,
+    FORMAT_REGISTRY,
+    PROFILER,
+    DIAGNOSTICS,
+    EXPECTED_TIMESTAMP_FORMATS,
+    parse_jobs,
+    timestamp_formats_file,
+    profile_run,
+    Profiler,
+    diagnostics_file,
+    Diagnostics,
+    TimestampColumn,
+    read_md_header,
+    iter_md_chunks,
+    get_md_directives,
+    load_metadata,
+    save_metadata,
+)
 
 
 def test_good():
@@ -35,3 +65,411 @@ def test_fails_on_incomplete():
 
     with pytest.raises(ParserError):
         strict_parse("3/19")
+
+
+def test_fails_on_nonexistent_date():
+    with pytest.raises(ParserError):
+        strict_parse("2019-02-30")
+
+    with pytest.raises(ParserError):
+        strict_parse("13/01/2019")
+
+
+def test_series_matches_strict_parse():
+    timestamps = [
+        "2012-09-21",
+        "1/4/15",
+        "12/17/2011",
+        "2020-05-27 12:40:00 PM EST",
+        "2002-10-18: 19:45",
+        "'2013-08-09",
+        "2012",
+        "2012-10",
+        "3/2019",
+        "2019-02-30",
+        "asdfasdf",
+        "1/4/15",
+    ]
+    valid, dates = strict_parse_series(timestamps)
+    for i, t in enumerate(timestamps):
+        try:
+            expected_date = strict_parse(t)
+        except ParserError:
+            assert not valid[i]
+            assert np.isnat(dates[i])
+        else:
+            assert valid[i]
+            assert dates[i] == np.datetime64(expected_date)
+
+
+def test_series_non_str_and_missing():
+    valid, dates = strict_parse_series(
+        pd.Series(["2012-09-21", np.nan, None, 20200109])
+    )
+    assert list(valid) == [True, False, False, False]
+    assert dates[0] == np.datetime64("2012-09-21")
+    assert np.isnat(dates[1:]).all()
+
+
+def test_series_unsupported_format_falls_back_to_arrow():
+    valid, dates = strict_parse_series(
+        ["May 3, 2011", "2011-05-04", "May 2011"],
+        ["MMMM D, YYYY", "YYYY-MM-DD"],
+    )
+    assert list(valid) == [True, True, False]
+    assert dates[0] == np.datetime64("2011-05-03")
+    assert dates[1] == np.datetime64("2011-05-04")
+
+
+def test_series_fallback_in_parallel():
+    timestamps = ["May {}, 2011".format(d) for d in range(1, 32)] * 2
+    timestamps += ["June 31, 2011", "2011-05-04", "May 2011"]
+    formats = ["MMMM D, YYYY", "YYYY-MM-DD"]
+    serial_valid, serial_dates = strict_parse_series(
+        timestamps, formats, cache=None, pool=None
+    )
+    parallel_valid, parallel_dates = strict_parse_series(
+        timestamps, formats, cache=None, pool=ParsePool(3, 1)
+    )
+    assert list(parallel_valid) == list(serial_valid)
+    assert list(parallel_dates.astype(str)) == list(serial_dates.astype(str))
+    assert serial_valid.sum() == 63
+
+
+def test_lenient_parse_series_in_parallel():
+    timestamps = ["2019-03-{:02} 12:30".format(d) for d in range(1, 32)]
+    serial_dates = lenient_parse_series(timestamps, cache=None, pool=None)
+    parallel_dates = lenient_parse_series(
+        timestamps, cache=None, pool=ParsePool(4, 1)
+    )
+    assert list(parallel_dates) == list(serial_dates)
+    assert str(serial_dates[-1]) == "2019-03-31"
+
+    # The error for the first bad timestamp is raised
+    with pytest.raises(ValueError) as einfo:
+        lenient_parse_series(
+            timestamps + ["not a date", "also not a date"],
+            cache=None,
+            pool=ParsePool(4, 1),
+        )
+    assert "not a date" in str(einfo.value)
+    assert "also not a date" not in str(einfo.value)
+
+
+def test_parse_jobs():
+    assert PARSE_POOL.jobs == 1
+    with parse_jobs(3) as pool:
+        assert pool is PARSE_POOL
+        assert PARSE_POOL.jobs == 3
+    assert PARSE_POOL.jobs == 1
+    with pytest.raises(ValueError) as einfo:
+        ParsePool(0)
+    assert "number of jobs must be at least 1" in str(einfo.value)
+
+
+def test_format_registry_dispatch():
+    registry = FormatRegistry()
+    assert registry.formats == EXPECTED_TIMESTAMP_FORMATS
+    assert registry.formats is not EXPECTED_TIMESTAMP_FORMATS
+    # Each shape goes to the first format that matches it
+    assert registry.dispatch("0000-00-00") == 0
+    assert registry.dispatch("0000-0-00 00:00") == 1
+    assert registry.dispatch("0/0/00") == 4
+    # (like arrow, YYYY-MM-DD allows some punctuation around the date)
+    assert registry.dispatch("'0000-00-00") == 0
+    assert registry.dispatch("0000-00") == len(registry)
+    # Formats that can't be converted to a regex (e.g. ones using month
+    # names, or containing literal digits) stop the dispatch
+    registry.register("MMMM D, YYYY")
+    registry.register("[20]YY.MM.DD")
+    assert registry.compiled[-2:] == [None, None]
+    assert registry.dispatch("May 0, 0000") == len(registry) - 2
+    assert registry.dispatch("0000-00-00") == 0
+
+
+def test_format_registry_register_incomplete_format():
+    with pytest.raises(ValueError) as einfo:
+        FormatRegistry().register("YYYY-MM")
+    assert "'YYYY-MM' must include a year, month, and day" in str(einfo.value)
+
+
+def test_series_literal_digits_in_format():
+    timestamps = ["2019.03.01", "1919.03.01", "2019.02.30"]
+    formats = ["[20]YY.MM.DD"]
+    valid, dates = strict_parse_series(timestamps, formats, cache=None)
+    assert list(valid) == [True, False, False]
+    assert dates[0] == np.datetime64("2019-03-01")
+
+
+def test_timestamp_formats_file(tmpdir):
+    fp = str(tmpdir.join("formats.txt"))
+    with open(fp, "w") as f:
+        f.write("# Formats used by the lab\n\nD MMMM YYYY\nYYYY.MM.DD\n")
+    timestamps = ["3 May 2011", "2011.05.04", "2011-05-05"]
+    with timestamp_formats_file(fp) as registry:
+        assert registry is FORMAT_REGISTRY
+        assert registry.formats[-2:] == ["D MMMM YYYY", "YYYY.MM.DD"]
+        valid, dates = strict_parse_series(timestamps)
+        assert list(valid) == [True, True, True]
+        assert strict_parse("3 May 2011") == date(2011, 5, 3)
+    assert FORMAT_REGISTRY.formats == EXPECTED_TIMESTAMP_FORMATS
+    valid, dates = strict_parse_series(timestamps)
+    assert list(valid) == [False, False, True]
+
+
+def test_profiler_spans():
+    profiler = Profiler()
+    # Not enabled yet, so nothing's recorded
+    with profiler.span("ignored"):
+        pass
+    profiler.start()
+    try:
+        with profiler.span("outer"):
+            for i in range(2):
+                with profiler.span("inner"):
+                    pass
+        with profiler.span("after"):
+            pass
+    finally:
+        profiler.stop()
+    spans = profiler.report()["spans"]
+    assert [s["name"] for s in spans] == [
+        "outer > inner",
+        "outer",
+        "after",
+    ]
+    assert [s["calls"] for s in spans] == [2, 1, 1]
+    assert spans[1]["seconds"] >= spans[0]["seconds"] >= 0
+    assert spans[2]["max_rss_mb"] >= spans[1]["max_rss_mb"] > 0
+    assert not profiler.enabled
+
+
+def test_profile_run(tmpdir):
+    report_fp = str(tmpdir.join("profile.json"))
+    with profile_run(report_fp, "test"):
+        strict_parse_series(["2019-01-01", "not a date"], cache=None)
+    assert not PROFILER.enabled
+    with open(report_fp, "r") as f:
+        spans = json.load(f)["spans"]
+    assert [s["name"] for s in spans] == ["test > strict parsing", "test"]
+
+    stats_fp = str(tmpdir.join("profile.prof"))
+    with profile_run(stats_fp, "test"):
+        strict_parse_series(["2019-01-01", "not a date"], cache=None)
+    assert not PROFILER.enabled
+    assert pstats.Stats(stats_fp).total_calls > 0
+
+    # Nothing is profiled or written if there's no filepath
+    with profile_run(None, "test"):
+        assert not PROFILER.enabled
+
+
+def test_diagnostics():
+    diagnostics = Diagnostics(max_examples=3)
+    assert diagnostics.summary() == "No anomalies found."
+    # Nothing's recorded if there aren't any anomalies
+    diagnostics.record("kind A", [], "{}", [])
+    assert len(diagnostics.counts) == 0
+
+    diagnostics.record("kind A", ["S1", "S2"], "{} / {}", ["a", "b"], [1, 2])
+    diagnostics.record("kind B", pd.Index(["S3"]), "No values")
+    diagnostics.record("kind A", np.array(["S4", "S5"]), "{} / {}", "cd", "34")
+    assert diagnostics.summary() == (
+        "Found 5 anomalies (kind A: 4, kind B: 1)."
+    )
+    # Only the first 3 examples of each kind are kept
+    assert diagnostics.examples == {
+        "kind A": [("S1", "a / 1"), ("S2", "b / 2"), ("S4", "c / 3")],
+        "kind B": [("S3", "No values")],
+    }
+
+
+def test_diagnostics_file(tmpdir, capsys):
+    DIAGNOSTICS.record("stale", ["S0"], "This should be cleared")
+    report_fp = str(tmpdir.join("report.tsv"))
+    with diagnostics_file(report_fp):
+        DIAGNOSTICS.record("kind A", ["S1"], "Details")
+    assert capsys.readouterr().out.endswith("Found 1 anomaly (kind A: 1).\n")
+    with open(report_fp, "r") as f:
+        assert f.read() == "kind\tid\tdetails\nkind A\tS1\tDetails\n"
+
+
+def test_parse_cache_hits_and_misses():
+    cache = ParseCache()
+    assert strict_parse("2012-09-21", cache=cache) == date(2012, 9, 21)
+    assert strict_parse("2012-09-21", cache=cache) == date(2012, 9, 21)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Failed parses are cached too
+    for i in range(2):
+        with pytest.raises(ParserError):
+            strict_parse("2012-10", cache=cache)
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # Cache entries are specific to the list of formats used
+    with pytest.raises(ParserError):
+        strict_parse("2012-09-21", ["M/D/YY"], cache=cache)
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_parse_cache_lru_eviction():
+    cache = ParseCache(max_size=2)
+    cache.put("a", None, date(2000, 1, 1))
+    cache.put("b", None, date(2000, 1, 2))
+    # Using "a" makes "b" the least recently used entry
+    assert cache.get("a", None) == date(2000, 1, 1)
+    cache.put("c", None, date(2000, 1, 3))
+    assert len(cache) == 2
+    assert cache.get("b", None) is ParseCache.MISSING
+    assert cache.get("a", None) == date(2000, 1, 1)
+    assert cache.get("c", None) == date(2000, 1, 3)
+
+
+def test_parse_cache_shared_by_series_parser():
+    cache = ParseCache()
+    valid, dates = strict_parse_series(
+        ["1/4/15", "2012-10", "1/4/15"], cache=cache
+    )
+    assert list(valid) == [True, False, True]
+    # Each unique timestamp is only looked up once
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert strict_parse("1/4/15", cache=cache) == date(2015, 1, 4)
+    assert cache.hits == 1
+
+    valid, dates = strict_parse_series(["2012-10", "1/4/15"], cache=cache)
+    assert list(valid) == [False, True]
+    assert dates[1] == np.datetime64("2015-01-04")
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_parse_cache_save_and_load(tmpdir):
+    cache = ParseCache()
+    strict_parse_series(["1/4/15", "2012-10"], cache=cache)
+    lenient_parse("January 5, 2014", cache=cache)
+    cache_fp = str(tmpdir.join("cache.json"))
+    cache.save(cache_fp)
+
+    # The formats shared by the strict_parse() entries are only written once
+    with open(cache_fp, "r") as f:
+        contents = json.load(f)
+    assert len(contents["formats"]) == 1
+    assert [e[1] for e in contents["entries"]] == [0, 0, None]
+
+    loaded_cache = ParseCache()
+    loaded_cache.load(cache_fp)
+    assert len(loaded_cache) == 3
+    assert strict_parse("1/4/15", cache=loaded_cache) == date(2015, 1, 4)
+    with pytest.raises(ParserError):
+        strict_parse("2012-10", cache=loaded_cache)
+    assert lenient_parse("January 5, 2014", cache=loaded_cache) == date(
+        2014, 1, 5
+    )
+    assert (loaded_cache.hits, loaded_cache.misses) == (3, 0)
+
+
+def test_iter_md_chunks(tmpdir):
+    md_fp = str(tmpdir.join("md.tsv"))
+    with open(md_fp, "w") as f:
+        f.write(
+            "#SampleID\ta\tb\n"
+            "#q2:types\tnumeric\tcategorical\n"
+            "S1\t1\tx\n"
+            "#comment\n"
+            "S2\t\ty\n"
+            "S3\t3.0\tz"
+        )
+    header, directives = read_md_header(md_fp)
+    assert header == ["#SampleID", "a", "b"]
+    assert directives == [["#q2:types", "numeric", "categorical"]]
+
+    chunks = list(iter_md_chunks(md_fp, 2))
+    assert [list(c.index) for c in chunks] == [["S1", "S2"], ["S3"]]
+    # Everything's read in as a string
+    assert list(chunks[0]["a"]) == ["1", ""]
+    assert list(chunks[1]["a"]) == ["3.0"]
+
+    chunks = list(iter_md_chunks(md_fp, 10, usecols=["b"]))
+    assert len(chunks) == 1
+    assert list(chunks[0].columns) == ["b"]
+    assert list(chunks[0]["b"]) == ["x", "y", "z"]
+
+
+def test_native_metadata_round_trip(tmpdir):
+    md_text = (
+        "sample-id\tcollection_timestamp\tph\tnotes\n"
+        "#q2:types\tcategorical\tnumeric\tcategorical\n"
+        'S1\t2014-01-03\t7.0\t"quoted, verbatim"\n'
+        "S2\t1/4/14\t\t\n"
+        "S3\t20200109\t6.50\tsay 'hi'\n"
+    )
+    input_fp = str(tmpdir.join("input.tsv"))
+    output_fp = str(tmpdir.join("output.tsv"))
+    with open(input_fp, "w") as f:
+        f.write(md_text)
+
+    m_df = load_metadata(input_fp)
+    assert m_df.index.name == "sample-id"
+    assert list(m_df.index) == ["S1", "S2", "S3"]
+    assert m_df.at["S3", "collection_timestamp"] == "20200109"
+    assert m_df.at["S3", "ph"] == "6.50"
+    assert m_df.at["S2", "ph"] == ""
+
+    directives = get_md_directives(input_fp)
+    assert directives == {
+        "#q2:types": {
+            "collection_timestamp": "categorical",
+            "ph": "numeric",
+            "notes": "categorical",
+        }
+    }
+
+    save_metadata(m_df, output_fp, directives=directives)
+    with open(output_fp, "r") as f:
+        assert f.read() == md_text
+
+    # New columns are declared as categorical
+    m_df["new_col"] = "abc"
+    save_metadata(m_df, output_fp, directives=directives)
+    with open(output_fp, "r") as f:
+        lines = f.read().splitlines()
+    assert lines[0].endswith("\tnew_col")
+    assert lines[1] == "#q2:types\tcategorical\tnumeric\tcategorical" + (
+        "\tcategorical"
+    )
+    assert lines[2].endswith("\tabc")
+
+
+def test_unrecognized_metadata_backend(tmpdir):
+    with pytest.raises(ValueError) as einfo:
+        load_metadata(str(tmpdir.join("md.tsv")), backend="asdf")
+    assert "Unrecognized metadata backend: asdf" in str(einfo.value)
+
+
+def test_timestamp_column():
+    PARSE_CACHE.clear()
+    timestamps = TimestampColumn(
+        ["2019-03-10 12:30", "1/4/15", "1/4/15", np.nan, "2012-10"]
+    )
+    mask = np.array([False, True, True, True, True])
+    valid, dates = timestamps.strict_parse(mask)
+    assert list(valid) == [True, True, False, False]
+    assert list(dates[:2].astype(str)) == ["2015-01-04", "2015-01-04"]
+    # The unmasked timestamp hasn't been parsed yet, but the rest have (NaN
+    # values are never looked up in the cache, since they're always invalid)
+    assert PARSE_CACHE.misses == 2
+    valid, dates = timestamps.strict_parse()
+    assert list(valid) == [True, True, True, False, False]
+    assert PARSE_CACHE.misses == 3
+
+    dates = timestamps.lenient_parse(
+        np.array([True, True, True, False, False])
+    )
+    assert list(dates.astype(str)) == [
+        "2019-03-10",
+        "2015-01-04",
+        "2015-01-04",
+    ]
+    # Parsing the same timestamps again shouldn't touch the parse cache
+    timestamps.lenient_parse(np.array([True, True, False, False, False]))
+    assert PARSE_CACHE.misses == 5
+    assert PARSE_CACHE.hits == 0
@@ -1,20 +1,542 @@
-from qiime2 import Metadata
+import cProfile
+import csv
+import functools
+import io
+import json
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date
 import arrow
+from dateutil.parser import parse as dateutil_parse
+import numpy as np
+import pandas as pd
 
 
-def strict_parse(
-    timestamp,
-    expected_formats=[
-        "YYYY-MM-DD",
-        "YYYY-M-D",
-        "MM/DD/YYYY",
-        "M/D/YYYY",
-        "M/D/YY",
-        # Idiosyncratic formats needed to parse some timestamps I've run into
-        "[']YYYY-MM-DD",
-        "YYYY-MM-DD[:]",
-    ],
-):
+EXPECTED_TIMESTAMP_FORMATS = [
+    "YYYY-MM-DD",
+    "YYYY-M-D",
+    "MM/DD/YYYY",
+    "M/D/YYYY",
+    "M/D/YY",
+    # Idiosyncratic formats needed to parse some timestamps I've run into
+    "[']YYYY-MM-DD",
+    "YYYY-MM-DD[:]",
+]
+
+# These mirror the regular expressions arrow uses when parsing a format string
+# (see arrow.parser.DateTimeParser). Only tokens that describe a date are
+# listed here; formats that use any other tokens can't be handled by
+# strict_parse_series() directly, so it hands them off to strict_parse().
+_FORMAT_TOKEN_RE = re.compile(
+    r"(YYY?Y?|MM?M?M?|Do|DD?D?D?|d?d?d?d|HH?|hh?|mm?|ss?|S+|ZZ?Z?|a|A|x|X|W)"
+)
+_FORMAT_ESCAPE_RE = re.compile(r"\[[^\[\]]*\]")
+_DIGIT_RE = re.compile(r"\d")
+# Used to get the "shape" of a timestamp (see FormatRegistry). Non-ASCII digits
+# aren't replaced, but that's fine: \d still matches them in the shape.
+_SHAPE_TABLE = str.maketrans("0123456789", "0" * 10)
+_DATE_TOKEN_PATTERNS = {
+    "YYYY": r"\d{4}",
+    "YY": r"\d{2}",
+    "MM": r"\d{2}",
+    "M": r"\d{1,2}",
+    "DD": r"\d{2}",
+    "D": r"\d{1,2}",
+}
+_DATE_TOKEN_FIELDS = {
+    "YYYY": "year",
+    "YY": "year",
+    "MM": "month",
+    "M": "month",
+    "DD": "day",
+    "D": "day",
+}
+# arrow only matches a format if it's surrounded by whitespace (or by a little
+# bit of punctuation); these are copied from arrow's custom "word boundaries,"
+# which were added in arrow 0.15.0 (hence the version required in setup.py).
+_FORMAT_START_BOUNDARY = (
+    r"(?<!\S\S)(?<![^\,\.\;\:\?\!\"\'\`\[\]\{\}\(\)<>\s])(\b|^)"
+)
+_FORMAT_END_BOUNDARY = r"(?=[\,\.\;\:\?\!\"\'\`\[\]\{\}\(\)\<\>]?(?!\S))"
+
+
+class ParseCache(object):
+    """A bounded cache of parsed timestamps, with LRU eviction.
+
+       Keys are (timestamp, formats) pairs, where formats is the tuple of
+       formats that the timestamp was parsed with (or None if the parser
+       doesn't use a list of formats). Values are either datetime.date
+       objects, or None if the timestamp couldn't be parsed -- this way we
+       don't have to keep re-parsing the same invalid timestamps, either.
+
+       The number of cache hits and misses is counted, so that you can see
+       how useful the cache is being.
+    """
+
+    # Returned by get() when a timestamp isn't in the cache
+    MISSING = object()
+
+    def __init__(self, max_size=100000):
+        if max_size < 1:
+            raise ValueError("The maximum cache size must be at least 1.")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, timestamp, formats):
+        """Returns a cached date, None, or ParseCache.MISSING on a miss."""
+
+        key = (timestamp, formats)
+        try:
+            result = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return ParseCache.MISSING
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, timestamp, formats, result):
+        """Caches a date (or None, for a failed parse), evicting if needed."""
+
+        key = (timestamp, formats)
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def parse(self, timestamp, formats, parse_func):
+        """Calls parse_func(timestamp), unless the result is already cached.
+
+           parse_func should return a datetime.date and raise a ValueError
+           (e.g. arrow.ParserError) if the timestamp can't be parsed. Failed
+           parses are cached too; if we see one of these timestamps again, an
+           arrow.ParserError is raised.
+        """
+        result = self.get(timestamp, formats)
+        if result is ParseCache.MISSING:
+            try:
+                result = parse_func(timestamp)
+            except ValueError:
+                self.put(timestamp, formats, None)
+                raise
+            self.put(timestamp, formats, result)
+        if result is None:
+            raise arrow.ParserError(
+                "Could not parse timestamp {!r} (cached result).".format(
+                    timestamp
+                )
+            )
+        return result
+
+    def copy(self):
+        """Returns a new ParseCache with the same entries and counts."""
+
+        cache = ParseCache(self.max_size)
+        cache.merge(self)
+        return cache
+
+    def merge(self, other):
+        """Adds the entries and hit/miss counts of another ParseCache.
+
+           This is useful for collecting the timestamps parsed in worker
+           processes, each of which has its own PARSE_CACHE.
+        """
+        for (timestamp, formats), result in other._entries.items():
+            self.put(timestamp, formats, result)
+        self.hits += other.hits
+        self.misses += other.misses
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def report(self):
+        return "Timestamp parse cache: {} hit(s), {} miss(es).".format(
+            self.hits, self.misses
+        )
+
+    def save(self, filepath):
+        """Writes the cached entries to a JSON file, oldest entries first.
+
+           Most entries share the same tuple of formats, so each distinct
+           tuple is only written once (in the top-level "formats" list); each
+           entry just stores the index of its formats in this list (or None,
+           if its formats are None).
+        """
+        format_lists = []
+        format_indices = {}
+        entries = []
+        for (timestamp, formats), result in self._entries.items():
+            if formats is not None:
+                if formats not in format_indices:
+                    format_indices[formats] = len(format_lists)
+                    format_lists.append(list(formats))
+                formats = format_indices[formats]
+            if result is not None:
+                result = result.isoformat()
+            entries.append([timestamp, formats, result])
+        with open(filepath, "w") as f:
+            json.dump({"formats": format_lists, "entries": entries}, f)
+
+    def load(self, filepath):
+        """Adds the entries from a file written by save() to this cache."""
+
+        with open(filepath, "r") as f:
+            contents = json.load(f)
+        format_tuples = [tuple(formats) for formats in contents["formats"]]
+        for timestamp, format_index, result in contents["entries"]:
+            formats = None
+            if format_index is not None:
+                formats = format_tuples[format_index]
+            if result is not None:
+                result = date(*(int(p) for p in result.split("-")))
+            self.put(timestamp, formats, result)
+
+
+# The cache shared by strict_parse(), strict_parse_series(), and the scripts
+PARSE_CACHE = ParseCache()
+
+
+@contextmanager
+def parse_cache_file(filepath):
+    """Loads PARSE_CACHE from a file beforehand and saves it afterwards.
+
+       If filepath is None, this just reports cache hits/misses at the end.
+       If filepath doesn't exist yet, it will be created.
+    """
+    if filepath is not None and os.path.exists(filepath):
+        with PROFILER.span("load parse cache"):
+            PARSE_CACHE.load(filepath)
+    yield PARSE_CACHE
+    print(PARSE_CACHE.report())
+    if filepath is not None:
+        with PROFILER.span("save parse cache"):
+            PARSE_CACHE.save(filepath)
+
+
+def _parse_chunk(parse_func, timestamps):
+    return [parse_func(t) for t in timestamps]
+
+
+class ParsePool(object):
+    """Runs a parsing function on lots of timestamps, possibly in parallel.
+
+       This is used for timestamps that have to be parsed one at a time (e.g.
+       by arrow or dateutil). If jobs is greater than 1 and there are at least
+       min_parallel_size timestamps, the timestamps are split into jobs
+       contiguous chunks, and each chunk is parsed in a separate process.
+       Otherwise, the timestamps are just parsed one after another in this
+       process -- for small inputs, starting up a pool of processes takes
+       longer than the parsing itself.
+
+       Either way, the results are returned in the same order as the
+       timestamps, so the output doesn't depend on the number of jobs.
+    """
+
+    def __init__(self, jobs=1, min_parallel_size=2000):
+        if jobs < 1:
+            raise ValueError("The number of jobs must be at least 1.")
+        self.jobs = jobs
+        self.min_parallel_size = min_parallel_size
+
+    def map(self, parse_func, timestamps):
+        """Returns [parse_func(t) for t in timestamps].
+
+           parse_func has to be picklable (e.g. a module-level function, or a
+           functools.partial of one), and shouldn't raise any errors.
+        """
+        timestamps = list(timestamps)
+        if self.jobs == 1 or len(timestamps) < self.min_parallel_size:
+            return _parse_chunk(parse_func, timestamps)
+        bounds = np.linspace(0, len(timestamps), self.jobs + 1).astype(int)
+        chunks = [timestamps[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            chunk_results = executor.map(
+                _parse_chunk, [parse_func] * len(chunks), chunks
+            )
+            return [r for results in chunk_results for r in results]
+
+
+# The pool used by strict_parse_series() and lenient_parse_series()
+PARSE_POOL = ParsePool()
+
+
+@contextmanager
+def parse_jobs(jobs):
+    """Makes PARSE_POOL use a given number of processes within a with block."""
+    old_jobs = PARSE_POOL.jobs
+    PARSE_POOL.jobs = jobs
+    try:
+        yield PARSE_POOL
+    finally:
+        PARSE_POOL.jobs = old_jobs
+
+
+def _get_max_rss():
+    """Returns the peak memory (resident set size) of this process, in MB.
+
+       Returns None on platforms without the resource module (i.e. Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # This is in bytes on macOS, and in kilobytes everywhere else
+    if sys.platform == "darwin":
+        return max_rss / 1e6
+    return max_rss / 1e3
+
+
+@contextmanager
+def _no_op_span():
+    # (contextlib.nullcontext() needs Python 3.7)
+    yield
+
+
+class Profiler(object):
+    """Records how long named stages of a run take, and how much memory.
+
+       Stages are marked using span(): for example,
+
+       with PROFILER.span("load metadata"):
+           m_df = load_metadata(filepath)
+
+       Spans can be nested, and the same span can be entered multiple times
+       (e.g. once per chunk of samples); calls and times are added up for
+       each path of nested span names.
+
+       When the profiler isn't enabled (the default), span() just returns a
+       context manager that does nothing, so marking stages is free.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._open_paths = []
+        self._records = OrderedDict()
+
+    def span(self, name):
+        """Returns a context manager that records a stage named name."""
+        if not self.enabled:
+            return _no_op_span()
+        return self._record_span(name)
+
+    def wrap(self, name):
+        """Returns a decorator that records each call of a function as a span.
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapped(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+
+            return wrapped
+
+        return decorator
+
+    @contextmanager
+    def _record_span(self, name):
+        path = (name,)
+        if len(self._open_paths) > 0:
+            path = self._open_paths[-1] + path
+        self._open_paths.append(path)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            self._open_paths.pop()
+            if path not in self._records:
+                self._records[path] = {"calls": 0, "seconds": 0.0}
+            record = self._records[path]
+            record["calls"] += 1
+            record["seconds"] += seconds
+            # Tracking memory use precisely (e.g. with tracemalloc) slows
+            # things down a lot -- but the process's peak memory use is
+            # free to check, and shows which stages increased it
+            record["max_rss_mb"] = _get_max_rss()
+
+    def start(self):
+        """Clears any previous records, and starts recording spans."""
+        self._records.clear()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def report(self):
+        """Returns the recorded spans, in the order they were first finished.
+
+           Each span is described by a dict including its "name" (the names
+           of it and the spans it's nested in, separated by " > "), its
+           number of "calls", the total "seconds" spent in it, and
+           "max_rss_mb": the peak memory use of the whole process (in
+           megabytes) as of the end of its last call.
+        """
+        spans = []
+        for path, record in self._records.items():
+            span = OrderedDict([("name", " > ".join(path))])
+            span.update(record)
+            spans.append(span)
+        return {"spans": spans}
+
+
+# The profiler used to mark stages throughout Qeeseburger
+PROFILER = Profiler()
+
+
+@contextmanager
+def profile_run(filepath, name):
+    """Profiles everything done within a with block, and saves the profile.
+
+       If filepath ends in ".prof", the block is profiled with cProfile, and
+       its stats are dumped to filepath (these can be viewed with e.g. the
+       pstats module or snakeviz). Otherwise, the stages marked by PROFILER
+       (all nested inside a span named name, covering the whole block) are
+       recorded, and written to filepath as a JSON report (see
+       Profiler.report()).
+
+       If filepath is None, nothing is profiled.
+    """
+    if filepath is None:
+        yield
+    elif filepath.endswith(".prof"):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+        profile.dump_stats(filepath)
+    else:
+        PROFILER.start()
+        try:
+            with PROFILER.span(name):
+                yield
+        finally:
+            PROFILER.stop()
+        with open(filepath, "w") as f:
+            json.dump(PROFILER.report(), f, indent=4)
+
+
+class Diagnostics(object):
+    """Collects anomalies (e.g. impossible host ages) found during a run.
+
+       Rather than printing a line for each sample with an anomaly (which,
+       for messy studies, can mean tens of thousands of lines), the commands
+       record anomalies here in bulk: each kind of anomaly is counted, and
+       the first max_examples samples with each kind of anomaly are kept as
+       examples. At the end of the run, these can be summarized in a single
+       line (see summary()), and the examples can be saved to a TSV file (see
+       save()).
+    """
+
+    def __init__(self, max_examples=1000):
+        self.max_examples = max_examples
+        self.counts = OrderedDict()
+        self.examples = OrderedDict()
+
+    def record(self, kind, ids, template, *values):
+        """Records one kind of anomaly for some samples (or hosts).
+
+           Each value in values should be a list-like with one element per
+           ID in ids. The details of the anomaly for the i-th ID are
+           template.format(values[0][i], values[1][i], ...) -- these are only
+           formatted for the IDs that are kept as examples.
+        """
+        if len(ids) == 0:
+            return
+        if kind not in self.counts:
+            self.counts[kind] = 0
+            self.examples[kind] = []
+        self.counts[kind] += len(ids)
+        num_left = self.max_examples - len(self.examples[kind])
+        if num_left > 0:
+            kept_values = [list(v[:num_left]) for v in values]
+            for i, example_id in enumerate(list(ids[:num_left])):
+                self.examples[kind].append(
+                    (example_id, template.format(*(v[i] for v in kept_values)))
+                )
+
+    def merge(self, other):
+        """Adds the anomalies recorded by another Diagnostics to this one.
+
+           This is useful for collecting the anomalies found in worker
+           processes, each of which has its own DIAGNOSTICS.
+        """
+        for kind, count in other.counts.items():
+            if kind not in self.counts:
+                self.counts[kind] = 0
+                self.examples[kind] = []
+            self.counts[kind] += count
+            num_left = self.max_examples - len(self.examples[kind])
+            if num_left > 0:
+                self.examples[kind].extend(other.examples[kind][:num_left])
+
+    def clear(self):
+        self.counts.clear()
+        self.examples.clear()
+
+    def summary(self):
+        """Returns a one-line summary of the anomalies recorded so far."""
+        if len(self.counts) == 0:
+            return "No anomalies found."
+        total = sum(self.counts.values())
+        return "Found {} {} ({}).".format(
+            total,
+            "anomaly" if total == 1 else "anomalies",
+            ", ".join(
+                "{}: {}".format(kind, count)
+                for kind, count in self.counts.items()
+            ),
+        )
+
+    def save(self, filepath):
+        """Saves the examples of each kind of anomaly to a TSV file.
+
+           The file has "kind", "id", and "details" columns, and one row per
+           example; kinds with more than max_examples anomalies are
+           truncated.
+        """
+        with open(filepath, "w", newline="") as f:
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            writer.writerow(["kind", "id", "details"])
+            for kind, examples in self.examples.items():
+                for example_id, example_details in examples:
+                    writer.writerow([kind, example_id, example_details])
+
+
+# The anomalies found by the commands in this run
+DIAGNOSTICS = Diagnostics()
+
+
+@contextmanager
+def diagnostics_file(filepath):
+    """Collects DIAGNOSTICS within a with block, and reports them afterwards.
+
+       A summary of the anomalies found is printed at the end. If filepath
+       isn't None, the examples of each anomaly are also saved to it.
+    """
+    DIAGNOSTICS.clear()
+    yield DIAGNOSTICS
+    print(DIAGNOSTICS.summary())
+    if filepath is not None:
+        DIAGNOSTICS.save(filepath)
+
+
+def strict_parse(timestamp, expected_formats=None, cache=PARSE_CACHE):
     """Parses a timestamp; only succeeds if it contains a year, month, and day.
 
        This function is intended to be more strict than many publicly
@@ -42,12 +564,19 @@ def strict_parse(
        timestamp: str
             A string representation of a sample's timestamp.
 
-       expected_formats: list of str
+       expected_formats: list of str or None
             A list of formats to try parsing the timestamp with. This list will
-            be passed into arrow.get() as is. YOU WILL PROBABLY WANT TO EXTEND
-            THIS LIST if you're going to be parsing arbitrary dates with this
-            thing -- these formats are suitable for my use cases right now, but
-            not comprehensive.
+            be passed into arrow.get() as is. If this is None, the formats in
+            FORMAT_REGISTRY are used: these are EXPECTED_TIMESTAMP_FORMATS,
+            plus any formats that have been registered (e.g. from a file; see
+            FormatRegistry.load()). YOU WILL PROBABLY WANT TO ADD FORMATS if
+            you're going to be parsing arbitrary dates with this thing -- the
+            default formats are suitable for my use cases right now, but not
+            comprehensive.
+
+       cache: ParseCache or None
+            Cache of previously parsed timestamps. Defaults to PARSE_CACHE;
+            if this is None, no caching will be done.
 
        Returns
        -------
@@ -65,13 +594,493 @@ def strict_parse(
                           the expected_formats. For huge datasets with some
                           incomplete or otherwise funky timestamps, this is to
                           be expected -- this case should be handled
-                          appropriately.
+                          appropriately. This is also raised if the timestamp
+                          matches a format but describes a date that doesn't
+                          exist (e.g. "2019-02-30").
     """
-    arrow_obj = arrow.get(timestamp, expected_formats)
+    if expected_formats is None:
+        expected_formats = FORMAT_REGISTRY.formats
+    if cache is not None:
+        return cache.parse(
+            timestamp,
+            tuple(expected_formats),
+            lambda t: strict_parse(t, expected_formats, cache=None),
+        )
+    try:
+        arrow_obj = arrow.get(timestamp, expected_formats)
+    except arrow.ParserError:
+        raise
+    except ValueError as e:
+        # arrow matched one of the formats, but the date it describes can't
+        # exist. For our purposes that's just as bad as not matching at all.
+        raise arrow.ParserError(str(e))
     # If that didn't fail, then Arrow was able to parse the timestamp! Yay.
     return arrow_obj.date()
 
 
+def _strict_parse_or_none(timestamp, expected_formats):
+    try:
+        return strict_parse(timestamp, expected_formats, cache=None)
+    except arrow.ParserError:
+        return None
+
+
+def _compile_date_format(fmt):
+    """Converts an arrow format string to a regular expression.
+
+       The resulting regex matches the same strings that arrow.get() would
+       match using this format, and has one named group per token.
+
+       Returns None if the format contains tokens that aren't in
+       _DATE_TOKEN_PATTERNS, if it contains multiple tokens for the same part
+       of a date (e.g. "YYYY" and "YY"), or if it contains literal digits
+       (since FormatRegistry.dispatch() assumes that a format's regex doesn't
+       care about which digits a timestamp contains).
+    """
+    if _DIGIT_RE.search(fmt):
+        return None
+    pattern = ""
+    fields = []
+    # Text in [square brackets] is inserted into the pattern as is
+    literals = _FORMAT_ESCAPE_RE.findall(fmt)
+    pieces = _FORMAT_ESCAPE_RE.split(fmt)
+    for i, piece in enumerate(pieces):
+        prev_end = 0
+        for m in _FORMAT_TOKEN_RE.finditer(piece):
+            token = m.group(0)
+            if token not in _DATE_TOKEN_FIELDS:
+                return None
+            if _DATE_TOKEN_FIELDS[token] in fields:
+                return None
+            fields.append(_DATE_TOKEN_FIELDS[token])
+            token_start = m.start()
+            pattern += re.escape(piece[prev_end:token_start])
+            pattern += "(?P<{}>{})".format(token, _DATE_TOKEN_PATTERNS[token])
+            prev_end = m.end()
+        pattern += re.escape(piece[prev_end:])
+        if i < len(literals):
+            pattern += literals[i][1:-1]
+    return re.compile(
+        _FORMAT_START_BOUNDARY + pattern + _FORMAT_END_BOUNDARY,
+        flags=re.IGNORECASE,
+    )
+
+
+def _get_format_tokens(fmt):
+    return _FORMAT_TOKEN_RE.findall(_FORMAT_ESCAPE_RE.sub("", fmt))
+
+
+class FormatRegistry(object):
+    """An ordered list of timestamp formats, each compiled to a regex once.
+
+       strict_parse_series() uses this to send each timestamp straight to the
+       first format that can match it, rather than trying every format in
+       turn. Timestamps are grouped by "shape" (the timestamp with each digit
+       replaced by 0, e.g. "2019-02-01" and "2020-12-31" both have the shape
+       "0000-00-00"). Whether or not a format's regex matches a timestamp only
+       depends on the timestamp's shape, so we only need to figure out which
+       format to use once per shape -- most metadata files only contain a
+       handful of different shapes, even if they have lots of different
+       timestamps. The format used for each shape is remembered, so later
+       calls don't need to figure this out again.
+    """
+
+    # Forget about remembered shapes once there are this many of them
+    MAX_SHAPES = 100000
+
+    def __init__(self, formats=EXPECTED_TIMESTAMP_FORMATS):
+        self.set_formats(formats)
+
+    def __len__(self):
+        return len(self.formats)
+
+    def set_formats(self, formats):
+        """Replaces all of the registered formats with a list of formats."""
+        self.formats = []
+        self.compiled = []
+        self._shape2index = {}
+        for fmt in formats:
+            self.register(fmt)
+
+    def register(self, fmt):
+        """Adds a format to the end of the list (so it's tried last).
+
+           Formats have to include a year, month, and day, since that's what
+           "strict" parsing requires.
+        """
+        tokens = [t[0] for t in _get_format_tokens(fmt)]
+        if not {"Y", "M", "D"} <= set(tokens):
+            raise ValueError(
+                "Timestamp format {!r} must include a year, month, and "
+                "day.".format(fmt)
+            )
+        if fmt not in self.formats:
+            self.formats.append(fmt)
+            self.compiled.append(_compile_date_format(fmt))
+            self._shape2index.clear()
+
+    def load(self, filepath):
+        """Registers the formats listed in a file, in order.
+
+           The file should contain one format per line (e.g. "D MMMM YYYY").
+           Blank lines, and lines starting with #, are ignored.
+
+           Returns the list of formats read from the file.
+        """
+        with open(filepath, "r") as f:
+            formats = [line.strip() for line in f]
+        formats = [fmt for fmt in formats if fmt and not fmt.startswith("#")]
+        for fmt in formats:
+            self.register(fmt)
+        return formats
+
+    def dispatch(self, shape):
+        """Returns the index of the format to use for timestamps of a shape.
+
+           This is the index of the first format whose regex matches the
+           shape; if a format without a regex (see _compile_date_format())
+           comes first, that format's index is returned instead, since we
+           can't tell whether or not it'd match. If no format matches, this
+           returns len(self).
+        """
+        try:
+            return self._shape2index[shape]
+        except KeyError:
+            pass
+        index = len(self.formats)
+        for i, fmt_re in enumerate(self.compiled):
+            if fmt_re is None or fmt_re.search(shape):
+                index = i
+                break
+        if len(self._shape2index) >= FormatRegistry.MAX_SHAPES:
+            self._shape2index.clear()
+        self._shape2index[shape] = index
+        return index
+
+
+# The formats used by strict_parse() and strict_parse_series() by default
+FORMAT_REGISTRY = FormatRegistry()
+
+
+@functools.lru_cache(maxsize=32)
+def _get_format_registry(formats):
+    return FormatRegistry(formats)
+
+
+@contextmanager
+def timestamp_formats_file(filepath):
+    """Registers extra formats from a file in FORMAT_REGISTRY, temporarily.
+
+       If filepath is None, this doesn't do anything. Otherwise, the formats
+       in the file (see FormatRegistry.load()) are used in addition to the
+       default formats within the with block.
+    """
+    if filepath is None:
+        yield FORMAT_REGISTRY
+        return
+    old_formats = list(FORMAT_REGISTRY.formats)
+    FORMAT_REGISTRY.load(filepath)
+    try:
+        yield FORMAT_REGISTRY
+    finally:
+        FORMAT_REGISTRY.set_formats(old_formats)
+
+
+def _ymd_to_dates(years, months, days):
+    """Converts arrays of year/month/day numbers to a datetime64[D] array.
+
+       Returns a tuple of (validity mask, dates). Combinations that don't
+       describe a real date (e.g. February 30th) are marked as invalid, and
+       their entries in the date array are set to NaT.
+    """
+    years = np.asarray(years, dtype=np.int64)
+    months = np.asarray(months, dtype=np.int64)
+    days = np.asarray(days, dtype=np.int64)
+
+    valid = (years >= 1) & (months >= 1) & (months <= 12) & (days >= 1)
+    months_since_epoch = (years - 1970) * 12 + (months - 1)
+    month_starts = months_since_epoch.astype("M8[M]").astype("M8[D]")
+    next_month_starts = (
+        (months_since_epoch + 1).astype("M8[M]").astype("M8[D]")
+    )
+    valid &= days <= (next_month_starts - month_starts).astype(np.int64)
+
+    dates = month_starts + (days - 1).astype("m8[D]")
+    dates[~valid] = np.datetime64("NaT")
+    return valid, dates
+
+
+@PROFILER.wrap("strict parsing")
+def strict_parse_series(
+    timestamps, expected_formats=None, cache=PARSE_CACHE, pool=PARSE_POOL
+):
+    """Parses many timestamps at once, the same way strict_parse() would.
+
+       Each (unique) timestamp is sent straight to the first format that can
+       match it, using a FormatRegistry; the timestamps for each format are
+       then parsed all at once using pandas' vectorized string methods. As
+       with arrow.get(), the first format that matches a timestamp decides
+       how it's parsed -- so stuff like "2012-10" is still rejected.
+
+       Formats that can't be converted to a regex (see
+       _compile_date_format()) are handed off to strict_parse(), along with
+       all of the formats after them, for the timestamps that none of the
+       earlier formats matched.
+
+       Non-string timestamps are converted to strings first, like we do when
+       calling strict_parse() on a single value. Missing values (e.g. NaN) are
+       considered invalid.
+
+       Parameters
+       ----------
+
+       timestamps: pd.Series or list-like
+            Timestamps to parse.
+
+       expected_formats: list of str or None
+            Formats to try parsing the timestamps with, in order. See
+            strict_parse().
+
+       cache: ParseCache or None
+            Cache of previously parsed timestamps, as in strict_parse(). Each
+            unique timestamp is looked up in (and then added to) the cache.
+
+       pool: ParsePool or None
+            Used to parse timestamps that have to be handed off to
+            strict_parse(), possibly in parallel. If this is None, these are
+            parsed one at a time in this process.
+
+       Returns
+       -------
+
+       (valid, dates): (np.ndarray of bool, np.ndarray of datetime64[D])
+            Both arrays have the same length as timestamps. valid[i] is True
+            if timestamps[i] was successfully parsed, and dates[i] is the date
+            it was parsed to (or NaT if valid[i] is False).
+    """
+    if expected_formats is None:
+        registry = FORMAT_REGISTRY
+    else:
+        registry = _get_format_registry(tuple(expected_formats))
+
+    codes, uniques = pd.factorize(pd.Series(timestamps, dtype=object))
+    uniques = pd.Series([str(u) for u in uniques], dtype=object)
+
+    unique_valid = np.zeros(len(uniques), dtype=bool)
+    unique_dates = np.full(len(uniques), np.datetime64("NaT"), dtype="M8[D]")
+    # Indices (within uniques) of timestamps that need to be parsed
+    remaining = np.arange(len(uniques))
+
+    if cache is not None:
+        formats_key = tuple(registry.formats)
+        uncached = []
+        for ui, u in enumerate(uniques):
+            result = cache.get(u, formats_key)
+            if result is ParseCache.MISSING:
+                uncached.append(ui)
+            elif result is not None:
+                unique_valid[ui] = True
+                unique_dates[ui] = result
+        remaining = np.array(uncached, dtype=np.int64)
+        to_cache = remaining
+
+    # Figure out which format to use for each remaining timestamp, based on
+    # its shape
+    shape_codes, shapes = pd.factorize(
+        uniques.iloc[remaining].str.translate(_SHAPE_TABLE)
+    )
+    shape_format_indices = np.array(
+        [registry.dispatch(shape) for shape in shapes], dtype=np.int64
+    )
+    format_indices = shape_format_indices[shape_codes]
+
+    # Timestamps that didn't match any format (format index len(registry))
+    # are left as invalid
+    for fi in np.unique(format_indices[format_indices < len(registry)]):
+        fmt_indices = remaining[format_indices == fi]
+        fmt_re = registry.compiled[fi]
+        if fmt_re is None:
+            # We can't handle this format ourselves, so just let arrow try
+            # this format and the ones after it on each of these timestamps
+            parse_func = functools.partial(
+                _strict_parse_or_none, expected_formats=registry.formats[fi:],
+            )
+            if pool is None:
+                results = _parse_chunk(parse_func, uniques.iloc[fmt_indices])
+            else:
+                results = pool.map(parse_func, uniques.iloc[fmt_indices])
+            for ui, d in zip(fmt_indices, results):
+                if d is not None:
+                    unique_valid[ui] = True
+                    unique_dates[ui] = d
+            continue
+
+        parts = uniques.iloc[fmt_indices].str.extract(fmt_re)
+
+        def get_part(tokens, default):
+            for t in tokens:
+                if t in parts.columns:
+                    return parts[t].astype(np.int64).to_numpy()
+            return np.full(len(parts.index), default, dtype=np.int64)
+
+        years = get_part(["YYYY"], 1)
+        if "YY" in parts.columns:
+            two_digit_years = get_part(["YY"], 0)
+            years = np.where(
+                two_digit_years > 68,
+                1900 + two_digit_years,
+                2000 + two_digit_years,
+            )
+        # Timestamps that match a format but don't describe a real date are
+        # invalid (rather than being tried against later formats -- arrow
+        # does the same thing)
+        valid, dates = _ymd_to_dates(
+            years, get_part(["MM", "M"], 1), get_part(["DD", "D"], 1)
+        )
+        unique_valid[fmt_indices] = valid
+        unique_dates[fmt_indices] = dates
+
+    if cache is not None:
+        new_dates = unique_dates[to_cache].astype(object)
+        for ui, ok, d in zip(to_cache, unique_valid[to_cache], new_dates):
+            cache.put(uniques[ui], formats_key, d if ok else None)
+
+    valid = np.zeros(len(codes), dtype=bool)
+    dates = np.full(len(codes), np.datetime64("NaT"), dtype="M8[D]")
+    found = codes >= 0
+    valid[found] = unique_valid[codes[found]]
+    dates[found] = unique_dates[codes[found]]
+    return valid, dates
+
+
+def lenient_parse(timestamp, cache=PARSE_CACHE):
+    """Parses a timestamp with dateutil, returning just its date.
+
+       Unlike strict_parse(), this accepts pretty much any reasonable-looking
+       timestamp (e.g. "2019-03-10 12:30"); this is what add-diet uses. Errors
+       from dateutil (for timestamps it can't parse) are raised as is.
+    """
+    if cache is None:
+        return dateutil_parse(timestamp).date()
+    return cache.parse(timestamp, None, lambda t: dateutil_parse(t).date())
+
+
+def _lenient_parse_or_error(timestamp):
+    try:
+        return lenient_parse(timestamp, cache=None)
+    except (ValueError, OverflowError) as e:
+        return e
+
+
+@PROFILER.wrap("lenient parsing")
+def lenient_parse_series(timestamps, cache=PARSE_CACHE, pool=PARSE_POOL):
+    """Parses many timestamps with lenient_parse(), possibly in parallel.
+
+       Timestamps that aren't in the cache are parsed using pool (or one at a
+       time in this process, if pool is None). Returns a np.ndarray of
+       datetime64[D] dates. As with lenient_parse(), if any of the timestamps
+       can't be parsed, an error is raised -- this is the error for the first
+       such timestamp.
+    """
+    timestamps = list(timestamps)
+    results = [None] * len(timestamps)
+    todo = []
+    for i, t in enumerate(timestamps):
+        result = ParseCache.MISSING
+        if cache is not None:
+            result = cache.get(t, None)
+        if result is ParseCache.MISSING:
+            todo.append(i)
+        elif result is None:
+            results[i] = arrow.ParserError(
+                "Could not parse timestamp {!r} (cached result).".format(t)
+            )
+        else:
+            results[i] = result
+
+    todo_timestamps = [timestamps[i] for i in todo]
+    if pool is None:
+        parsed = _parse_chunk(_lenient_parse_or_error, todo_timestamps)
+    else:
+        parsed = pool.map(_lenient_parse_or_error, todo_timestamps)
+    for i, t, result in zip(todo, todo_timestamps, parsed):
+        if cache is not None and not isinstance(result, OverflowError):
+            cache.put(
+                t, None, None if isinstance(result, ValueError) else result
+            )
+        results[i] = result
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return np.array(results, dtype="M8[D]")
+
+
+class TimestampColumn(object):
+    """A column of timestamps that can be parsed lazily, and only once.
+
+       This is meant to be shared by multiple transformations of the same
+       metadata (see pipeline.py): each unique timestamp is only parsed (by
+       strict_parse_series() or by lenient_parse_series()) the first time one
+       of the transformations needs it, and the results are reused
+       afterwards.
+    """
+
+    def __init__(self, timestamps):
+        self._codes, uniques = pd.factorize(
+            pd.Series(timestamps, dtype=object)
+        )
+        # Give missing values (e.g. NaN), which pd.factorize() marks as -1,
+        # their own slot at the end of the uniques, so that they're handled
+        # the same way the parsing functions would handle them. (Newer
+        # versions of pandas can do this with use_na_sentinel=False, but
+        # older versions -- like the ones QIIME 2 uses -- can't.)
+        self._uniques = np.append(np.asarray(uniques, dtype=object), np.nan)
+        self._codes[self._codes == -1] = len(self._uniques) - 1
+        n = len(self._uniques)
+        self._strict_done = np.zeros(n, dtype=bool)
+        self._strict_valid = np.zeros(n, dtype=bool)
+        self._strict_dates = np.full(n, np.datetime64("NaT"), dtype="M8[D]")
+        self._lenient_done = np.zeros(n, dtype=bool)
+        self._lenient_dates = np.full(n, np.datetime64("NaT"), dtype="M8[D]")
+
+    def __len__(self):
+        return len(self._codes)
+
+    def _get_codes_to_parse(self, mask, done):
+        codes = self._codes if mask is None else self._codes[mask]
+        needed = np.unique(codes)
+        return codes, needed[~done[needed]]
+
+    def strict_parse(self, mask=None):
+        """Returns (valid, dates) arrays as strict_parse_series() would.
+
+           If mask (a boolean array) is given, only the timestamps where mask
+           is True are parsed and returned.
+        """
+        codes, todo = self._get_codes_to_parse(mask, self._strict_done)
+        if len(todo) > 0:
+            valid, dates = strict_parse_series(self._uniques[todo])
+            self._strict_valid[todo] = valid
+            self._strict_dates[todo] = dates
+            self._strict_done[todo] = True
+        return self._strict_valid[codes], self._strict_dates[codes]
+
+    def lenient_parse(self, mask=None):
+        """Returns an array of the dates lenient_parse() would give.
+
+           If mask (a boolean array) is given, only the timestamps where mask
+           is True are parsed and returned.
+        """
+        codes, todo = self._get_codes_to_parse(mask, self._lenient_done)
+        if len(todo) > 0:
+            self._lenient_dates[todo] = lenient_parse_series(
+                self._uniques[todo]
+            )
+            self._lenient_done[todo] = True
+        return self._lenient_dates[codes]
+
+
 def check_cols_present(df, required_cols):
     """Checks that a collection of columns are all present in a DataFrame."""
 
@@ -92,8 +1101,360 @@ def check_cols_not_present(df, disallowed_cols):
         )
 
 
+_COMPRESSION_EXTENSIONS = (".gz", ".bz2", ".zip", ".xz", ".zst")
+
+
+def read_table(filepath):
+    """Reads a CSV or TSV file (which may be compressed) into a DataFrame.
+
+       Files with a .csv extension (ignoring any compression extension, e.g.
+       .csv.gz) are read as comma-separated; everything else is read as
+       tab-separated. All values are read in as strings, with leading and
+       trailing whitespace removed. The first line of the file is used as the
+       header.
+
+       The returned DataFrame is indexed by each row's line number in the
+       file (starting from 2, since line 1 is the header), so that errors can
+       point to the offending lines. Blank rows are skipped.
+    """
+    base = filepath.lower()
+    for ext in _COMPRESSION_EXTENSIONS:
+        if base.endswith(ext):
+            base = base[: -len(ext)]
+            break
+    sep = "," if base.endswith(".csv") else "\t"
+    df = pd.read_csv(
+        filepath,
+        sep=sep,
+        dtype=str,
+        keep_default_na=False,
+        compression="infer",
+        # Keep blank lines, so that we know each row's line number
+        skip_blank_lines=False,
+    )
+    df.columns = [c.strip() for c in df.columns]
+    for col in df.columns:
+        df[col] = df[col].str.strip()
+    df.index = pd.RangeIndex(2, len(df.index) + 2)
+    return df.loc[(df != "").any(axis=1)]
+
+
+# QIIME 2 treats lines starting with "#" as comments, except for these ID
+# column headers (and except for directives like "#q2:types", which can occur
+# right after the header).
+_HASH_ID_HEADERS = {"#SampleID", "#Sample ID", "#OTUID", "#OTU ID"}
+
+
+def _is_md_comment_or_blank(line):
+    if line.strip() == "":
+        return True
+    return (
+        line.startswith("#")
+        and line.rstrip("\r\n").split("\t", 1)[0] not in _HASH_ID_HEADERS
+    )
+
+
+def _split_md_line(line):
+    return line.rstrip("\r\n").split("\t")
+
+
+def _iter_md_lines(f):
+    """Yields ("header" | "directive" | "data", line) from a metadata file.
+
+       Comments and blank lines are skipped.
+    """
+    seen_header = False
+    in_directives = False
+    for line in f:
+        if not seen_header:
+            if not _is_md_comment_or_blank(line):
+                seen_header = True
+                in_directives = True
+                yield "header", line
+        elif in_directives and line.startswith("#q2:"):
+            yield "directive", line
+        else:
+            in_directives = False
+            if not _is_md_comment_or_blank(line):
+                yield "data", line
+
+
+def read_md_header(filepath):
+    """Reads the header and any directives from a QIIME 2 metadata file.
+
+       Returns
+       -------
+
+       (header, directives): (list of str, list of list of str)
+            The header line's cells (the first of which is the ID column
+            header) and the cells of each directive line (e.g.
+            ["#q2:types", "categorical", ...]).
+    """
+    header = None
+    directives = []
+    with open(filepath, "r") as f:
+        for kind, line in _iter_md_lines(f):
+            if kind == "header":
+                header = _split_md_line(line)
+            elif kind == "directive":
+                directives.append(_split_md_line(line))
+            else:
+                break
+    if header is None:
+        raise ValueError(
+            "Metadata file {} doesn't have a header line.".format(filepath)
+        )
+    return header, directives
+
+
+def get_md_directives(filepath, include_types=False):
+    """Returns the directives in a metadata file's header, by column.
+
+       If include_types is True and the file doesn't have a #q2:types
+       directive, an empty one is included anyway (so that the file's
+       columns' types are left for QIIME 2 to infer, but new columns added
+       on by Qeeseburger are declared as categorical: see write_md_header()).
+       This is what qiime2.Metadata.save() does, since it always writes out
+       a #q2:types directive.
+
+       Returns
+       -------
+
+       dict of str -> dict of str -> str
+            Maps the name of each directive (e.g. "#q2:types") to a dict
+            mapping column names to this directive's value for that column.
+    """
+    header, directive_rows = read_md_header(filepath)
+    directives = {
+        row[0]: dict(zip(header[1:], row[1:])) for row in directive_rows
+    }
+    if include_types and "#q2:types" not in directives:
+        directives["#q2:types"] = {c: "" for c in header[1:]}
+    return directives
+
+
+def _parse_md_lines(lines, header, usecols=None):
+    """Parses data lines from a metadata file into a DataFrame of strings.
+
+       Cells are read verbatim: quotes aren't interpreted, and empty cells are
+       read as empty strings.
+    """
+    if len(lines) == 0:
+        columns = header[1:] if usecols is None else usecols[1:]
+        return pd.DataFrame(
+            columns=columns, index=pd.Index([], name=header[0]), dtype=object
+        )
+    return pd.read_csv(
+        io.StringIO("".join(lines)),
+        sep="\t",
+        header=None,
+        names=header,
+        index_col=0,
+        usecols=usecols,
+        dtype=str,
+        keep_default_na=False,
+        quoting=csv.QUOTE_NONE,
+    )
+
+
+def iter_md_chunks(filepath, chunk_size=None, usecols=None):
+    """Reads a QIIME 2 metadata file in chunks of at most chunk_size samples.
+
+       Yields DataFrames indexed by sample ID. All values are read as strings
+       (empty cells are read as empty strings), and comments are ignored. If
+       usecols is specified, only these columns are included in each chunk
+       (this is a lot faster than loading every column if you only need to
+       look at a few of them).
+
+       Only a single chunk's worth of data is kept in memory at once, so this
+       can be used for metadata files that are too large to load all at once.
+       If chunk_size is None, the entire file is read as a single chunk.
+    """
+    header, directives = read_md_header(filepath)
+    if usecols is not None:
+        usecols = [header[0]] + list(usecols)
+
+    with open(filepath, "r") as f:
+        lines = []
+        for kind, line in _iter_md_lines(f):
+            if kind != "data":
+                continue
+            lines.append(line if line.endswith("\n") else line + "\n")
+            if chunk_size is not None and len(lines) >= chunk_size:
+                yield _parse_md_lines(lines, header, usecols)
+                lines = []
+        if len(lines) > 0 or chunk_size is None:
+            yield _parse_md_lines(lines, header, usecols)
+
+
+def write_md_header(f, header, directives):
+    """Writes a header line and directive lines to an open metadata file.
+
+       directives should be formatted like the output of get_md_directives().
+       Columns that a directive doesn't have a value for (e.g. new columns
+       added on by Qeeseburger) are declared as "categorical" in #q2:types
+       directives, and left empty in any other directives.
+    """
+    f.write("\t".join(header) + "\n")
+    for name, col2value in directives.items():
+        default = "categorical" if name == "#q2:types" else ""
+        cells = [name] + [col2value.get(c, default) for c in header[1:]]
+        f.write("\t".join(cells) + "\n")
+
+
+def write_md_rows(f, metadata_df):
+    """Writes the rows of a DataFrame to an open metadata file."""
+
+    metadata_df.to_csv(f, sep="\t", header=False, quoting=csv.QUOTE_NONE)
+
+
+def load_metadata(filepath, backend="native"):
+    """Loads a QIIME 2 metadata file into a DataFrame indexed by sample ID.
+
+       Parameters
+       ----------
+
+       filepath: str
+            Path to a QIIME 2 metadata file.
+
+       backend: str
+            Either "native" or "qiime2".
+
+            "native" reads the file directly into a DataFrame where every value
+            is a string (cells are read verbatim, and empty cells are read as
+            empty strings). Comments are skipped; use get_md_directives() to
+            get directives like #q2:types. No validation or type inference is
+            done, and QIIME 2 doesn't need to be installed.
+
+            "qiime2" uses qiime2.Metadata.load(), which validates the file and
+            converts numeric columns to floats.
+
+       Returns
+       -------
+
+       pd.DataFrame
+    """
+    if backend == "native":
+        return next(iter_md_chunks(filepath))
+    elif backend == "qiime2":
+        # QIIME 2 takes a while to import, so we only import it when we need
+        # it
+        from qiime2 import Metadata
+
+        return Metadata.load(filepath).to_dataframe()
+    else:
+        raise ValueError("Unrecognized metadata backend: {}".format(backend))
+
+
+def save_metadata(metadata_df, filepath, backend="native", directives=None):
+    """Saves a DataFrame indexed by sample ID as a QIIME 2 metadata file.
+
+       The "native" backend writes the DataFrame out directly: a header line
+       (using the index's name as the ID column header), any directives (in the
+       format returned by get_md_directives()), and then one line per sample.
+       Saving a DataFrame loaded with the "native" backend, along with its
+       directives, reproduces the original file (minus any comments).
+
+       The "qiime2" backend uses qiime2.Metadata.save(); directives are
+       ignored, since QIIME 2 infers column types itself.
+    """
+    if backend == "native":
+        id_header = metadata_df.index.name
+        if id_header is None:
+            id_header = "sample-id"
+        columns = [str(c) for c in metadata_df.columns]
+        with open(filepath, "w") as f:
+            write_md_header(f, [id_header] + columns, directives or {})
+            write_md_rows(f, metadata_df)
+    elif backend == "qiime2":
+        from qiime2 import Metadata
+
+        # QIIME 2 doesn't accept categorical columns (like the ones that
+        # Qeeseburger adds on), so we convert these back to plain strings
+        cat_cols = metadata_df.select_dtypes("category").columns
+        metadata_df = metadata_df.astype({c: object for c in cat_cols})
+        Metadata(metadata_df).save(filepath)
+    else:
+        raise ValueError("Unrecognized metadata backend: {}".format(backend))
+
+
+def attach_cols(metadata_df, new_cols):
+    """Adds new columns to a DataFrame in place, and returns the DataFrame.
+
+       new_cols should map column names to array-likes, each containing one
+       value per row of metadata_df (in the same order as metadata_df's rows).
+       Only these new columns are added -- none of metadata_df's existing
+       columns are copied.
+    """
+    for col_name, col_values in new_cols.items():
+        metadata_df[col_name] = col_values
+    return metadata_df
+
+
+def find_reusable_rows(metadata_df, previous_df, output_cols, key_cols):
+    """Finds samples whose derived values can be reused from a previous run.
+
+       previous_df should be a DataFrame that was previously output by the
+       same command. A sample's values in output_cols can be reused if
+       previous_df has a sample with the same ID, and this sample has the
+       same values in all of key_cols (e.g. collection_timestamp) as it does
+       in metadata_df.
+
+       Returns
+       -------
+
+       (reusable, previous_rows): (np.ndarray of bool, np.ndarray of int)
+            reusable indicates, for each sample in metadata_df, whether or
+            not this sample's values can be reused. previous_rows contains,
+            for each reusable sample, the position of its row in previous_df.
+    """
+    missing_cols = set(output_cols) - set(previous_df.columns)
+    if len(missing_cols) > 0:
+        raise ValueError(
+            "The previous output file doesn't include the following "
+            "columns: {}".format(missing_cols)
+        )
+
+    positions = previous_df.index.get_indexer(metadata_df.index)
+    reusable = positions >= 0
+    for col in key_cols:
+        if col not in previous_df.columns:
+            reusable[:] = False
+            break
+        # Values are compared as strings, in case one of the files was loaded
+        # with the qiime2 backend
+        prev_values = previous_df[col].to_numpy()[positions[reusable]]
+        curr_values = metadata_df[col].to_numpy()[reusable]
+        reusable[reusable] = prev_values.astype(str) == curr_values.astype(str)
+    return reusable, positions[reusable]
+
+
+def combine_cols(reusable, new_cols, reused_cols):
+    """Merges the recomputed and reused values of some columns.
+
+       new_cols and reused_cols should both map the same column names to
+       arrays of values: new_cols containing values for the samples where
+       reusable is False, and reused_cols containing values for the samples
+       where reusable is True (see find_reusable_rows()).
+
+       Returns an OrderedDict mapping each column's name to its values for
+       all of the samples, as a pd.Categorical.
+    """
+    combined = OrderedDict()
+    for col_name, col_values in new_cols.items():
+        values = np.empty(len(reusable), dtype=object)
+        values[~reusable] = np.asarray(col_values, dtype=object)
+        values[reusable] = reused_cols[col_name]
+        combined[col_name] = pd.Categorical(values)
+    return combined
+
+
 def manipulate_md(
-    input_metadata_file, param_list, output_metadata_file, modification_func
+    input_metadata_file,
+    param_list,
+    output_metadata_file,
+    modification_func,
+    backend="native",
 ):
     """Automates a common I/O paradigm in Qeeseburger's scripts.
 
@@ -101,13 +1462,28 @@ def manipulate_md(
        the DF with some specified parameters (can be an empty list if there are
        no other parameters besides the metadata file), and outputs the modified
        metadata DF to an output path.
+
+       modification_func should NOT modify or copy the DF it's given: it
+       should just return the new columns to add, as a dict mapping column
+       names to arrays of values (see attach_cols()). These columns are then
+       added directly to the loaded DF, so wide metadata files aren't copied
+       just to add on a few columns.
+
+       backend is the metadata I/O backend to use: see load_metadata().
     """
-    # First off, load the metadata file and convert it to a DataFrame
-    m = Metadata.load(input_metadata_file)
-    m_df = m.to_dataframe()
+    # First off, load the metadata file as a DataFrame
+    with PROFILER.span("load metadata"):
+        m_df = load_metadata(input_metadata_file, backend)
+        directives = None
+        if backend == "native":
+            directives = get_md_directives(
+                input_metadata_file, include_types=True
+            )
 
     # ... Actually do relevant computations
-    m_df_new = modification_func(m_df, *param_list)
+    with PROFILER.span("transform"):
+        attach_cols(m_df, modification_func(m_df, *param_list))
 
-    # Convert modified DataFrame back into a q2 Metadata object and save it
-    Metadata(m_df_new).save(output_metadata_file)
+    # Save the modified DataFrame
+    with PROFILER.span("save metadata"):
+        save_metadata(m_df, output_metadata_file, backend, directives)
@@ -37,18 +37,35 @@ setup(
     url="https://github.com/fedarko/qeeseburger",
     packages=find_packages(),
     include_package_data=True,
-    install_requires=["click", "arrow", "python-dateutil", "pandas", "xlrd"],
+    install_requires=[
+        "click",
+        "arrow >= 0.15.0",
+        "python-dateutil",
+        "numpy",
+        "pandas",
+        "xlrd",
+    ],
     # Based on how Altair splits up its requirements:
     # https://github.com/altair-viz/altair/blob/master/setup.py
     extras_require={
-        "dev": ["pytest >= 4.2", "pytest-cov >= 2.0", "flake8", "black"]
+        "dev": [
+            "pytest >= 4.2",
+            "pytest-cov >= 2.0",
+            "pytest-benchmark",
+            "flake8",
+            "black",
+        ],
+        "yaml": ["pyyaml"],
     },
     classifiers=classifiers,
     entry_points={
         "console_scripts": [
-            "add-ts-cols=qeeseburger.add_timeseries_cols:add_columns",
-            "add-host-ages=qeeseburger.add_host_ages:add_host_ages",
-            "add-diet=qeeseburger.add_dietary_phase:add_dietary_phase",
+            "add-ts-cols=qeeseburger.cli:add_columns",
+            "add-ts-cols-batch=qeeseburger.cli:add_columns_batch",
+            "add-host-ages=qeeseburger.cli:add_host_ages",
+            "add-diet=qeeseburger.cli:add_dietary_phase",
+            "add-diet-batch=qeeseburger.cli:add_dietary_phases",
+            "qeeseburger=qeeseburger.cli:qeeseburger",
         ],
     },
     zip_safe=False,